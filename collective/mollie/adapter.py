@@ -1,16 +1,99 @@
-from persistent.mapping import PersistentMapping
+import heapq
+import time
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 
-from DateTime import DateTime
 from zope.annotation import IAttributeAnnotatable, IAnnotations
 from zope.component import adapts
 from zope.interface import implements
 from zope.component import getUtility
+from zope.component import queryUtility
 
 from collective.mollie.config import IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY
+from collective.mollie.config import \
+    IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY
+from collective.mollie.config import \
+    IDEAL_MULTIPLE_PAYMENTS_ORDER_ANNOTATION_KEY
 from collective.mollie.config import IDEAL_PAYMENT_ANNOTATION_KEY
 from collective.mollie.interfaces import IMollieIdeal
 from collective.mollie.interfaces import IMollieIdealMultiplePayments
 from collective.mollie.interfaces import IMollieIdealPayment
+from collective.mollie.interfaces import IMollieTransactionIndex
+from collective.mollie.precheck import add_known_transaction
+from collective.mollie.storage import FINAL_STATUSES
+from collective.mollie.storage import PaymentRecord
+from collective.mollie.storage import as_payment_record
+from collective.mollie.storage import as_payment_tree
+
+
+def _consumer_data(order_info):
+    """Return the consumer of a check result as a plain dict (or None).
+
+    Only builtin types are stored in the database, so the stored
+    payments do not depend on the result classes.
+    """
+    consumer = order_info.get('consumer')
+    if consumer is None:
+        return None
+    return dict(consumer.items())
+
+
+def update_payment(payment, order_info, last_checked_interval=None):
+    """Store the result of a payment check in the ``payment`` record.
+
+    Only fields which changed are written, and ``last_update`` only
+    when something changed. So when Mollie answers 'CheckedBefore' to
+    a repeated report, the record is not changed at all.
+
+    Instead, ``last_checked`` is set to the time of the check, but at
+    most once every ``last_checked_interval`` seconds (never if it is
+    None). Return True if the record was changed.
+    """
+    data = {'last_status': order_info['status']}
+    if order_info['status'] != 'CheckedBefore':
+        # Only store the main info the first time.
+        data['currency'] = order_info['currency']
+        data['paid'] = order_info['paid']
+        data['consumer'] = _consumer_data(order_info)
+        data['status'] = order_info['status']
+    now = time.time()
+    if payment.update(data):
+        payment['last_update'] = now
+        payment['last_checked'] = now
+        return True
+    if last_checked_interval is None:
+        return False
+    last_checked = payment.timestamp('last_checked')
+    if last_checked is None or now - last_checked >= last_checked_interval:
+        payment['last_checked'] = now
+        return True
+    return False
+
+
+def is_archivable(payment, cutoff):
+    """Return True if a final payment was last updated before ``cutoff``."""
+    last_update = payment.timestamp('last_update')
+    return (payment['status'] in FINAL_STATUSES and
+            last_update is not None and last_update < cutoff)
+
+
+def format_cursor(key, order):
+    """Return the cursor (a string) for the sort key of a transaction."""
+    if order == 'last_update':
+        return '%r:%s' % key
+    return key
+
+
+def parse_cursor(cursor, order):
+    """Return the sort key of the transaction of a cursor (or None)."""
+    if cursor is None or order != 'last_update':
+        return cursor
+    try:
+        last_update, transaction_id = cursor.split(':', 1)
+        return float(last_update), transaction_id
+    except ValueError:
+        raise ValueError('Invalid cursor: %r' % cursor)
 
 
 class UnknownTransactionError(ValueError):
@@ -18,25 +101,140 @@ class UnknownTransactionError(ValueError):
     pass
 
 
+def index_transaction(transaction_id, context, multiple=False):
+    """Add the transaction to the site wide index, if it is available."""
+    index = queryUtility(IMollieTransactionIndex)
+    if index is not None:
+        index.index_transaction(transaction_id, context, multiple)
+
+
+def index_payment(transaction_id, payment):
+    """Update the status of the payment in the site wide index."""
+    index = queryUtility(IMollieTransactionIndex)
+    if index is not None:
+        index.index_payment(transaction_id, payment)
+
+
+def get_indexed_payment(index, transaction_id, root):
+    """Return the record of a transaction in the site wide index.
+
+    Return None if the object or the payment cannot be found anymore.
+    """
+    entry = index.get(transaction_id)
+    obj = index.resolve(transaction_id, root)
+    if obj is None:
+        return None
+    if entry[2]:
+        try:
+            return IMollieIdealMultiplePayments(obj).get_transaction(
+                transaction_id)
+        except UnknownTransactionError:
+            return None
+    payment = IMollieIdealPayment(obj)._storage()
+    if payment is None or payment['transaction_id'] != transaction_id:
+        return None
+    return payment
+
+
+def migrate_payment(context):
+    """Convert the payment stored on ``context`` to the current storage.
+
+    Older versions stored the payment in a ``PersistentMapping``. It is
+    now stored as a ``PaymentRecord``, which resolves conflicting
+    changes. Return True if the payment has been migrated.
+    """
+    annotations = IAnnotations(context)
+    payment = annotations.get(IDEAL_PAYMENT_ANNOTATION_KEY)
+    if payment is None or isinstance(payment, PaymentRecord):
+        return False
+    annotations[IDEAL_PAYMENT_ANNOTATION_KEY] = \
+        PaymentRecord.from_dict(payment)
+    return True
+
+
+def migrate_multiple_payments(context):
+    """Convert the payments stored on ``context`` to the current storage.
+
+    Older versions stored all payments of a context as dicts in a
+    single ``PersistentMapping``. They are now stored as
+    ``PaymentRecord`` objects in an ``OOBTree``. Return True if the
+    payments have been migrated.
+    """
+    annotations = IAnnotations(context)
+    payments = annotations.get(IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY)
+    if payments is None or isinstance(payments, OOBTree):
+        return False
+    annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
+        as_payment_tree(payments)
+    return True
+
+
+def migrate_timestamps(context):
+    """Convert the times of the payments on ``context`` to epoch floats.
+
+    Older versions stored ``DateTime`` objects. Payments stored in the
+    older storage are migrated to records as well. Return True if
+    anything has been migrated.
+    """
+    migrated = migrate_payment(context)
+    migrated = migrate_multiple_payments(context) or migrated
+    annotations = IAnnotations(context)
+    payment = annotations.get(IDEAL_PAYMENT_ANNOTATION_KEY)
+    if payment is not None:
+        migrated = payment.migrate_timestamps() or migrated
+    payments = annotations.get(IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY)
+    if payments is not None:
+        for payment in payments.values():
+            if isinstance(payment, PaymentRecord):
+                migrated = payment.migrate_timestamps() or migrated
+    return migrated
+
+
 class MollieIdealPayment(object):
     implements(IMollieIdealPayment)
     adapts(IAttributeAnnotatable)
 
+    # Minimum number of seconds between storing the time a payment was
+    # checked without any changes. None to never store it.
+    LAST_CHECKED_INTERVAL = 3600
+
     def __init__(self, context):
+        self.context = context
         self.ideal_wrapper = getUtility(IMollieIdeal)
-        annotations = IAnnotations(context)
-        self._metadata = annotations.get(IDEAL_PAYMENT_ANNOTATION_KEY, None)
-        if self._metadata is None:
-            self._metadata = PersistentMapping()
-            annotations[IDEAL_PAYMENT_ANNOTATION_KEY] = self._metadata
+
+    def _storage(self, create=False):
+        """Return the stored payment.
+
+        The payment is only stored on the context (or migrated) when
+        ``create`` is True, so reading does not change the context.
+        Without a stored payment, None is returned.
+        """
+        annotations = IAnnotations(self.context)
+        payment = annotations.get(IDEAL_PAYMENT_ANNOTATION_KEY)
+        if payment is None:
+            if not create:
+                return None
+            payment = annotations[IDEAL_PAYMENT_ANNOTATION_KEY] = \
+                PaymentRecord()
+        elif not isinstance(payment, PaymentRecord):
+            if not create:
+                return PaymentRecord.from_dict(payment)
+            migrate_payment(self.context)
+            payment = annotations[IDEAL_PAYMENT_ANNOTATION_KEY]
+        return payment
+
+    _metadata = property(lambda self: self._storage(create=True))
 
     # Properties
 
     def _getter(self, key):
-        return self._metadata.get(key)
+        payment = self._storage()
+        if payment is None:
+            return None
+        return payment.get(key)
 
     def _setter(self, key, value):
-        self._metadata[key] = value
+        self._storage(create=True)[key] = value
 
     _partner_id = property(lambda self: self._getter('partner_id'),
         lambda self, value: self._setter('partner_id', value))
@@ -68,6 +266,9 @@ class MollieIdealPayment(object):
     last_status = property(lambda self: self._getter('last_status'),
         lambda self, value: self._setter('last_status', value))
 
+    last_checked = property(lambda self: self._getter('last_checked'),
+        lambda self, value: self._setter('last_checked', value))
+
     # Methods
 
     def get_banks(self):
@@ -83,20 +284,19 @@ class MollieIdealPayment(object):
         self._partner_id = partner_id
         self._profile_key = profile_key
         self.amount = amount
-        self.last_update = DateTime()
+        self.last_update = time.time()
+        index_transaction(transaction_id, self.context)
+        add_known_transaction(transaction_id)
+        index_payment(transaction_id, self._storage())
         return url
 
-    def get_payment_status(self):
-        order_info = self.ideal_wrapper.check_payment(
-            self._partner_id, self.transaction_id)
-        if order_info['status'] != 'CheckedBefore':
-            # Only store the main info the first time.
-            self.currency = order_info['currency']
-            self.paid = order_info['paid']
-            self.consumer = order_info.get('consumer')
-            self.status = order_info['status']
-        self.last_status = order_info['status']
-        self.last_update = DateTime()
+    def get_payment_status(self, order_info=None):
+        if order_info is None:
+            order_info = self.ideal_wrapper.check_payment(
+                self._partner_id, self.transaction_id)
+        payment = self._storage(create=True)
+        if update_payment(payment, order_info, self.LAST_CHECKED_INTERVAL):
+            index_payment(self.transaction_id, payment)
         return self.last_status
 
 
@@ -104,15 +304,93 @@ class MollieIdealMultiplePayments(object):
     implements(IMollieIdealMultiplePayments)
     adapts(IAttributeAnnotatable)
 
+    # Minimum number of seconds between storing the time a payment was
+    # checked without any changes. None to never store it.
+    LAST_CHECKED_INTERVAL = 3600
+
+    # Default number of seconds after the last update of a final
+    # payment before it is archived.
+    ARCHIVE_AGE = 30 * 24 * 3600
+
     def __init__(self, context):
+        self.context = context
         self.ideal_wrapper = getUtility(IMollieIdeal)
-        annotations = IAnnotations(context)
-        self._metadata = annotations.get(
-            IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY, None)
-        if self._metadata is None:
-            self._metadata = PersistentMapping()
-            annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
-                self._metadata
+
+    def _storage(self, create=False):
+        """Return the stored payments.
+
+        The payments are only stored on the context (or migrated) when
+        ``create`` is True, so reading does not change the context.
+        Without stored payments, None is returned.
+        """
+        annotations = IAnnotations(self.context)
+        payments = annotations.get(IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY)
+        if payments is None:
+            if not create:
+                return None
+            payments = annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
+                OOBTree()
+        elif create and not isinstance(payments, OOBTree):
+            migrate_multiple_payments(self.context)
+            payments = annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY]
+        return payments
+
+    _metadata = property(lambda self: self._storage(create=True))
+
+    def _archive(self, create=False):
+        """Return the archive of final payments.
+
+        Old final payments are moved from the stored payments to this
+        separate ``OOBTree``, so the tree new payments are written to
+        stays small. Without an archive (and ``create``), None is
+        returned.
+        """
+        annotations = IAnnotations(self.context)
+        archive = annotations.get(IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY)
+        if archive is None and create:
+            archive = annotations[
+                IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY] = OOBTree()
+        return archive
+
+    def _get_payment(self, payments, transaction_id):
+        """Return the stored (or archived) payment, or None."""
+        payment = None
+        if payments is not None:
+            payment = payments.get(transaction_id)
+        if payment is None:
+            archive = self._archive()
+            if archive is not None:
+                payment = archive.get(transaction_id)
+        return payment
+
+    def _order(self, create=False):
+        """Return the set of (last update, transaction ID) tuples.
+
+        The set is used to iterate over the payments in order of their
+        last update. Reports only add tuples to it: removing the old
+        tuple of a payment would make concurrent reports for the same
+        payment conflict. Tuples which do not match the last update of
+        the payment anymore are skipped when iterating, and removed by
+        ``archive_transactions`` once they are older than its cutoff.
+
+        The set is built when it is first needed for a write, so
+        without ``create`` None may be returned.
+        """
+        annotations = IAnnotations(self.context)
+        order = annotations.get(IDEAL_MULTIPLE_PAYMENTS_ORDER_ANNOTATION_KEY)
+        if order is None and create:
+            order = OOTreeSet()
+            for transaction_id, payment in self._storage(create=True).items():
+                payment = as_payment_record(payment)
+                order.insert((payment.timestamp('last_update') or 0.0,
+                              transaction_id))
+            annotations[IDEAL_MULTIPLE_PAYMENTS_ORDER_ANNOTATION_KEY] = order
+        return order
+
+    def _reorder(self, transaction_id, payment):
+        """Add the last update of a payment to the order of updates."""
+        self._order(create=True).insert(
+            (payment.timestamp('last_update') or 0.0, transaction_id))
 
     # Methods
 
@@ -125,35 +403,183 @@ class MollieIdealMultiplePayments(object):
             partner_id, bank_id, amount, message, report_url,
             return_url, profile_key)
 
-        self._metadata[transaction_id] = {
-            'partner_id': partner_id,
-            'profile_key': profile_key,
-            'amount': amount,
-            'last_update': DateTime(),
-            'curreny': None,
-            'status': None,
-            'paid': None,
-            'consumer': {},
-            'last_status': None,
-            }
+        payment = self._metadata[transaction_id] = PaymentRecord(
+            partner_id=partner_id,
+            profile_key=profile_key,
+            amount=amount,
+            last_update=time.time())
+        self._reorder(transaction_id, payment)
+        index_transaction(transaction_id, self.context, multiple=True)
+        add_known_transaction(transaction_id)
+        index_payment(transaction_id, payment)
         return transaction_id, url
 
-    def get_transaction(self, transaction_id):
-        transaction = self._metadata.get(transaction_id)
+    def _transaction(self, transaction_id, write=False):
+        """Return the record of a transaction.
+
+        Unless ``write`` is True, nothing is changed on the context: a
+        transaction stored as a dict is returned as a new record.
+        """
+        if not transaction_id:
+            raise UnknownTransactionError
+        payments = self._storage(create=write)
+        transaction = self._get_payment(payments, transaction_id)
         if transaction is None:
             raise UnknownTransactionError
+        if not isinstance(transaction, PaymentRecord):
+            # Stored as a dict, convert it to a record.
+            transaction = as_payment_record(transaction)
+            if write:
+                payments[transaction_id] = transaction
         return transaction
 
-    def get_payment_status(self, transaction_id):
-        transaction = self.get_transaction(transaction_id)
-        order_info = self.ideal_wrapper.check_payment(
-            transaction['partner_id'], transaction_id)
-        if order_info['status'] != 'CheckedBefore':
-            # Only store the main info the first time.
-            transaction['currency'] = order_info['currency']
-            transaction['paid'] = order_info['paid']
-            transaction['consumer'] = order_info.get('consumer')
-            transaction['status'] = order_info['status']
-        transaction['last_status'] = order_info['status']
-        transaction['last_update'] = DateTime()
+    def get_transaction(self, transaction_id):
+        return self._transaction(transaction_id)
+
+    def _ordered_keys(self, payments, order, min, max, after):
+        """Yield the sort keys and IDs of the transactions in order.
+
+        For the 'last_update' order, the sort key is a (last update,
+        transaction ID) tuple, for the 'transaction_id' order it is the
+        transaction ID. Only keys after the sort key ``after`` are
+        yielded.
+        """
+        if order == 'transaction_id':
+            if isinstance(payments, OOBTree):
+                keys = payments.keys(min, max)
+            else:
+                # Not migrated yet, sort the keys of the mapping.
+                keys = [key for key in sorted(payments.keys())
+                        if (min is None or key >= min) and
+                           (max is None or key <= max)]
+            archive = self._archive()
+            if archive is not None:
+                keys = heapq.merge(keys, archive.keys(min, max))
+            for key in keys:
+                if after is None or key > after:
+                    yield key, key
+            return
+        if order != 'last_update':
+            raise ValueError('Unknown order: %r' % order)
+        start = after
+        if min is not None and (start is None or start < (min,)):
+            start = (min,)
+        keys = self._order()
+        if keys is not None:
+            keys = keys.keys(start)
+        else:
+            # Not built yet, sort the payments in memory.
+            keys = sorted(
+                (as_payment_record(payment).timestamp('last_update') or 0.0,
+                 transaction_id)
+                for transaction_id, payment in payments.items())
+            if start is not None:
+                keys = [key for key in keys if key >= start]
+        for key in keys:
+            if max is not None and key[0] > max:
+                break
+            if key != after:
+                yield key, key[1]
+
+    def _transactions(self, min, max, order, cursor):
+        """Yield the sort keys, IDs and records of the transactions."""
+        payments = self._storage()
+        if payments is None:
+            return
+        after = parse_cursor(cursor, order)
+        for key, transaction_id in self._ordered_keys(
+                payments, order, min, max, after):
+            payment = self._get_payment(payments, transaction_id)
+            if payment is None:
+                continue
+            payment = as_payment_record(payment)
+            if (order == 'last_update' and
+                key[0] != (payment.timestamp('last_update') or 0.0)):
+                # The payment has been updated since.
+                continue
+            yield key, transaction_id, payment
+
+    def iter_transactions(self, min=None, max=None, order='transaction_id',
+                          cursor=None):
+        for key, transaction_id, payment in self._transactions(
+                min, max, order, cursor):
+            yield transaction_id, payment
+
+    def get_transactions_page(self, size=50, cursor=None, min=None,
+                              max=None, order='transaction_id'):
+        page = []
+        last_key = None
+        for key, transaction_id, payment in self._transactions(
+                min, max, order, cursor):
+            if len(page) == size:
+                # There is at least one more page.
+                return page, format_cursor(last_key, order)
+            page.append((transaction_id, payment))
+            last_key = key
+        return page, None
+
+    def archive_transaction(self, transaction_id):
+        """Move a payment to the archive.
+
+        The payment can still be found with ``get_transaction``. Return
+        False if the payment is not stored (or already archived).
+        """
+        payments = self._storage(create=True)
+        payment = payments.get(transaction_id)
+        if payment is None:
+            return False
+        self._archive(create=True)[transaction_id] = \
+            as_payment_record(payment)
+        del payments[transaction_id]
+        return True
+
+    def archive_transactions(self, max_age=None, now=None):
+        """Archive the final payments not updated for ``max_age`` seconds.
+
+        Without ``max_age``, the ``ARCHIVE_AGE`` of the adapter is used.
+        The tuples of earlier updates before the cutoff are removed from
+        the order of updates. Return the IDs of the archived
+        transactions.
+        """
+        if max_age is None:
+            max_age = self.ARCHIVE_AGE
+        if now is None:
+            now = time.time()
+        cutoff = now - max_age
+        payments = self._storage(create=True)
+        order = self._order()
+        archived = []
+        if order is None:
+            for transaction_id in list(payments.keys()):
+                if is_archivable(as_payment_record(payments[transaction_id]),
+                                 cutoff):
+                    self.archive_transaction(transaction_id)
+                    archived.append(transaction_id)
+            return archived
+        # Only look at the payments which were updated before.
+        dead = []
+        for key in order.keys(None, (cutoff,)):
+            last_update, transaction_id = key
+            payment = self._get_payment(payments, transaction_id)
+            if (payment is None or last_update !=
+                (as_payment_record(payment).timestamp('last_update') or 0.0)):
+                # An earlier update of the payment.
+                dead.append(key)
+            elif (transaction_id in payments and
+                  is_archivable(as_payment_record(payment), cutoff)):
+                self.archive_transaction(transaction_id)
+                archived.append(transaction_id)
+        for key in dead:
+            order.remove(key)
+        return archived
+
+    def get_payment_status(self, transaction_id, order_info=None):
+        transaction = self._transaction(transaction_id, write=True)
+        if order_info is None:
+            order_info = self.ideal_wrapper.check_payment(
+                transaction['partner_id'], transaction_id)
+        if update_payment(transaction, order_info,
+                          self.LAST_CHECKED_INTERVAL):
+            self._reorder(transaction_id, transaction)
+            index_payment(transaction_id, transaction)
         return transaction['last_status']
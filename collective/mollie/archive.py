@@ -0,0 +1,71 @@
+"""
+Archive old final payments of the whole site.
+
+Final payments (like 'Success') which have not been updated for a
+while are moved from the tree new payments are written to, to a
+separate archive tree on the same object. ``get_transaction`` still
+finds them. The payments to archive are found with the secondary
+indexes of the transaction index, and the job commits after each
+batch, so it can run regularly next to a live site (for instance with
+``bin/instance run``). Archived payments stay in the index, so the
+cutoff of the last run is kept on the index and the next run only looks
+at the payments updated after it.
+"""
+import logging
+import time
+
+import transaction
+
+from collective.mollie.adapter import UnknownTransactionError
+from collective.mollie.adapter import is_archivable
+from collective.mollie.interfaces import IMollieIdealMultiplePayments
+from collective.mollie.storage import FINAL_STATUSES
+
+logger = logging.getLogger('collective.mollie')
+
+
+def archive_payments(index, root, max_age, batch_size=100, commit=True,
+                     now=None):
+    """Archive the final payments not updated for ``max_age`` seconds.
+
+    Only payments stored with the ``IMollieIdealMultiplePayments``
+    adapter are archived. Payments updated before the cutoff of the
+    previous run (``archived_until`` of the index) have been looked at
+    already and are skipped. After every ``batch_size`` archived
+    payments the transaction is committed (when ``commit`` is True).
+    Return the number of archived payments.
+    """
+    if now is None:
+        now = time.time()
+    cutoff = now - max_age
+    updated_min = index.archived_until
+    archived = 0
+    for status in FINAL_STATUSES:
+        for transaction_id in index.query(status=status,
+                                          updated_min=updated_min,
+                                          updated_max=cutoff):
+            entry = index.get(transaction_id)
+            if entry is None or not entry[2]:
+                continue
+            obj = index.resolve(transaction_id, root)
+            if obj is None:
+                continue
+            adapted = IMollieIdealMultiplePayments(obj)
+            try:
+                payment = adapted.get_transaction(transaction_id)
+            except UnknownTransactionError:
+                continue
+            if (not is_archivable(payment, cutoff) or
+                not adapted.archive_transaction(transaction_id)):
+                continue
+            archived += 1
+            if archived % batch_size == 0:
+                logger.info('Archived %d payments.', archived)
+                if commit:
+                    transaction.commit()
+    if updated_min is None or cutoff > updated_min:
+        index.archived_until = cutoff
+    if commit:
+        transaction.commit()
+    logger.info('Archived %d payments in total.', archived)
+    return archived
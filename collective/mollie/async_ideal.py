@@ -0,0 +1,346 @@
+"""
+A non-blocking client for the Mollie iDeal API.
+
+The ``MollieIdeal`` utility blocks the calling thread until Mollie has
+answered. Outside Zope, for instance in a process which handles orders,
+you may want to have a lot of calls to Mollie in flight without using
+a thread for each of them.
+
+``AsyncMollieIdeal`` offers the same methods as ``MollieIdeal``, but
+instead of waiting for Mollie they immediately return a
+``MollieResult``. The network traffic for all calls is handled by an
+``asyncore`` loop in a single thread when ``run`` is called.
+"""
+import asyncore
+import errno
+import os
+import select
+import socket
+import ssl
+import sys
+import time
+import urllib
+
+from zope.interface import implements
+
+from collective.mollie.ideal import normalize_order
+from collective.mollie.ideal import parse_banklist
+from collective.mollie.ideal import parse_order
+from collective.mollie.ideal import payment_from_order
+from collective.mollie.ideal import payment_request_data
+from collective.mollie.interfaces import IAsyncMollieIdeal
+
+# SSL errors which mean the operation has to be retried when the socket
+# is ready again.
+SSL_RETRY_ERRORS = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
+
+class MollieResult(object):
+    """The result of a call to Mollie which may not have arrived yet."""
+
+    def __init__(self, process):
+        # Function which turns the answer from Mollie into the result.
+        self._process = process
+        self._done = False
+        self._value = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if the call has finished."""
+        return self._done
+
+    def result(self):
+        """Return the result of the call.
+
+        If the call failed, the error (for instance a
+        ``MollieAPIError``) is raised.
+        """
+        if not self._done:
+            raise ValueError('The call to Mollie has not finished yet.')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def exception(self):
+        """Return the error of the call, or None if it succeeded."""
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_callback(self, callback):
+        """Call ``callback`` with this result when the call has finished."""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_answer(self, text):
+        try:
+            self._value = self._process(text)
+        except:
+            self._exc_info = sys.exc_info()
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class MollieChannel(asyncore.dispatcher):
+    """A single HTTP(S) request to Mollie.
+
+    The request is sent as HTTP/1.0, so Mollie closes the connection
+    after the answer has been sent.
+    """
+
+    def __init__(self, client, body, result, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.client = client
+        self.result = result
+        self.ssl_context = client.get_ssl_context()
+        self.handshaking = False
+        self.out_buffer = '\r\n'.join([
+            'POST %s HTTP/1.0' % client.BASE_PATH,
+            'Host: %s' % client.API_HOST,
+            'Content-Type: application/x-www-form-urlencoded',
+            'Content-Length: %d' % len(body),
+            'Connection: close',
+            '', body])
+        self.in_buffer = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((client.API_HOST, client.get_port()))
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return not self.connected or self.handshaking or \
+            bool(self.out_buffer)
+
+    def handle_connect(self):
+        if self.ssl_context is None:
+            return
+        self.socket = self.ssl_context.wrap_socket(
+            self.socket, server_hostname=self.client.API_HOST,
+            do_handshake_on_connect=False)
+        self.handshaking = True
+        self._do_handshake()
+
+    def _do_handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] not in SSL_RETRY_ERRORS:
+                raise
+        else:
+            self.handshaking = False
+
+    def handle_write(self):
+        if self.handshaking:
+            self._do_handshake()
+            return
+        try:
+            sent = self.socket.send(self.out_buffer)
+        except ssl.SSLError, e:
+            if e.args[0] not in SSL_RETRY_ERRORS:
+                raise
+            return
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        self.out_buffer = self.out_buffer[sent:]
+
+    def handle_read(self):
+        if self.handshaking:
+            self._do_handshake()
+            return
+        while True:
+            try:
+                data = self.socket.recv(8192)
+            except ssl.SSLError, e:
+                if e.args[0] in SSL_RETRY_ERRORS:
+                    return
+                if not self.in_buffer:
+                    raise
+                # Lots of servers close the connection without an SSL
+                # shutdown. Treat that like a normal end of the answer.
+                data = ''
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            if not data:
+                self.handle_close()
+                return
+            self.in_buffer.append(data)
+            if self._answer_complete():
+                self.handle_close()
+                return
+            # An SSL socket may have buffered more data than select
+            # will tell us about.
+            if not getattr(self.socket, 'pending', lambda: 0)():
+                return
+
+    def _answer_complete(self):
+        """Return True if the complete answer has been received.
+
+        This can only be known if Mollie sent a Content-Length header,
+        otherwise we wait until the connection is closed.
+        """
+        response = ''.join(self.in_buffer)
+        head, separator, body = response.partition('\r\n\r\n')
+        if not separator:
+            return False
+        for line in head.split('\r\n')[1:]:
+            name, colon, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                try:
+                    return len(body) >= int(value)
+                except ValueError:
+                    return False
+        return False
+
+    def handle_close(self):
+        if not self.connected:
+            # We never got connected, for instance because the
+            # connection was refused.
+            self.abort(self._socket_error())
+            return
+        self.close()
+        if self.result.done():
+            return
+        response = ''.join(self.in_buffer)
+        head, separator, body = response.partition('\r\n\r\n')
+        if not separator:
+            self.result.set_exc_info(self._error(
+                socket.error(errno.ECONNRESET,
+                             'Connection closed by Mollie')))
+            return
+        self.result.set_answer(body)
+
+    def handle_error(self):
+        self.close()
+        if not self.result.done():
+            self.result.set_exc_info(sys.exc_info())
+
+    def handle_expt(self):
+        self.abort(self._socket_error())
+
+    def _socket_error(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        return socket.error(err, os.strerror(err))
+
+    def _error(self, error):
+        try:
+            raise error
+        except:
+            return sys.exc_info()
+
+    def abort(self, error):
+        """Stop the request and fail its result with ``error``."""
+        self.close()
+        if not self.result.done():
+            self.result.set_exc_info(self._error(error))
+
+
+class AsyncMollieIdeal(object):
+    """A non-blocking client for the Mollie iDeal API.
+
+    All methods return a ``MollieResult`` immediately. Call ``run`` to
+    perform the actual network traffic for all pending calls.
+    """
+    implements(IAsyncMollieIdeal)
+
+    API_HOST = 'secure.mollie.nl'
+    API_PORT = None
+    BASE_PATH = '/xml/ideal'
+    TESTMODE = False
+    # Set to False to talk plain HTTP (for instance to a test server).
+    USE_SSL = True
+    # Optional ssl.SSLContext used for the connections to Mollie.
+    SSL_CONTEXT = None
+
+    def __init__(self):
+        # Each client has its own socket map, so it does not interfere
+        # with other asyncore loops (like the one of ZServer).
+        self._map = {}
+
+    def get_port(self):
+        if self.API_PORT:
+            return self.API_PORT
+        if self.USE_SSL:
+            return 443
+        return 80
+
+    def get_ssl_context(self):
+        if not self.USE_SSL:
+            return None
+        if self.SSL_CONTEXT is None:
+            self.SSL_CONTEXT = ssl.create_default_context()
+        return self.SSL_CONTEXT
+
+    def _call_mollie(self, data, process):
+        """Start a call to Mollie and return a ``MollieResult``.
+
+        The answer will be passed to ``process`` to get the result.
+        """
+        if self.TESTMODE:
+            data['testmode'] = 'true'
+        result = MollieResult(process)
+        MollieChannel(self, urllib.urlencode(data), result, self._map)
+        return result
+
+    def pending(self):
+        """Return the number of calls in flight."""
+        return len(self._map)
+
+    def run(self, timeout=None):
+        """Handle network traffic until all pending calls have finished.
+
+        If ``timeout`` (in seconds) is given, the calls which have not
+        finished by then fail with a ``socket.timeout`` error.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        use_poll = hasattr(select, 'poll')
+        while self._map:
+            wait = 1.0
+            if timeout is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    for channel in self._map.values():
+                        channel.abort(socket.timeout('timed out'))
+                    break
+                wait = min(wait, 1.0)
+            asyncore.loop(wait, use_poll, self._map, count=1)
+
+    def get_banks(self):
+        """Return a ``MollieResult`` for the list of banks."""
+        return self._call_mollie({'a': 'banklist'}, parse_banklist)
+
+    def request_payment(self, partner_id, bank_id, amount, message, report_url,
+                        return_url, profile_key=None):
+        """Return a ``MollieResult`` for the transaction ID and URL."""
+        data = payment_request_data(partner_id, bank_id, amount, message,
+                                    report_url, return_url, profile_key)
+        def process(text):
+            order = payment_from_order(parse_order(text), amount)
+            return order.transaction_id, order.URL
+        return self._call_mollie(data, process)
+
+    def check_payment(self, partner_id, transaction_id):
+        """Return a ``MollieResult`` for the status of the payment."""
+        data = {
+            'a': 'check',
+            'partnerid': partner_id,
+            'transaction_id': transaction_id,
+        }
+        return self._call_mollie(
+            data, lambda text: normalize_order(parse_order(text)))
@@ -0,0 +1,239 @@
+"""
+Checking a lot of payments concurrently.
+
+Checking thousands of payments one by one, for instance to reconcile
+them, takes the latency of a call to Mollie times the number of
+payments. The ``BatchChecker`` checks them with a bounded number of
+threads and yields the results as soon as they arrive.
+"""
+import logging
+import Queue
+import socket
+import threading
+import time
+
+logger = logging.getLogger('collective.mollie')
+
+
+class BatchCheckResult(object):
+    """The result of checking a single payment.
+
+    Either ``order`` contains the normalized order, as returned by
+    ``check_payment``, or ``error`` contains the error (usually a
+    ``MollieAPIError``) which occurred.
+    """
+
+    def __init__(self, partner_id, transaction_id, order=None, error=None):
+        self.partner_id = partner_id
+        self.transaction_id = transaction_id
+        self.order = order
+        self.error = error
+
+    def __repr__(self):
+        return '<BatchCheckResult %s: %r>' % (
+            self.transaction_id, self.error or self.order)
+
+
+class RateLimiter(object):
+    """Limit the number of calls per second, over all threads.
+
+    A token bucket: ``wait`` takes a token, and waits until one is
+    available when the bucket is empty. The bucket holds at most
+    ``burst`` tokens and gets ``rate`` tokens per second.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _take(self):
+        """Take a token and return 0, or return the time to wait."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+        finally:
+            self._lock.release()
+
+    def wait(self):
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+
+class BatchChecker(object):
+    """Check payments with at most ``max_workers`` threads.
+
+    The ``check`` function is called with a partner ID and transaction
+    ID and should return the order (see ``MollieIdeal.check_payment``).
+
+    When a check takes longer than ``timeout`` seconds, it is reported
+    as a ``socket.timeout`` error and its thread is abandoned: a new
+    thread takes over its place, so the remaining payments can still be
+    checked. Since Mollie only returns the status of a payment once, an
+    answer which still arrives is not thrown away: the ``late`` function
+    (if given) is called with its ``BatchCheckResult``, in the abandoned
+    thread.
+
+    With a ``RateLimiter`` as ``limiter``, the checks are not started
+    faster than its rate.
+    """
+
+    def __init__(self, check, max_workers=4, timeout=None, limiter=None,
+                 late=None):
+        self.check = check
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.limiter = limiter
+        self.late = late
+        self._lock = threading.Lock()
+        self._results = Queue.Queue()
+        # Checks in progress: a mapping from a job number to a tuple
+        # with the pair and the time the check started.
+        self._running = {}
+        self._abandoned = set()
+        self._jobs = 0
+        self._exhausted = False
+        self._stopped = False
+
+    def run(self, pairs):
+        """Check the ``(partner_id, transaction_id)`` tuples in ``pairs``.
+
+        A ``BatchCheckResult`` is yielded for each payment in order of
+        completion.
+        """
+        self._pairs = iter(pairs)
+        for i in range(self.max_workers):
+            self._start_worker()
+        try:
+            while True:
+                expired, wait = self._expire()
+                if expired is None:
+                    return
+                for partner_id, transaction_id in expired:
+                    self._start_worker()
+                    yield BatchCheckResult(
+                        partner_id, transaction_id,
+                        error=socket.timeout('timed out'))
+                try:
+                    result = self._results.get(True, wait)
+                except Queue.Empty:
+                    continue
+                if result is not None:
+                    yield result
+        finally:
+            # Stop the workers when the caller stops iterating.
+            self._stopped = True
+
+    def _expire(self):
+        """Abandon the checks which take too long.
+
+        Return a list of the abandoned pairs and the time until the
+        next check expires. If all payments have been checked and all
+        results have been handed out, the list is None instead.
+        """
+        expired = []
+        wait = None
+        self._lock.acquire()
+        try:
+            if self._exhausted and not self._running and \
+               self._results.empty():
+                return None, None
+            if self.timeout is None:
+                return expired, wait
+            now = time.time()
+            # A check which has not started yet expires after the
+            # timeout at the earliest.
+            wait = self.timeout
+            for job, (pair, started) in self._running.items():
+                remaining = started + self.timeout - now
+                if remaining <= 0:
+                    del self._running[job]
+                    self._abandoned.add(job)
+                    expired.append(pair)
+                else:
+                    wait = min(wait, remaining)
+        finally:
+            self._lock.release()
+        return expired, wait
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _next_job(self):
+        """Return a tuple with a job number and pair, or None."""
+        self._lock.acquire()
+        try:
+            if self._stopped or self._exhausted:
+                return None
+            try:
+                pair = self._pairs.next()
+            except StopIteration:
+                self._exhausted = True
+                # Wake up the caller to tell it we are done.
+                self._results.put(None)
+                return None
+            job = self._jobs
+            self._jobs += 1
+            self._running[job] = (pair, time.time())
+            return job, pair
+        finally:
+            self._lock.release()
+
+    def _worker(self):
+        while True:
+            if self.limiter is not None:
+                # Before taking a job, so waiting does not count for
+                # the timeout.
+                self.limiter.wait()
+            next_job = self._next_job()
+            if next_job is None:
+                return
+            job, (partner_id, transaction_id) = next_job
+            try:
+                result = BatchCheckResult(
+                    partner_id, transaction_id,
+                    order=self.check(partner_id, transaction_id))
+            except Exception, e:
+                result = BatchCheckResult(partner_id, transaction_id,
+                                          error=e)
+            self._lock.acquire()
+            try:
+                abandoned = job in self._abandoned
+                if abandoned:
+                    # Another thread has taken over.
+                    self._abandoned.remove(job)
+                else:
+                    del self._running[job]
+                    self._results.put(result)
+            finally:
+                self._lock.release()
+            if abandoned:
+                self._deliver_late(result)
+                return
+
+    def _deliver_late(self, result):
+        """Hand the result of an abandoned check to ``late``."""
+        if self.late is None:
+            logger.warning('Ignored the late result of checking '
+                           'transaction %s: %r', result.transaction_id,
+                           result)
+            return
+        try:
+            self.late(result)
+        except Exception:
+            logger.exception('Could not handle the late result of checking '
+                             'transaction %s.', result.transaction_id)
@@ -0,0 +1,104 @@
+"""
+A circuit breaker for the calls to Mollie.
+
+When Mollie is down or very slow, every call would wait for a timeout
+and hold a thread in the meantime. After a number of consecutive
+failures the ``CircuitBreaker`` opens: calls fail immediately instead
+of waiting for Mollie. After ``reset_timeout`` seconds a single trial
+call is let through (the breaker is half open). When it succeeds the
+breaker closes again, otherwise it opens for another period.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing service for a while."""
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        # True while the trial call of a half open breaker is running.
+        self._trial = False
+        self._counters = {
+            'opened': 0,
+            'rejected': 0,
+        }
+
+    def allow(self):
+        """Return True if a call may be made now."""
+        self._lock.acquire()
+        try:
+            if self._state == OPEN and \
+               time.time() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._trial = False
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self._counters['rejected'] += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def success(self):
+        """Record a successful call."""
+        self._lock.acquire()
+        try:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        """Record a failed call."""
+        self._lock.acquire()
+        try:
+            self._failures += 1
+            if self._state == HALF_OPEN or (
+                    self._state == CLOSED and self.threshold and
+                    self._failures >= self.threshold):
+                self._state = OPEN
+                self._opened_at = time.time()
+                self._trial = False
+                self._counters['opened'] += 1
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Close the breaker and forget the failures."""
+        self.success()
+
+    def state(self):
+        """Return the state: 'closed', 'open' or 'half_open'."""
+        self._lock.acquire()
+        try:
+            if self._state == OPEN and \
+               time.time() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a dict with the state and statistics of the breaker."""
+        state = self.state()
+        self._lock.acquire()
+        try:
+            stats = dict(self._counters)
+            stats['state'] = state
+            stats['failures'] = self._failures
+        finally:
+            self._lock.release()
+        return stats
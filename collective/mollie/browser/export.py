@@ -0,0 +1,138 @@
+import csv
+import json
+import time
+from cStringIO import StringIO
+
+from DateTime import DateTime
+from DateTime.interfaces import DateTimeError
+from zope.component import queryUtility
+from zope.publisher.browser import BrowserView
+
+from collective.mollie.adapter import get_indexed_payment
+from collective.mollie.interfaces import IMollieTransactionIndex
+
+# The columns of the export.
+EXPORT_FIELDS = ('transaction_id', 'partner_id', 'amount', 'currency',
+                 'status', 'paid', 'last_status', 'last_update',
+                 'consumer_name', 'consumer_account', 'consumer_city', 'path')
+
+
+def export_row(transaction_id, payment, path):
+    """Return the exported fields of a payment as a dict."""
+    last_update = payment.timestamp('last_update')
+    if last_update is not None:
+        last_update = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                    time.gmtime(last_update))
+    consumer = payment['consumer'] or {}
+    return {
+        'transaction_id': transaction_id,
+        'partner_id': payment['partner_id'],
+        'amount': payment['amount'],
+        'currency': payment['currency'],
+        'status': payment['status'],
+        'paid': payment['paid'],
+        'last_status': payment['last_status'],
+        'last_update': last_update,
+        'consumer_name': consumer.get('name'),
+        'consumer_account': consumer.get('account'),
+        'consumer_city': consumer.get('city'),
+        'path': path and '/'.join(path) or None,
+    }
+
+
+def csv_line(values):
+    """Return a line of CSV with the (UTF-8 encoded) values."""
+    out = StringIO()
+    row = []
+    for value in values:
+        if value is None:
+            value = ''
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(value)
+    csv.writer(out).writerow(row)
+    return out.getvalue()
+
+
+class ExportView(BrowserView):
+    """View which exports the payments of the site as CSV or JSON lines.
+
+    The payments are found with the ``IMollieTransactionIndex`` utility,
+    so this view should be registered for the site root. The export is
+    streamed to the client while the payments are read, and the ZODB
+    cache is cleared now and then, so memory use does not grow with
+    the number of payments.
+
+    The payments can be filtered by ``status``, ``partner_id`` and the
+    time of their last update, from ``start`` up to (but not including)
+    ``end``. The export is CSV, unless ``format`` is 'json'.
+    """
+
+    # Number of exported payments after which the ZODB cache is cleared.
+    CACHE_CLEAR_INTERVAL = 1000
+
+    def _time(self, name):
+        value = self.request.form.get(name)
+        if not value:
+            return None
+        return DateTime(value).timeTime()
+
+    def payments(self, index, status=None, partner_id=None, start=None,
+                 end=None):
+        """Yield the rows of the payments matching the filters."""
+        jar = getattr(self.context, '_p_jar', None)
+        count = 0
+        for transaction_id in index.query(status=status, updated_min=start,
+                                          updated_max=end):
+            payment = get_indexed_payment(index, transaction_id,
+                                          self.context)
+            if payment is None:
+                continue
+            if partner_id and payment['partner_id'] != partner_id:
+                continue
+            last_update = payment.timestamp('last_update')
+            if end is not None and (last_update is None or
+                                    last_update >= end):
+                continue
+            yield export_row(transaction_id, payment,
+                             index.get(transaction_id)[0])
+            count += 1
+            if jar is not None and count % self.CACHE_CLEAR_INTERVAL == 0:
+                # Nothing is changed, so all objects can be removed.
+                jar.cacheMinimize()
+
+    def __call__(self):
+        """Write the export to the response."""
+        form = self.request.form
+        response = self.request.response
+        try:
+            start = self._time('start')
+            end = self._time('end')
+        except DateTimeError:
+            message = 'Invalid start or end date'
+            response.setStatus(400, message)
+            return message
+        index = queryUtility(IMollieTransactionIndex)
+        if index is None:
+            message = 'No transaction index'
+            response.setStatus(404, message)
+            return message
+
+        rows = self.payments(index, form.get('status') or None,
+                             form.get('partner_id'), start, end)
+        if form.get('format') == 'json':
+            response.setHeader('Content-Type', 'application/x-json-stream')
+            extension = 'json'
+        else:
+            response.setHeader('Content-Type', 'text/csv; charset=utf-8')
+            extension = 'csv'
+        response.setHeader('Content-Disposition',
+                           'attachment; filename="payments.%s"' % extension)
+        if extension == 'csv':
+            response.write(csv_line(EXPORT_FIELDS))
+        for row in rows:
+            if extension == 'json':
+                response.write(json.dumps(row) + '\n')
+            else:
+                response.write(csv_line([row[key] for key in EXPORT_FIELDS]))
+        return ''
@@ -1,10 +1,48 @@
-from zope.event import notify
+from zope.component import queryUtility
 from zope.publisher.browser import BrowserView
 
 from collective.mollie.adapter import UnknownTransactionError
-from collective.mollie.events import MollieIdealPaymentEvent
+from collective.mollie.index import object_path
+from collective.mollie.index import object_uid
 from collective.mollie.interfaces import IMollieIdealMultiplePayments
 from collective.mollie.interfaces import IMollieIdealPayment
+from collective.mollie.interfaces import IMollieReportPreCheck
+from collective.mollie.interfaces import IMollieReportQueue
+from collective.mollie.interfaces import IMollieTransactionIndex
+from collective.mollie.reports import process_report
+
+
+def handle_report(obj, transaction_id, multiple, request):
+    """Process the report for a payment on ``obj``, or queue it.
+
+    The report is queued when an ``IMollieReportQueue`` utility is
+    registered, unless the object cannot be found again by a worker
+    (because it has neither a path nor a UID).
+    """
+    queue = queryUtility(IMollieReportQueue)
+    if queue is not None and (object_path(obj) is not None or
+                              object_uid(obj) is not None):
+        queue.put(transaction_id, obj, multiple)
+    else:
+        process_report(obj, transaction_id, multiple, request)
+
+
+def client_address(request):
+    """Return the address of the client, behind trusted proxies."""
+    get_address = getattr(request, 'getClientAddr', None)
+    if get_address is not None:
+        return get_address()
+    return request.get('REMOTE_ADDR')
+
+
+def rejected(request, transaction_id):
+    """Return True if the ``IMollieReportPreCheck`` utility (if available)
+    rejects the report, without loading any payment."""
+    precheck = queryUtility(IMollieReportPreCheck)
+    if precheck is None:
+        return False
+    return precheck.check(transaction_id,
+                          client_address(request)) is not None
 
 
 class ReportPaymentStatusView(BrowserView):
@@ -17,18 +55,21 @@ class ReportPaymentStatusView(BrowserView):
 
     def __call__(self):
         """Return the right status code for Mollie and process the payment."""
-        adapted = IMollieIdealPayment(self.context)
         received_transaction_id = self.request.form.get('transaction_id')
+        if rejected(self.request, received_transaction_id):
+            message = 'Wrong or missing transaction ID'
+            self.request.response.setStatus(403, message)
+            return message
 
+        adapted = IMollieIdealPayment(self.context)
         if (not received_transaction_id or
             received_transaction_id != adapted.transaction_id):
             message = 'Wrong or missing transaction ID'
             self.request.response.setStatus(403, message)
             return message
 
-        adapted.get_payment_status()
-        notify(MollieIdealPaymentEvent(self.context, self.request,
-                                       received_transaction_id))
+        handle_report(self.context, received_transaction_id, False,
+                      self.request)
         self.request.response.setStatus(200)
         return 'OK'
 
@@ -43,9 +84,13 @@ class ReportMultiplePaymentsStatusView(BrowserView):
 
     def __call__(self):
         """Return the right status code for Mollie and process the payment."""
-        adapted = IMollieIdealMultiplePayments(self.context)
         received_transaction_id = self.request.form.get('transaction_id')
+        if rejected(self.request, received_transaction_id):
+            message = 'Wrong or missing transaction ID'
+            self.request.response.setStatus(403, message)
+            return message
 
+        adapted = IMollieIdealMultiplePayments(self.context)
         try:
             transaction = adapted.get_transaction(received_transaction_id)
         except UnknownTransactionError:
@@ -55,8 +100,48 @@ class ReportMultiplePaymentsStatusView(BrowserView):
             self.request.response.setStatus(403, message)
             return message
 
-        adapted.get_payment_status(received_transaction_id)
-        notify(MollieIdealPaymentEvent(self.context, self.request,
-                                       received_transaction_id))
+        handle_report(self.context, received_transaction_id, True,
+                      self.request)
+        self.request.response.setStatus(200)
+        return 'OK'
+
+
+class ReportView(BrowserView):
+    """View that can be used by Mollie to report the status of any
+    payment on the site.
+
+    The object on which the payment is stored is looked up with the
+    ``IMollieTransactionIndex`` utility, so this view should be
+    registered for the site root. Depending on how the payment was
+    stored, the MollieIdealPayment or MollieIdealMultiplePayments
+    adapter is used.
+    """
+
+    def __call__(self):
+        """Return the right status code for Mollie and process the payment."""
+        received_transaction_id = self.request.form.get('transaction_id')
+        index = queryUtility(IMollieTransactionIndex)
+        obj = None
+        if (received_transaction_id and index is not None and
+            not rejected(self.request, received_transaction_id)):
+            obj = index.resolve(received_transaction_id, self.context)
+        if obj is not None:
+            path, uid, multiple = index.get(received_transaction_id)
+            if multiple:
+                adapted = IMollieIdealMultiplePayments(obj)
+                try:
+                    adapted.get_transaction(received_transaction_id)
+                except UnknownTransactionError:
+                    obj = None
+            else:
+                adapted = IMollieIdealPayment(obj)
+                if adapted.transaction_id != received_transaction_id:
+                    obj = None
+        if obj is None:
+            message = 'Wrong or missing transaction ID'
+            self.request.response.setStatus(403, message)
+            return message
+
+        handle_report(obj, received_transaction_id, multiple, self.request)
         self.request.response.setStatus(200)
         return 'OK'
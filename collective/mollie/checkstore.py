@@ -0,0 +1,98 @@
+"""
+A durable store of the first result of checking a payment.
+
+Mollie only returns the status of a payment the first time it is
+checked, after that the status is 'CheckedBefore'. When the request
+which checked the payment is retried after a ``ConflictError`` (or
+Mollie reports the payment twice), the first result is lost and a call
+to Mollie is wasted.
+
+The ``CheckResultStore`` keeps the first final result (like 'Success'
+or 'Expired') of each payment. It is committed in a transaction of its
+own right away, so it is kept even when the transaction of the request
+is aborted. Later checks of the payment, from any thread or ZEO
+client, are answered from the store. A result which may still change,
+like 'Open', is not stored, so the payment is checked with Mollie
+again.
+"""
+import logging
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from zope.interface import implements
+
+from collective.mollie.interfaces import IMollieCheckResultStore
+from collective.mollie.results import CheckResult
+from collective.mollie.results import Consumer
+from collective.mollie.storage import FINAL_STATUSES
+
+logger = logging.getLogger('collective.mollie')
+
+
+def result_data(result):
+    """Return a check result as a tuple of builtin types."""
+    consumer = result.consumer
+    if consumer is not None:
+        consumer = dict(consumer.items())
+    return (result.transaction_id, result.amount, result.currency,
+            result.paid, result.status, result.message, consumer)
+
+
+def result_from_data(data):
+    """Return the check result of a tuple made by ``result_data``."""
+    consumer = data[6]
+    if consumer is not None:
+        consumer = Consumer(**consumer)
+    return CheckResult(*data[:6], **{'consumer': consumer})
+
+
+class CheckResultStore(Persistent):
+    """Persistent utility with the first check result of payments."""
+    implements(IMollieCheckResultStore)
+
+    # Number of times storing a result is tried when it conflicts.
+    RETRIES = 3
+
+    def __init__(self):
+        self._results = OOBTree()
+
+    def get(self, transaction_id):
+        if not transaction_id:
+            return None
+        data = self._results.get(transaction_id)
+        if data is None:
+            return None
+        return result_from_data(data)
+
+    def record(self, transaction_id, result):
+        if result.status not in FINAL_STATUSES:
+            return False
+        data = result_data(result)
+        if self._p_jar is None:
+            # Not stored in a database.
+            if transaction_id not in self._results:
+                self._results[transaction_id] = data
+            return True
+        for attempt in range(self.RETRIES):
+            transaction_manager = transaction.TransactionManager()
+            connection = self._p_jar.db().open(
+                transaction_manager=transaction_manager)
+            try:
+                results = connection.get(self._p_oid)._results
+                if transaction_id not in results:
+                    results[transaction_id] = data
+                transaction_manager.commit()
+                return True
+            except ConflictError:
+                pass
+            finally:
+                transaction_manager.abort()
+                connection.close()
+        logger.error('Could not store the check result of transaction %s.',
+                     transaction_id)
+        return False
+
+    def __contains__(self, transaction_id):
+        return bool(transaction_id) and transaction_id in self._results
@@ -1,3 +1,9 @@
 
 IDEAL_PAYMENT_ANNOTATION_KEY = 'collective.mollie.adapter.idealpayment'
 IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY = 'collective.mollie.adapter.idealmultiplepayments'
+IDEAL_MULTIPLE_PAYMENTS_ORDER_ANNOTATION_KEY = 'collective.mollie.adapter.idealmultiplepayments.order'
+IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY = 'collective.mollie.adapter.idealmultiplepayments.archive'
+
+# Notify the payment status events (like ``PaymentPaid``) only when the
+# transaction of the report has been committed, instead of right away.
+STATUS_EVENTS_AFTER_COMMIT = False
@@ -1,7 +1,20 @@
+import logging
+
+import transaction
+from zope.event import notify
 from zope.interface import implements
 from zope.component.interfaces import ObjectEvent
 
+from collective.mollie import config
 from collective.mollie.interfaces import IMollieIdealPaymentEvent
+from collective.mollie.interfaces import IMolliePaymentCancelledEvent
+from collective.mollie.interfaces import IMolliePaymentExpiredEvent
+from collective.mollie.interfaces import IMolliePaymentPaidEvent
+from collective.mollie.interfaces import IMolliePaymentStatusChangedEvent
+from collective.mollie.interfaces import IMolliePaymentStatusEvent
+from collective.mollie.interfaces import IMolliePaymentStatusUnchangedEvent
+
+logger = logging.getLogger('collective.mollie')
 
 
 class MollieIdealPaymentEvent(ObjectEvent):
@@ -12,3 +25,84 @@ class MollieIdealPaymentEvent(ObjectEvent):
         self.context = context
         self.request = request
         self.transaction_id = transaction_id
+
+
+class PaymentStatusEvent(ObjectEvent):
+    implements(IMolliePaymentStatusEvent)
+
+    def __init__(self, context, request, transaction_id, old_status,
+                 new_status):
+        super(PaymentStatusEvent, self).__init__(context)
+        self.context = context
+        self.request = request
+        self.transaction_id = transaction_id
+        self.old_status = old_status
+        self.new_status = new_status
+
+
+class PaymentStatusUnchanged(PaymentStatusEvent):
+    implements(IMolliePaymentStatusUnchangedEvent)
+
+
+class PaymentStatusChanged(PaymentStatusEvent):
+    implements(IMolliePaymentStatusChangedEvent)
+
+
+class PaymentPaid(PaymentStatusChanged):
+    implements(IMolliePaymentPaidEvent)
+
+
+class PaymentCancelled(PaymentStatusChanged):
+    implements(IMolliePaymentCancelledEvent)
+
+
+class PaymentExpired(PaymentStatusChanged):
+    implements(IMolliePaymentExpiredEvent)
+
+
+# The events for a change to a status, other changes get a
+# ``PaymentStatusChanged`` event.
+STATUS_EVENTS = {
+    'Success': PaymentPaid,
+    'Cancelled': PaymentCancelled,
+    'Expired': PaymentExpired,
+}
+
+
+def status_event(context, request, transaction_id, old_status, new_status):
+    """Return the event for the change from ``old_status`` to
+    ``new_status``."""
+    if old_status == new_status:
+        factory = PaymentStatusUnchanged
+    else:
+        factory = STATUS_EVENTS.get(new_status, PaymentStatusChanged)
+    return factory(context, request, transaction_id, old_status, new_status)
+
+
+def _notify_committed(status, event):
+    if status:
+        notify(event)
+    else:
+        logger.info('Not notifying the status of transaction %s: the '
+                    'transaction was not committed.', event.transaction_id)
+
+
+def notify_status(event, after_commit=None, transaction_manager=None):
+    """Notify a payment status event.
+
+    When ``after_commit`` is True (by default the value of
+    ``STATUS_EVENTS_AFTER_COMMIT`` in ``collective.mollie.config``), the
+    event is only notified after the current transaction of
+    ``transaction_manager`` has been committed, and never when it is
+    aborted. Changes subscribers make to the database are then not part
+    of the committed transaction.
+    """
+    if after_commit is None:
+        after_commit = config.STATUS_EVENTS_AFTER_COMMIT
+    if not after_commit:
+        notify(event)
+        return
+    if transaction_manager is None:
+        transaction_manager = transaction.manager
+    transaction_manager.get().addAfterCommitHook(_notify_committed,
+                                                 args=(event,))
@@ -1,25 +1,293 @@
 import httplib
+import logging
+import random
+import socket
+import threading
+import time
 import urllib
 
+from zope.component import queryUtility
 from zope.interface import implements
 
+from collective.mollie.batch import BatchCheckResult
+from collective.mollie.batch import BatchChecker
+from collective.mollie.breaker import CircuitBreaker
+from collective.mollie.interfaces import IMollieCheckResultStore
 from collective.mollie.interfaces import IMollieIdeal
+from collective.mollie.pool import HTTPSConnectionPool
+from collective.mollie.results import Bank
+from collective.mollie.results import CheckResult
+from collective.mollie.results import Consumer
+from collective.mollie.results import PaymentOrder
+from collective.mollie.singleflight import SingleFlight
 from collective.mollie.xml_parser import XmlDictConfig
-from collective.mollie.xml_parser import xml_string_to_dict
+from collective.mollie.xml_parser import iterparse
+from collective.mollie.xml_parser import xml_to_dict
+
+logger = logging.getLogger('collective.mollie')
+
+# Errors after which a call for one of the RETRY_ACTIONS is retried.
+RETRY_ERRORS = (socket.error, httplib.HTTPException)
 
 
 class MollieAPIError(EnvironmentError):
     """Error from the Mollie API"""
 
 
+class MollieUnavailableError(MollieAPIError):
+    """Mollie is not called, because the calls to it keep failing."""
+
+
+def parse_answer(source):
+    """Parse the XML answer from Mollie and return a dict.
+
+    This is the generic parser, which converts the complete answer. If
+    Mollie reported an error, a ``MollieAPIError`` is raised.
+
+    The answer can be a string or a file-like object, like the HTTP
+    response from Mollie.
+    """
+    return _check_answer(xml_to_dict(source))
+
+
+def _check_answer(result_dict):
+    """Raise a ``MollieAPIError`` if the answer is an error."""
+    if 'item' in result_dict and \
+       result_dict['item'].get('type') == 'error':
+        raise MollieAPIError(result_dict['item']['errorcode'],
+                             result_dict['item']['message'])
+    return result_dict
+
+
+def _check_error_item(element):
+    """Raise a ``MollieAPIError`` if ``element`` is an error item."""
+    if element.get('type') == 'error':
+        raise MollieAPIError(element.findtext('errorcode'),
+                             element.findtext('message'))
+
+
+def parse_banklist(source):
+    """Return a list of ``Bank`` tuples (id and name) from a banklist answer.
+
+    Only the banks are picked from the answer, while it is being
+    parsed. If Mollie reported an error, a ``MollieAPIError`` is
+    raised.
+    """
+    banks = []
+    for event, element in iterparse(source):
+        if element.tag == 'bank':
+            banks.append(Bank(element.findtext('bank_id'),
+                              element.findtext('bank_name')))
+            element.clear()
+        elif element.tag == 'item':
+            _check_error_item(element)
+    return banks
+
+
+def parse_order(source):
+    """Return a dict with the order from a fetch or check answer.
+
+    The dict has the same content as the 'order' of the generic
+    ``parse_answer``: the text of each child of the order and, if
+    available, a dict with the consumer information. If Mollie
+    reported an error, a ``MollieAPIError`` is raised.
+    """
+    element = None
+    for event, element in iterparse(source):
+        if element.tag == 'order':
+            order = {}
+            for child in element:
+                if len(child):
+                    order[child.tag] = dict(
+                        [(grandchild.tag, grandchild.text)
+                         for grandchild in child])
+                else:
+                    order[child.tag] = child.text
+            return order
+        elif element.tag == 'item':
+            _check_error_item(element)
+    # Not the answer we expected, fall back to the generic parser. The
+    # last element is the root of the answer, which has been parsed
+    # completely by now.
+    return _check_answer(XmlDictConfig(element)).get('order')
+
+
+def payment_request_data(partner_id, bank_id, amount, message, report_url,
+                         return_url, profile_key=None):
+    """Return the parameters to send to Mollie to request a payment."""
+    data = {
+        'a': 'fetch',
+        'partnerid': partner_id,
+        'amount': amount,
+        'bank_id': bank_id,
+        'description': message,
+        'reporturl': report_url,
+        'returnurl': return_url,
+    }
+    if profile_key:
+        data['profile_key'] = profile_key
+    return data
+
+
+def payment_from_order(order, amount):
+    """Return a ``PaymentOrder`` from the order of a fetch answer.
+
+    A ``ValueError`` is raised when the amount or currency of the
+    order do not match the requested payment.
+    """
+    if order.get('amount') != str(amount):
+        raise ValueError('The amount for the payment is incorrect.')
+    if order.get('currency') != 'EUR':
+        raise ValueError('The currency for the payment is incorrect.')
+    return PaymentOrder(transaction_id=order.get('transaction_id'),
+                        amount=order.get('amount'),
+                        currency=order.get('currency'),
+                        URL=order.get('URL'),
+                        message=order.get('message'))
+
+
+def normalize_order(order):
+    """Return a ``CheckResult`` with the order from a check answer."""
+    consumer = order.get('consumer')
+    if consumer:
+        # 'Normalize' keys
+        consumer = Consumer(name=consumer.get('consumerName'),
+                            account=consumer.get('consumerAccount'),
+                            city=consumer.get('consumerCity'))
+    else:
+        consumer = None
+    return CheckResult(transaction_id=order.get('transaction_id'),
+                       amount=order.get('amount'),
+                       currency=order.get('currency'),
+                       paid=order.get('payed') == 'true',
+                       status=order.get('status'),
+                       message=order.get('message'),
+                       consumer=consumer)
+
+
 class MollieIdeal(object):
     """A utility that wraps the Mollie iDeal API."""
     implements(IMollieIdeal)
 
     API_HOST = 'secure.mollie.nl'
+    API_PORT = None
     BASE_PATH = '/xml/ideal'
     TESTMODE = False
 
+    # Maximum number of idle keep-alive connections to Mollie and the
+    # number of seconds an idle connection may be reused.
+    POOL_SIZE = 4
+    POOL_IDLE_TIMEOUT = 60
+    # Optional ssl.SSLContext used for the connections to Mollie.
+    SSL_CONTEXT = None
+    # Maximum size in bytes of an answer from Mollie. A larger answer
+    # raises a ResponseTooLargeError. Set to None for no limit.
+    MAX_RESPONSE_SIZE = 1024 * 1024
+
+    # Number of seconds to wait for a connection to Mollie, for each
+    # read from a connection and for a complete call (including
+    # retries). None means wait forever.
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 15
+    CALL_DEADLINE = 30
+
+    # Actions which are retried when the call to Mollie fails, the
+    # number of retries and the base delay in seconds between them.
+    # The delays are random and grow with each retry.
+    RETRY_ACTIONS = ('banklist',)
+    RETRIES = 2
+    RETRY_BACKOFF = 0.5
+
+    # Number of consecutive failed calls after which Mollie is not
+    # called anymore for BREAKER_RESET_TIMEOUT seconds. Set to 0 to
+    # always call Mollie.
+    BREAKER_THRESHOLD = 5
+    BREAKER_RESET_TIMEOUT = 30
+
+    # Number of seconds the list of banks is cached. When the cached
+    # list is older, it is still returned while it is refreshed in the
+    # background. Set to 0 to disable the cache.
+    BANKS_CACHE_TTL = 300
+
+    # Actions for which concurrent identical calls share a single
+    # request to Mollie. Requesting a payment ('fetch') is not
+    # idempotent, so those calls are never shared.
+    COALESCE_ACTIONS = ('banklist', 'check')
+
+    # Actions which are sent again when the connection turns out to be
+    # closed after the request was sent. Requesting a payment creates a
+    # new payment and checking one uses up its status, so only the list
+    # of banks is requested again.
+    RESEND_ACTIONS = ('banklist',)
+
+    _pool = None
+    _pool_key = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self):
+        # Cached list of banks per mode (test or live), stored as a
+        # tuple with the time it was fetched and the list.
+        self._banks_cache = {}
+        # Background threads refreshing the cached list of banks.
+        self._banks_refreshing = {}
+        self._banks_lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self._breaker = CircuitBreaker()
+        # The deadline of the call which is made by the current thread.
+        self._local = threading.local()
+
+    def _get_pool(self):
+        """Return the connection pool, creating it when needed.
+
+        The pool is (re)created when the host, port or pool settings
+        have been changed.
+        """
+        key = (self.API_HOST, self.API_PORT, self.POOL_SIZE,
+               self.POOL_IDLE_TIMEOUT, self.SSL_CONTEXT,
+               self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        if self._pool is not None and self._pool_key == key:
+            return self._pool
+        self._pool_lock.acquire()
+        try:
+            if self._pool is None or self._pool_key != key:
+                if self._pool is not None:
+                    self._pool.clear()
+                conn_kwargs = {}
+                if self.SSL_CONTEXT is not None:
+                    conn_kwargs['context'] = self.SSL_CONTEXT
+                pool = HTTPSConnectionPool(
+                    self.API_HOST, self.API_PORT, size=self.POOL_SIZE,
+                    idle_timeout=self.POOL_IDLE_TIMEOUT,
+                    connect_timeout=self.CONNECT_TIMEOUT,
+                    read_timeout=self.READ_TIMEOUT, **conn_kwargs)
+                self._pool = pool
+                self._pool_key = key
+            return self._pool
+        finally:
+            self._pool_lock.release()
+
+    def pool_stats(self):
+        """Return a dict with statistics of the connection pool."""
+        return self._get_pool().stats()
+
+    def coalesce_stats(self):
+        """Return a dict with statistics of the coalesced calls."""
+        return self._single_flight.stats()
+
+    def _get_breaker(self):
+        breaker = self._breaker
+        breaker.threshold = self.BREAKER_THRESHOLD
+        breaker.reset_timeout = self.BREAKER_RESET_TIMEOUT
+        return breaker
+
+    def breaker_stats(self):
+        """Return a dict with the state and statistics of the breaker.
+
+        The state is 'closed' (Mollie is called), 'open' (calls fail
+        immediately) or 'half_open' (the next call is a trial).
+        """
+        return self._get_breaker().stats()
+
     def _do_request(self, data={}):
         """Return XML after performing the actual call to the Mollie API.
 
@@ -30,45 +298,172 @@ class MollieIdeal(object):
         will also contain the 'testmode' parameter (which will be set
         to 'true') to signal this is a test.
 
-        The return value is a string.
+        The connection to Mollie is taken from a pool of keep-alive
+        connections, so subsequent calls do not need to set up a new
+        connection.
+
+        The return value is a file-like object with the answer, which
+        has not been read yet. This way the answer can be parsed while
+        it is received. It has to be closed to give the connection
+        back to the pool. (A string with the answer is accepted
+        everywhere as well.)
+
+        The request and reading the answer raise a ``socket.timeout``
+        when the deadline of the current call has passed.
+
+        Only the ``RESEND_ACTIONS`` are sent again when the answer
+        cannot be read from a reused connection.
         """
-        connection = httplib.HTTPSConnection(self.API_HOST)
         if self.TESTMODE:
             data['testmode'] = 'true'
         encoded_data = urllib.urlencode(data)
-        connection.request(
+        return self._get_pool().open(
             'POST', self.BASE_PATH, encoded_data,
-            {'Content-type': 'application/x-www-form-urlencoded'})
-        return connection.getresponse().read()
+            {'Content-type': 'application/x-www-form-urlencoded'},
+            max_size=self.MAX_RESPONSE_SIZE,
+            deadline=getattr(self._local, 'deadline', None),
+            idempotent=data.get('a') in self.RESEND_ACTIONS)
 
-    def _call_mollie(self, data,):
-        """Call the Mollie API and return a dict with the result.
+    def _call_mollie(self, data, parse=parse_answer):
+        """Call the Mollie API and return the parsed answer.
 
         The ``data`` dict should contain all the parameters we will
-        send to Mollie.
+        send to Mollie. The answer is parsed with the ``parse``
+        function, by default the generic ``parse_answer``.
+
+        Concurrent identical calls for one of the ``COALESCE_ACTIONS``
+        share a single request to Mollie and its result. The result
+        should therefore not be modified.
+        """
+        if data.get('a') in self.COALESCE_ACTIONS:
+            key = (bool(self.TESTMODE), tuple(sorted(data.items())), parse)
+            return self._single_flight.do(
+                key, self._call_mollie_once, data, parse)
+        return self._call_mollie_once(data, parse)
+
+    def _call_mollie_once(self, data, parse):
+        """Call Mollie, retrying failed calls for the ``RETRY_ACTIONS``.
 
+        The complete call must finish within ``CALL_DEADLINE`` seconds.
+        Only network errors are retried. While the circuit breaker is
+        open, a ``MollieUnavailableError`` is raised instead of calling
+        Mollie. Errors reported by Mollie itself do not count as
+        failures.
         """
-        result_str = self._do_request(data)
-        result_dict = xml_string_to_dict(result_str)
-        if 'item' in result_dict and \
-           result_dict['item'].get('type') == 'error':
-            raise MollieAPIError(result_dict['item']['errorcode'],
-                                 result_dict['item']['message'])
-        return result_dict
+        breaker = self._get_breaker()
+        deadline = None
+        if self.CALL_DEADLINE is not None:
+            deadline = time.time() + self.CALL_DEADLINE
+        attempts = 1
+        if data.get('a') in self.RETRY_ACTIONS:
+            attempts += self.RETRIES
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise MollieUnavailableError(
+                    'unavailable', 'Calls to Mollie are failing, '
+                    'not calling Mollie for now.')
+            attempt += 1
+            try:
+                result = self._call_mollie_before(data, parse, deadline)
+            except MollieAPIError:
+                breaker.success()
+                raise
+            except Exception, e:
+                breaker.failure()
+                if attempt >= attempts or not isinstance(e, RETRY_ERRORS):
+                    raise
+                # Full jitter: a random delay up to the exponential
+                # backoff, so retrying clients do not synchronize.
+                delay = random.uniform(
+                    0, self.RETRY_BACKOFF * 2 ** (attempt - 1))
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise
+                logger.warning('Call to Mollie failed (%s), retrying in '
+                               '%.2f seconds', e, delay)
+                time.sleep(delay)
+                continue
+            breaker.success()
+            return result
+
+    def _call_mollie_before(self, data, parse, deadline):
+        """Call Mollie once and parse the answer before ``deadline``."""
+        self._local.deadline = deadline
+        try:
+            answer = self._do_request(data)
+            try:
+                return parse(answer)
+            finally:
+                if hasattr(answer, 'close'):
+                    answer.close()
+        finally:
+            self._local.deadline = None
 
     def get_banks(self):
         """Return a list of bank id and name tuples.
 
         Example: [('0031, 'ABN AMRO'), ('0721', 'Postbank')]
+
+        The list is cached for ``BANKS_CACHE_TTL`` seconds. After that
+        the cached list is still returned, while a single background
+        thread retrieves a fresh list from Mollie.
         """
+        testmode = bool(self.TESTMODE)
+        if not self.BANKS_CACHE_TTL:
+            return self._fetch_banks(testmode)
+        cached = self._banks_cache.get(testmode)
+        if cached is None:
+            banks = self._fetch_banks(testmode)
+            self._banks_cache[testmode] = (time.time(), banks)
+            return list(banks)
+        fetched, banks = cached
+        if time.time() - fetched > self.BANKS_CACHE_TTL:
+            self._refresh_banks_in_background(testmode)
+        return list(banks)
+
+    def clear_banks_cache(self):
+        """Forget the cached lists of banks."""
+        self._banks_cache.clear()
+
+    def _refresh_banks_in_background(self, testmode):
+        """Start a thread to refresh the cached list of banks.
+
+        Only one thread per mode is started at a time.
+        """
+        self._banks_lock.acquire()
+        try:
+            if testmode in self._banks_refreshing:
+                return
+            thread = threading.Thread(target=self._refresh_banks,
+                                      args=(testmode,))
+            thread.setDaemon(True)
+            self._banks_refreshing[testmode] = thread
+        finally:
+            self._banks_lock.release()
+        thread.start()
+
+    def _refresh_banks(self, testmode):
+        try:
+            try:
+                banks = self._fetch_banks(testmode)
+            except Exception:
+                # Keep using the stale list, we will try again later.
+                logger.exception('Could not refresh the list of banks.')
+            else:
+                self._banks_cache[testmode] = (time.time(), banks)
+        finally:
+            self._banks_lock.acquire()
+            try:
+                del self._banks_refreshing[testmode]
+            finally:
+                self._banks_lock.release()
+
+    def _fetch_banks(self, testmode=False):
+        """Retrieve the list of banks from Mollie."""
         data = {'a': 'banklist'}
-        answer = self._call_mollie(data)
-        banks = answer.get('bank', None)
-        if not banks:
-            return []
-        elif isinstance(banks, XmlDictConfig):
-            banks = [banks]
-        return [(b['bank_id'], b['bank_name']) for b in banks]
+        if testmode:
+            data['testmode'] = 'true'
+        return list(self._call_mollie(data, parse_banklist))
 
     def request_payment(self, partner_id, bank_id, amount, message, report_url,
                         return_url, profile_key=None):
@@ -90,24 +485,11 @@ class MollieIdeal(object):
         Optionally, the ``profile_key`` can be used to select another
         profile than the default profile for the ``partnerid``.
         """
-        data = {
-            'a': 'fetch',
-            'partnerid': partner_id,
-            'amount': amount,
-            'bank_id': bank_id,
-            'description': message,
-            'reporturl': report_url,
-            'returnurl': return_url,
-        }
-        if profile_key:
-            data['profile_key'] = profile_key
-        answer = self._call_mollie(data)
-        order = answer.get('order')
-        if order.get('amount') != str(amount):
-            raise ValueError('The amount for the payment is incorrect.')
-        if order.get('currency') != 'EUR':
-            raise ValueError('The currency for the payment is incorrect.')
-        return order.get('transaction_id'), order.get('URL')
+        data = payment_request_data(partner_id, bank_id, amount, message,
+                                    report_url, return_url, profile_key)
+        order = payment_from_order(self._call_mollie(data, parse_order),
+                                   amount)
+        return order.transaction_id, order.URL
 
     def check_payment(self, partner_id, transaction_id):
         """Check the status of the payment and return a dict with infomation.
@@ -129,25 +511,80 @@ class MollieIdeal(object):
 
         In other words: wait until Mollie pinged the ``report_url``
         which was sent with the ``request_payment`` method.
+
+        When an ``IMollieCheckResultStore`` utility is available, the
+        first final result (like 'Success') is stored and returned for
+        later checks, without calling Mollie again.
         """
+        store = queryUtility(IMollieCheckResultStore)
+        if store is not None:
+            result = store.get(transaction_id)
+            if result is not None:
+                return result
+        result = self._check_payment(partner_id, transaction_id)
+        if store is not None:
+            store.record(transaction_id, result)
+        return result
+
+    def _check_payment(self, partner_id, transaction_id):
         data = {
             'a': 'check',
             'partnerid': partner_id,
             'transaction_id': transaction_id,
         }
-        answer = self._call_mollie(data)
-        order = answer['order']
-        if order.get('payed') == 'true':
-            order['paid'] = True
-        else:
-            order['paid'] = False
-        del order['payed']
-        if order.get('consumer'):
-            # 'Normalize' keys
-            mapping = [('consumerName', 'name'),
-                       ('consumerAccount', 'account'),
-                       ('consumerCity', 'city')]
-            for old, new in mapping:
-                order['consumer'][new] = order['consumer'][old]
-                del order['consumer'][old]
-        return order
+        return normalize_order(self._call_mollie(data, parse_order))
+
+    def check_payments(self, pairs, max_workers=4, timeout=None,
+                       limiter=None):
+        """Check multiple payments concurrently.
+
+        The ``pairs`` are an iterable of ``(partner_id, transaction_id)``
+        tuples. The payments are checked by at most ``max_workers``
+        threads. A ``BatchCheckResult`` is yielded for each payment as
+        soon as it has been checked, so in order of completion instead
+        of the order of ``pairs``.
+
+        If ``timeout`` (in seconds) is given, a payment which has not
+        been checked within that time is yielded with a
+        ``socket.timeout`` error. An answer arriving later is still
+        added to the ``IMollieCheckResultStore`` (if available), so a
+        later check gets it. With a ``RateLimiter`` (from
+        ``collective.mollie.batch``) as ``limiter``, Mollie is not
+        called faster than its rate.
+
+        The same warning as for ``check_payment`` applies: the status
+        of a payment can only be retrieved once. When an
+        ``IMollieCheckResultStore`` utility is available, the payments
+        with a stored result are answered from the store first (in the
+        calling thread, since the threads cannot use its database
+        connection), and the results of the other payments are added to
+        the store when they are yielded.
+        """
+        # Looked up here: the threads do not see the local utilities.
+        store = queryUtility(IMollieCheckResultStore)
+        late = None
+        if store is not None:
+            late = lambda result: self._record_result(result, store)
+        checker = BatchChecker(self._check_payment, max_workers, timeout,
+                               limiter, late)
+        if store is None:
+            return checker.run(pairs)
+        return self._check_with_store(checker, pairs, store)
+
+    def _record_result(self, result, store):
+        if result.order is not None:
+            store.record(result.transaction_id, result.order)
+
+    def _check_with_store(self, checker, pairs, store):
+        """Yield the stored results, then check the other payments."""
+        unchecked = []
+        for partner_id, transaction_id in pairs:
+            stored = store.get(transaction_id)
+            if stored is None:
+                unchecked.append((partner_id, transaction_id))
+            else:
+                yield BatchCheckResult(partner_id, transaction_id,
+                                       order=stored)
+        for result in checker.run(unchecked):
+            self._record_result(result, store)
+            yield result
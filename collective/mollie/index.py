@@ -0,0 +1,260 @@
+"""
+A site wide index from transaction ID to the object with the payment.
+
+The report views need the object on which a payment is stored in
+their URL. With the ``TransactionIndex`` utility, the payment can be
+found with only its transaction ID, so a single report URL can be
+used for the whole site. Looking up a transaction is a BTree lookup,
+so it stays cheap on sites with millions of objects.
+
+The index also keeps secondary indexes on the status, the paid flag
+and the last update time (in buckets) of the payments. They are
+updated in the same transaction as the payment, so queries like "all
+open payments older than 30 minutes" cost time proportional to the
+number of results instead of a scan of all payments.
+"""
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from persistent import Persistent
+from zope.interface import implements
+
+from collective.mollie.interfaces import IMollieTransactionIndex
+
+try:
+    from plone.uuid.interfaces import IUUID
+except ImportError:
+    # Before Plone 4.1 there are no UIDs for all objects, only paths.
+    IUUID = None
+
+try:
+    from plone.app.uuid.utils import uuidToObject
+except ImportError:
+    uuidToObject = None
+
+
+def object_path(obj):
+    """Return the physical path of ``obj`` as a tuple, or None."""
+    get_path = getattr(obj, 'getPhysicalPath', None)
+    if get_path is None:
+        return None
+    return tuple(get_path())
+
+
+def object_uid(obj):
+    """Return the UID of ``obj``, or None."""
+    if IUUID is None:
+        return None
+    return IUUID(obj, None)
+
+
+def resolve_entry(path, uid, root):
+    """Return the object with ``uid``, or at ``path`` from ``root``."""
+    if uid is not None and uuidToObject is not None:
+        # The UID still works when the object has been moved.
+        obj = uuidToObject(uid)
+        if obj is not None:
+            return obj
+    if path is None:
+        return None
+    return root.unrestrictedTraverse(path, None)
+
+
+def _add(index, key, transaction_id):
+    """Add ``transaction_id`` to the set of ``key`` in ``index``."""
+    tids = index.get(key)
+    if tids is None:
+        tids = index[key] = OOTreeSet()
+    tids.insert(transaction_id)
+
+
+def _remove(index, key, transaction_id):
+    """Remove ``transaction_id`` from the set of ``key`` in ``index``."""
+    tids = index.get(key)
+    if tids is not None and transaction_id in tids:
+        tids.remove(transaction_id)
+        if not tids:
+            del index[key]
+
+
+class TransactionIndex(Persistent):
+    """Persistent utility which maps transaction IDs to objects."""
+    implements(IMollieTransactionIndex)
+
+    # Number of seconds of last update times in a bucket of the index.
+    UPDATE_BUCKET_SIZE = 3600
+
+    # The secondary indexes. Indexes created by older versions do not
+    # have them, they are created with the first indexed payment.
+    _payments = None
+    _status = None
+    _paid = None
+    _updated = None
+
+    # Set by ``backfill_index`` once the payments stored before the
+    # index existed have been added.
+    complete = False
+
+    # The cutoff of the last run of ``archive_payments``.
+    archived_until = None
+
+    def __init__(self):
+        self._entries = OOBTree()
+        # A BTrees Length resolves concurrent changes, unlike an int.
+        self._length = Length()
+        self._create_payment_indexes()
+
+    def _create_payment_indexes(self):
+        # Transaction ID to (status, paid, last update time).
+        self._payments = OOBTree()
+        self._status = OOBTree()
+        self._paid = OOBTree()
+        # Bucket of last update times to transaction IDs.
+        self._updated = IOBTree()
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.UPDATE_BUCKET_SIZE)
+
+    def index_transaction(self, transaction_id, obj, multiple=False):
+        """Store where the payment with ``transaction_id`` is stored.
+
+        Return False if the object cannot be found again, because it
+        has neither a path nor a UID.
+        """
+        path = object_path(obj)
+        uid = object_uid(obj)
+        if path is None and uid is None:
+            return False
+        entry = (path, uid, bool(multiple))
+        old = self._entries.get(transaction_id)
+        if old == entry:
+            return True
+        self._entries[transaction_id] = entry
+        if old is None:
+            self._length.change(1)
+        return True
+
+    def unindex_transaction(self, transaction_id):
+        if transaction_id in self._entries:
+            del self._entries[transaction_id]
+            self._length.change(-1)
+        self._unindex_payment(transaction_id)
+
+    def index_payment(self, transaction_id, payment):
+        """Update the secondary indexes for a payment record.
+
+        Return False if the transaction is not in the index.
+        """
+        if transaction_id not in self:
+            return False
+        if self._payments is None:
+            self._create_payment_indexes()
+        entry = (payment['status'], payment['paid'],
+                 payment.timestamp('last_update'))
+        if self._payments.get(transaction_id) == entry:
+            return True
+        self._unindex_payment(transaction_id)
+        self._payments[transaction_id] = entry
+        status, paid, last_update = entry
+        if status is not None:
+            _add(self._status, status, transaction_id)
+        if paid is not None:
+            _add(self._paid, bool(paid), transaction_id)
+        if last_update is not None:
+            _add(self._updated, self._bucket(last_update), transaction_id)
+        return True
+
+    def _unindex_payment(self, transaction_id):
+        if self._payments is None:
+            return
+        entry = self._payments.get(transaction_id)
+        if entry is None:
+            return
+        del self._payments[transaction_id]
+        status, paid, last_update = entry
+        if status is not None:
+            _remove(self._status, status, transaction_id)
+        if paid is not None:
+            _remove(self._paid, bool(paid), transaction_id)
+        if last_update is not None:
+            _remove(self._updated, self._bucket(last_update), transaction_id)
+
+    def _updated_between(self, updated_min, updated_max):
+        """Yield the transaction IDs in the buckets of a time range."""
+        min_bucket = max_bucket = None
+        if updated_min is not None:
+            min_bucket = self._bucket(updated_min)
+        if updated_max is not None:
+            max_bucket = self._bucket(updated_max)
+        for tids in self._updated.values(min_bucket, max_bucket):
+            for transaction_id in tids:
+                yield transaction_id
+
+    def query(self, status=None, paid=None, updated_min=None,
+              updated_max=None):
+        """Yield the IDs of the transactions matching all criteria.
+
+        ``updated_min`` and ``updated_max`` are epoch times (inclusive)
+        of the last update of the payment. The IDs are taken from the
+        most selective index (a time range with a start, the status,
+        the paid flag or the time range without a start) and checked
+        against the other criteria while iterating.
+        """
+        if self._payments is None:
+            return
+        if updated_min is not None:
+            candidates = self._updated_between(updated_min, updated_max)
+        elif status is not None:
+            candidates = self._status.get(status, ())
+        elif paid is not None:
+            candidates = self._paid.get(bool(paid), ())
+        elif updated_max is not None:
+            candidates = self._updated_between(None, updated_max)
+        else:
+            candidates = self._payments.keys()
+        for transaction_id in candidates:
+            entry = self._payments.get(transaction_id)
+            if entry is None:
+                continue
+            entry_status, entry_paid, last_update = entry
+            if status is not None and entry_status != status:
+                continue
+            if paid is not None and (entry_paid is None or
+                                     bool(entry_paid) != bool(paid)):
+                continue
+            if updated_min is not None or updated_max is not None:
+                if last_update is None:
+                    continue
+                if updated_min is not None and last_update < updated_min:
+                    continue
+                if updated_max is not None and last_update > updated_max:
+                    continue
+            yield transaction_id
+
+    def get_payment_entry(self, transaction_id, default=None):
+        if not transaction_id or self._payments is None:
+            return default
+        return self._payments.get(transaction_id, default)
+
+    def get(self, transaction_id, default=None):
+        if not transaction_id:
+            return default
+        return self._entries.get(transaction_id, default)
+
+    def resolve(self, transaction_id, root):
+        entry = self.get(transaction_id)
+        if entry is None:
+            return None
+        path, uid, multiple = entry
+        return resolve_entry(path, uid, root)
+
+    def keys(self, min=None, max=None):
+        """Return the indexed transaction IDs, optionally in a range."""
+        return self._entries.keys(min, max)
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, transaction_id):
+        return bool(transaction_id) and transaction_id in self._entries
@@ -53,6 +53,53 @@ class IMollieIdeal(Interface):
         which was sent with the ``request_payment`` method.
         """
 
+    def check_payments(pairs, max_workers=4, timeout=None, limiter=None):
+        """Check multiple payments concurrently.
+
+        The ``pairs`` are an iterable of ``(partner_id, transaction_id)``
+        tuples. The payments are checked by at most ``max_workers``
+        threads and a result is yielded for each payment in order of
+        completion. Each result has either an ``order`` (the dict
+        ``check_payment`` returns) or an ``error``.
+
+        A payment which has not been checked within ``timeout`` seconds
+        is yielded with a ``socket.timeout`` error. Payments with a
+        result in the ``IMollieCheckResultStore`` (if available) get
+        the stored result, without calling Mollie, and an answer
+        arriving after the timeout is still added to the store. When a
+        ``limiter``
+        is given, its ``wait`` method is called before each check.
+        """
+
+
+class IAsyncMollieIdeal(Interface):
+    """A non-blocking client for the Mollie iDeal API.
+
+    The methods are the same as those of ``IMollieIdeal``, but they
+    return a ``MollieResult`` right away. The result is available
+    after ``run`` has been called.
+    """
+
+    def get_banks():
+        """Return a result for the list of bank id and name tuples."""
+
+    def request_payment(partner_id, bank_id, amount, message, report_url,
+                        return_url, profile_key=None):
+        """Return a result for the transaction ID and URL to visit."""
+
+    def check_payment(partner_id, transaction_id):
+        """Return a result for the dict with the status of the payment."""
+
+    def pending():
+        """Return the number of calls in flight."""
+
+    def run(timeout=None):
+        """Handle network traffic until all pending calls have finished.
+
+        If ``timeout`` (in seconds) is given, the calls which have not
+        finished by then fail with a ``socket.timeout`` error.
+        """
+
 
 class IMollieIdealPayment(Interface):
     """Model to store payment information."""
@@ -65,6 +112,7 @@ class IMollieIdealPayment(Interface):
     consumer = Attribute('Consumer information')
     status = Attribute('Status')
     last_status = Attribute('Last status')
+    last_checked = Attribute('Date/time the status was last checked.')
 
     def get_banks():
         """Return a list of bank id and name tuples.
@@ -79,8 +127,13 @@ class IMollieIdealPayment(Interface):
         Also internally store the data for later reference.
         """
 
-    def get_payment_status():
-        """Retrieve and return the payment status."""
+    def get_payment_status(order_info=None):
+        """Retrieve and return the payment status.
+
+        When the payment has already been checked (for instance with
+        ``check_payments``), pass the result as ``order_info`` to store
+        it without calling Mollie.
+        """
 
 
 class IMollieIdealMultiplePayments(Interface):
@@ -103,10 +156,198 @@ class IMollieIdealMultiplePayments(Interface):
         """
 
     def get_transaction(transaction_id):
-        """Return a dict with the data stored for a transaction."""
+        """Return the data stored for a transaction.
 
-    def get_payment_status(transaction_id):
-        """Retrieve and return the payment status."""
+        The data is a persistent record which can be used like a dict.
+        """
+
+    def iter_transactions(min=None, max=None, order='transaction_id',
+                          cursor=None):
+        """Return a lazy iterator over transaction ID and record tuples.
+
+        The ``order`` is either 'transaction_id' or 'last_update'. The
+        transactions are limited to the (inclusive) range of ``min``
+        and ``max``: transaction IDs or epoch times respectively. With
+        a ``cursor`` returned by ``get_transactions_page``, iteration
+        continues after the last transaction of that page.
+        """
+
+    def get_transactions_page(size=50, cursor=None, min=None, max=None,
+                              order='transaction_id'):
+        """Return a page of transactions and the cursor of the next page.
+
+        The page is a list of at most ``size`` transaction ID and record
+        tuples. The cursor is None for the last page. The other
+        arguments are the same as for ``iter_transactions``.
+        """
+
+    def archive_transaction(transaction_id):
+        """Move a payment to the archive of the object.
+
+        Archived payments are still returned by ``get_transaction`` and
+        ``iter_transactions``.
+        """
+
+    def archive_transactions(max_age=None, now=None):
+        """Archive the final payments not updated for ``max_age`` seconds.
+
+        Return the IDs of the archived transactions.
+        """
+
+    def get_payment_status(transaction_id, order_info=None):
+        """Retrieve and return the payment status.
+
+        When the payment has already been checked (for instance with
+        ``check_payments``), pass the result as ``order_info`` to store
+        it without calling Mollie.
+        """
+
+
+class IMollieTransactionIndex(Interface):
+    """Site wide index of the objects on which payments are stored.
+
+    The index maps a transaction ID to the object which stores the
+    payment, so a payment can be found with just its transaction ID.
+    """
+
+    complete = Attribute('True once the payments stored before the index '
+                         'existed have been added to it.')
+    archived_until = Attribute('Epoch time of the cutoff of the last run '
+                               'of archive_payments, or None.')
+
+    def index_transaction(transaction_id, obj, multiple=False):
+        """Store where the payment with ``transaction_id`` is stored.
+
+        ``multiple`` tells whether the payment is stored with the
+        ``IMollieIdealMultiplePayments`` adapter (instead of the
+        ``IMollieIdealPayment`` adapter).
+        """
+
+    def unindex_transaction(transaction_id):
+        """Remove the transaction from the index."""
+
+    def index_payment(transaction_id, payment):
+        """Update the status, paid flag and last update of a payment.
+
+        ``payment`` is the ``PaymentRecord`` of an indexed transaction.
+        """
+
+    def query(status=None, paid=None, updated_min=None, updated_max=None):
+        """Return a lazy iterator over the matching transaction IDs.
+
+        ``updated_min`` and ``updated_max`` are (inclusive) epoch times
+        of the last update of the payment.
+        """
+
+    def get_payment_entry(transaction_id, default=None):
+        """Return the indexed status, paid flag and last update time of
+        a payment as a tuple."""
+
+    def get(transaction_id, default=None):
+        """Return the entry for a transaction.
+
+        The entry is a tuple of the path of the object, its UID (or
+        None) and whether multiple payments are stored on the object.
+        """
+
+    def resolve(transaction_id, root):
+        """Return the object on which the payment is stored, or None.
+
+        Paths are traversed from ``root``.
+        """
+
+    def __len__():
+        """Return the number of indexed transactions."""
+
+    def __contains__(transaction_id):
+        """Return True if the transaction is indexed."""
+
+
+class IMollieCheckResultStore(Interface):
+    """Durable store of the first result of checking a payment.
+
+    Mollie only returns the status of a payment once, so the first
+    result is stored (and committed right away) and later checks are
+    answered from the store.
+    """
+
+    def get(transaction_id):
+        """Return the stored check result of a payment, or None."""
+
+    def record(transaction_id, result):
+        """Store the check result, unless a result is already stored.
+
+        Only final results (like 'Success') are stored, a result which
+        may still change (like 'Open' or 'CheckedBefore') is not. Return
+        True if a result is stored for the payment.
+        """
+
+
+class IMollieReportQueue(Interface):
+    """Queue of reports of Mollie which are processed in the background.
+
+    A job is a tuple of the path and UID of the object with the
+    payment, whether the object stores multiple payments and the
+    number of failed attempts to process it.
+    """
+
+    def put(transaction_id, obj, multiple=False):
+        """Queue the report for the payment with ``transaction_id``.
+
+        Return False if the payment is already queued.
+        """
+
+    def pop():
+        """Remove the next job and return a (transaction ID, job) tuple.
+
+        Return None if the queue is empty.
+        """
+
+    def retake(transaction_id, job):
+        """Take the job of a report again after its transaction has been
+        aborted because of a conflict.
+
+        The job is read again, since it may have been changed by the
+        transaction it conflicted with. Return None when the report is
+        no longer queued (it has been processed by another worker).
+        """
+
+    def failed(transaction_id, job):
+        """Queue a job again after processing it failed.
+
+        Return False if it failed too often and has been dropped.
+        """
+
+    def __len__():
+        """Return the number of queued reports."""
+
+
+class IMollieReportPreCheck(Interface):
+    """Cheap checks of a report, before the payment is loaded."""
+
+    def check(transaction_id, address=None):
+        """Check the transaction ID and the address a report came from.
+
+        Return None if the report may be processed, otherwise the reason
+        to reject it: 'missing', 'bad_format', 'bad_address' or
+        'unknown'.
+        """
+
+    def add(transaction_id):
+        """Add the ID of a new transaction to the known transactions."""
+
+    def load(transaction_ids):
+        """Replace the known transactions with ``transaction_ids``.
+
+        Without this, the known transactions are loaded from the
+        transaction index on first use, once the index is complete.
+        Unknown transactions are only rejected when the transaction
+        index is complete. Return the number of known transactions.
+        """
+
+    def stats():
+        """Return a dict with the number of accepted and rejected
+        reports (by reason) and of known transactions."""
 
 
 class IMollieIdealPaymentEvent(Interface):
@@ -114,3 +355,39 @@ class IMollieIdealPaymentEvent(Interface):
 
     context = Attribute('The object the payment was processed for.')
     request = Attribute('The request')
+
+
+class IMolliePaymentStatusEvent(Interface):
+    """An event signalling the result of a report of Mollie.
+
+    Unlike ``IMollieIdealPaymentEvent``, there are more specific events
+    for the status of the payment, so subscribers only need to be
+    registered for the reports they want to act on.
+    """
+
+    context = Attribute('The object the payment was processed for.')
+    request = Attribute('The request (None in the background)')
+    transaction_id = Attribute('The transaction ID of the payment.')
+    old_status = Attribute('The status before the report (or None).')
+    new_status = Attribute('The status after the report.')
+
+
+class IMolliePaymentStatusUnchangedEvent(IMolliePaymentStatusEvent):
+    """The status of the payment did not change (for instance because
+    Mollie answered 'CheckedBefore')."""
+
+
+class IMolliePaymentStatusChangedEvent(IMolliePaymentStatusEvent):
+    """The status of the payment changed."""
+
+
+class IMolliePaymentPaidEvent(IMolliePaymentStatusChangedEvent):
+    """The payment has been paid: its status changed to 'Success'."""
+
+
+class IMolliePaymentCancelledEvent(IMolliePaymentStatusChangedEvent):
+    """The payment has been cancelled by the consumer."""
+
+
+class IMolliePaymentExpiredEvent(IMolliePaymentStatusChangedEvent):
+    """The payment expired before it was paid."""
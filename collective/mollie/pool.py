@@ -0,0 +1,370 @@
+"""
+A thread-safe pool of keep-alive HTTPS connections.
+
+Setting up a new TLS connection for every call to Mollie is expensive:
+the handshake usually takes longer than the actual request. The
+``HTTPSConnectionPool`` keeps a number of idle connections around so
+subsequent requests can reuse them.
+"""
+import httplib
+import select
+import socket
+import sys
+import threading
+import time
+
+
+# Errors which indicate the server closed a connection we kept around.
+RECONNECT_ERRORS = (socket.error, httplib.BadStatusLine,
+                    httplib.CannotSendRequest, httplib.ResponseNotReady)
+
+
+class ResponseTooLargeError(IOError):
+    """The response is larger than the maximum size which is allowed."""
+
+
+def reraise_timeout():
+    """Raise the current error, as a ``socket.timeout`` if it is one.
+
+    The ssl module of Python 2 raises an ``SSLError`` instead of a
+    ``socket.timeout`` when a read or write on an SSL socket times out.
+    ``SSLError`` is a ``socket.error``, so the ssl module (which is
+    missing from a Python built without SSL) is not needed to catch it.
+    """
+    exc_type, error, traceback = sys.exc_info()
+    if isinstance(error, socket.error) and \
+       not isinstance(error, socket.timeout) and 'timed out' in str(error):
+        raise socket.timeout, socket.timeout(str(error)), traceback
+    raise exc_type, error, traceback
+
+
+def is_connection_dropped(connection):
+    """Return True if the server closed the idle ``connection``.
+
+    An idle keep-alive connection should not have anything to read. If
+    the socket is readable, the server has closed it (or sent garbage).
+    """
+    sock = connection.sock
+    if sock is None:
+        return False
+    try:
+        readable, writable, errors = select.select([sock], [], [], 0.0)
+    except (select.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class HTTPSConnectionPool(object):
+    """A pool of keep-alive connections to a single host.
+
+    At most ``size`` idle connections are kept. When all connections
+    are in use a new one is created instead of blocking the caller;
+    connections released to a full pool are closed.
+
+    Idle connections older than ``idle_timeout`` seconds are discarded
+    instead of being reused, since the server has most likely closed
+    them already.
+
+    Setting up a connection may take at most ``connect_timeout``
+    seconds, and each read or write on it at most ``read_timeout``
+    seconds (None means no timeout).
+    """
+
+    def __init__(self, host, port=None, size=4, idle_timeout=60,
+                 connection_class=httplib.HTTPSConnection,
+                 connect_timeout=None, read_timeout=None, **conn_kwargs):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connection_class = connection_class
+        self.conn_kwargs = conn_kwargs
+        self._lock = threading.Lock()
+        # List of (connection, time of release) tuples, most recently
+        # released last.
+        self._idle = []
+        self._in_use = 0
+        self._counters = {
+            'created': 0,
+            'reused': 0,
+            'reconnects': 0,
+            'expired': 0,
+            'discarded': 0,
+        }
+
+    def _new_connection(self):
+        connection = self.connection_class(self.host, self.port,
+                                           **self.conn_kwargs)
+        self._counters['created'] += 1
+        return connection
+
+    def acquire(self):
+        """Return a tuple with a connection and whether it is reused."""
+        now = time.time()
+        expired = []
+        self._lock.acquire()
+        try:
+            connection = None
+            while self._idle:
+                candidate, released = self._idle.pop()
+                if now - released > self.idle_timeout:
+                    expired.append(candidate)
+                    self._counters['expired'] += 1
+                    continue
+                if is_connection_dropped(candidate):
+                    # Reopen it the next time it is used.
+                    candidate.close()
+                    self._counters['reconnects'] += 1
+                connection = candidate
+                self._counters['reused'] += 1
+                break
+            self._in_use += 1
+            if connection is None:
+                connection = self._new_connection()
+                reused = False
+            else:
+                reused = True
+        finally:
+            self._lock.release()
+        for candidate in expired:
+            candidate.close()
+        return connection, reused
+
+    def release(self, connection, reusable=True):
+        """Give a connection back to the pool.
+
+        Connections which cannot be reused (for instance because the
+        server asked to close it) are closed instead.
+        """
+        self._lock.acquire()
+        try:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+            self._counters['discarded'] += 1
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def request(self, method, url, body=None, headers={}, max_size=None,
+                deadline=None, idempotent=False):
+        """Perform a request and return a tuple with status and body.
+
+        The response body is read completely so the connection can be
+        reused. See ``open`` for when a request is sent again.
+        """
+        response = self.open(method, url, body, headers, max_size, deadline,
+                             idempotent)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        return response.status, data
+
+    def open(self, method, url, body=None, headers={}, max_size=None,
+             deadline=None, idempotent=False):
+        """Perform a request and return a ``PooledResponse``.
+
+        The body of the response has not been read yet, so it can be
+        processed while it is received. The response must be closed,
+        which gives the connection back to the pool.
+
+        If ``max_size`` is given, reading more than ``max_size`` bytes
+        raises a ``ResponseTooLargeError``.
+
+        If ``deadline`` (a time in seconds since the epoch) is given,
+        the request and reading the response raise a
+        ``socket.timeout`` when it has passed.
+
+        If sending the request on a reused connection fails, because the
+        server closed it, the request is sent again on a fresh
+        connection. When the request has been sent but getting the
+        response fails, the server may have handled the request already,
+        so it is only sent again if it is ``idempotent``.
+        """
+        connection, reused = self.acquire()
+        try:
+            try:
+                self._send(connection, method, url, body, headers, deadline)
+            except RECONNECT_ERRORS, e:
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                self._reconnect(
+                    connection, method, url, body, headers, deadline)
+                reused = False
+            try:
+                response = self._getresponse(connection)
+            except RECONNECT_ERRORS, e:
+                if not (reused and idempotent) or \
+                   isinstance(e, socket.timeout):
+                    raise
+                self._reconnect(
+                    connection, method, url, body, headers, deadline)
+                response = self._getresponse(connection)
+            if max_size is not None and response.length is not None and \
+               response.length > max_size:
+                raise ResponseTooLargeError(
+                    'Response of %d bytes is larger than %d bytes' % (
+                        response.length, max_size))
+        except:
+            connection.close()
+            self.release(connection, reusable=False)
+            raise
+        return PooledResponse(self, connection, response, max_size, deadline)
+
+    def timeout(self, timeout, deadline=None):
+        """Return the socket timeout to use before ``deadline``.
+
+        This is ``timeout``, or the time left until the deadline if
+        that is shorter. A ``socket.timeout`` is raised when the
+        deadline has passed.
+        """
+        if deadline is None:
+            return timeout
+        left = deadline - time.time()
+        if left <= 0:
+            raise socket.timeout('Deadline exceeded')
+        if timeout is None:
+            return left
+        return min(timeout, left)
+
+    def _send(self, connection, method, url, body, headers, deadline=None):
+        try:
+            if connection.sock is None:
+                connect_timeout = self.timeout(self.connect_timeout, deadline)
+                if connect_timeout is not None:
+                    connection.timeout = connect_timeout
+                connection.connect()
+            read_timeout = self.timeout(self.read_timeout, deadline)
+            if read_timeout is not None:
+                connection.sock.settimeout(read_timeout)
+            connection.request(method, url, body, headers)
+        except socket.error:
+            reraise_timeout()
+
+    def _getresponse(self, connection):
+        try:
+            return connection.getresponse()
+        except socket.error:
+            reraise_timeout()
+
+    def _reconnect(self, connection, method, url, body, headers,
+                   deadline=None):
+        connection.close()
+        self._lock.acquire()
+        try:
+            self._counters['reconnects'] += 1
+        finally:
+            self._lock.release()
+        self._send(connection, method, url, body, headers, deadline)
+
+    def clear(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for connection, released in idle:
+            connection.close()
+
+    def stats(self):
+        """Return a dict with statistics about the pool."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._counters)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+            stats['size'] = self.size
+        finally:
+            self._lock.release()
+        return stats
+
+
+class PooledResponse(object):
+    """A file-like response on a connection from a pool.
+
+    Closing the response gives the connection back to the pool. It is
+    only reused when the complete body has been read.
+    """
+
+    # Unread data which is read when the response is closed, so the
+    # connection can be reused. With more data the connection is closed.
+    DRAIN_SIZE = 64 * 1024
+
+    def __init__(self, pool, connection, response, max_size=None,
+                 deadline=None):
+        self.pool = pool
+        self.connection = connection
+        # The socket of the response, to apply the deadline to.
+        self.sock = connection.sock
+        self.response = response
+        self.status = response.status
+        self.max_size = max_size
+        self.deadline = deadline
+        self.bytes_read = 0
+        self.closed = False
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        """Read at most ``amt`` bytes (or everything) from the body."""
+        if self.closed:
+            return ''
+        try:
+            if self.deadline is not None and self.sock is not None:
+                self.sock.settimeout(
+                    self.pool.timeout(self.pool.read_timeout, self.deadline))
+            if self.max_size is None:
+                data = self.response.read(amt)
+            else:
+                # Never read more than one byte past the limit, so a
+                # huge response is not read into memory.
+                left = self.max_size - self.bytes_read + 1
+                if amt is None or amt > left:
+                    amt = left
+                data = self.response.read(amt)
+        except:
+            self._discard()
+            reraise_timeout()
+        self.bytes_read += len(data)
+        if self.max_size is not None and self.bytes_read > self.max_size:
+            self._discard()
+            raise ResponseTooLargeError(
+                'Response is larger than %d bytes' % self.max_size)
+        return data
+
+    def close(self):
+        """Give the connection back to the pool."""
+        if self.closed:
+            return
+        if not self.response.isclosed():
+            # Read what is left of the body (usually only the end of
+            # the XML), otherwise the connection cannot be reused.
+            try:
+                if self.deadline is not None and self.sock is not None:
+                    self.sock.settimeout(self.pool.timeout(
+                        self.pool.read_timeout, self.deadline))
+                data = self.response.read(self.DRAIN_SIZE)
+            except Exception:
+                self._discard()
+                return
+            self.bytes_read += len(data)
+            if not self.response.isclosed():
+                self._discard()
+                return
+        self.closed = True
+        self.pool.release(self.connection,
+                          reusable=not self.response.will_close)
+
+    def _discard(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.connection.close()
+        self.pool.release(self.connection, reusable=False)
@@ -0,0 +1,219 @@
+"""
+Cheap checks of the reports of Mollie, before any payment is loaded.
+
+The report views are public, so scanners and bogus retries hit them
+too. The ``ReportPreCheck`` rejects those reports before the context
+is adapted and its payments are loaded from the database:
+
+- the transaction ID should look like one of Mollie (32 hexadecimal
+  characters),
+
+- the report should come from one of the ``networks`` Mollie sends its
+  reports from (only when networks are configured),
+
+- the transaction ID should be known. Known transaction IDs are kept
+  in a ``BloomFilter`` in the memory of the process, which is filled
+  from the transaction index on first use (or with ``load``) and kept
+  up to date when payments are requested. A
+  transaction ID which is not in the filter may have been requested in
+  another ZEO client, so it is looked up in the transaction index (a
+  single lookup which does not load the context) before the report is
+  rejected. Payments stored before the index existed are only in it
+  once it is ``complete`` (see ``backfill_index``), so until then (or
+  without an index) the report is accepted.
+
+The rejections are counted, see ``stats``.
+"""
+import math
+import re
+import socket
+import struct
+import threading
+from hashlib import md5
+
+from zope.component import queryUtility
+from zope.interface import implements
+
+from collective.mollie.interfaces import IMollieReportPreCheck
+from collective.mollie.interfaces import IMollieTransactionIndex
+
+
+def parse_network(network):
+    """Return the (address, mask) integers of an IPv4 network.
+
+    The network is an address (like '1.2.3.4') or a network in CIDR
+    notation (like '1.2.3.0/24').
+    """
+    if '/' in network:
+        address, bits = network.split('/', 1)
+        bits = int(bits)
+    else:
+        address, bits = network, 32
+    if not 0 <= bits <= 32:
+        raise ValueError('Invalid network: %r' % network)
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    return parse_address(address) & mask, mask
+
+
+def parse_address(address):
+    """Return an IPv4 address as an integer."""
+    try:
+        return struct.unpack('!I', socket.inet_aton(address.strip()))[0]
+    except (socket.error, AttributeError):
+        raise ValueError('Invalid address: %r' % address)
+
+
+class BloomFilter(object):
+    """Set of strings which may give false positives, but no false
+    negatives.
+
+    It uses about 1.8 bytes per string for an error rate of 0.001,
+    whatever the length of the strings.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(int(math.ceil(bits)), 8)
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        first, second = struct.unpack('<QQ', md5(value).digest())
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """Return the number of added strings."""
+        return self._count
+
+
+class ReportPreCheck(object):
+    """Check the reports of Mollie before the payments are loaded."""
+    implements(IMollieReportPreCheck)
+
+    TRANSACTION_ID_FORMAT = re.compile(r'^[0-9a-f]{32}\Z')
+
+    def __init__(self, networks=(), capacity=100000, error_rate=0.001):
+        self.networks = [parse_network(network) for network in networks]
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        # Held while the filter is loaded from the transaction index, so
+        # concurrent reports do not all load it.
+        self._load_lock = threading.Lock()
+        # The filter of known transaction IDs, None until it is loaded.
+        self._known = None
+        self._counters = {
+            'accepted': 0,
+            'missing': 0,
+            'bad_format': 0,
+            'bad_address': 0,
+            'unknown': 0,
+        }
+
+    def load(self, transaction_ids):
+        known = BloomFilter(self.capacity, self.error_rate)
+        for transaction_id in transaction_ids:
+            known.add(transaction_id)
+        self._lock.acquire()
+        try:
+            self._known = known
+        finally:
+            self._lock.release()
+        return len(known)
+
+    def add(self, transaction_id):
+        self._lock.acquire()
+        try:
+            if self._known is not None:
+                self._known.add(transaction_id)
+        finally:
+            self._lock.release()
+
+    def _known_transactions(self, index):
+        """Return the filter of known transaction IDs.
+
+        The first time, the filter is loaded from the ``index``, once it
+        is complete. Return None until then.
+        """
+        known = self._known
+        if known is None and index is not None and index.complete:
+            self._load_lock.acquire()
+            try:
+                if self._known is None:
+                    self.load(index.keys())
+                known = self._known
+            finally:
+                self._load_lock.release()
+        return known
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._counters[name] += 1
+        finally:
+            self._lock.release()
+
+    def _rejection(self, transaction_id, address):
+        if not transaction_id:
+            return 'missing'
+        if (not isinstance(transaction_id, basestring) or
+            not self.TRANSACTION_ID_FORMAT.match(transaction_id)):
+            return 'bad_format'
+        if self.networks:
+            try:
+                address = parse_address(address)
+            except ValueError:
+                return 'bad_address'
+            for network, mask in self.networks:
+                if address & mask == network:
+                    break
+            else:
+                return 'bad_address'
+        index = queryUtility(IMollieTransactionIndex)
+        known = self._known_transactions(index)
+        if known is not None and transaction_id not in known:
+            if index is not None and transaction_id in index:
+                self.add(transaction_id)
+            elif index is not None and index.complete:
+                return 'unknown'
+        return None
+
+    def check(self, transaction_id, address=None):
+        reason = self._rejection(transaction_id, address)
+        self._count(reason or 'accepted')
+        return reason
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            stats = dict(self._counters)
+            # The number of known transaction IDs (None when not loaded).
+            stats['known'] = None
+            if self._known is not None:
+                stats['known'] = len(self._known)
+        finally:
+            self._lock.release()
+        return stats
+
+
+def add_known_transaction(transaction_id):
+    """Add a new transaction ID to the ``IMollieReportPreCheck`` utility,
+    if it is available."""
+    precheck = queryUtility(IMollieReportPreCheck)
+    if precheck is not None:
+        precheck.add(transaction_id)
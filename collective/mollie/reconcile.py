@@ -0,0 +1,216 @@
+"""
+Check the payments Mollie did not report.
+
+When a report of Mollie gets lost, a payment stays open (or unchecked)
+forever, since nothing checks it anymore. ``reconcile_payments`` finds
+the indexed payments which are still open or unchecked a while after
+their last update, checks them with Mollie concurrently (with a rate
+limit) and stores the results through the adapters, like a report
+would. The event subscribers are notified as well. It commits after
+each batch, so it can run regularly next to a live site, for instance
+with the ``reconcile_mollie`` command of the Zope instance::
+
+    bin/instance reconcile_mollie Plone --min-age 3600
+"""
+import logging
+import optparse
+import time
+
+import transaction
+from zope.component import getUtility
+from zope.component import queryUtility
+
+from collective.mollie.adapter import UnknownTransactionError
+from collective.mollie.adapter import get_indexed_payment
+from collective.mollie.batch import RateLimiter
+from collective.mollie.interfaces import IMollieIdeal
+from collective.mollie.interfaces import IMollieTransactionIndex
+from collective.mollie.reports import process_report
+
+try:
+    from zope.component.hooks import setSite
+except ImportError:
+    from zope.site.hooks import setSite
+
+try:
+    from zope.component.interfaces import ISite
+except ImportError:
+    from zope.location.interfaces import ISite
+
+logger = logging.getLogger('collective.mollie')
+
+# The statuses of payments which may still change.
+OPEN_STATUSES = (None, 'Open')
+
+
+def open_payments(index, updated_min=None, updated_max=None):
+    """Yield the IDs of the indexed payments which are open or have not
+    been checked, last updated between ``updated_min`` and
+    ``updated_max``."""
+    for transaction_id in index.query(updated_min=updated_min,
+                                      updated_max=updated_max):
+        entry = index.get_payment_entry(transaction_id)
+        if entry is not None and entry[0] in OPEN_STATUSES:
+            yield transaction_id
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _check_batch(ideal, batch, max_workers, timeout, limiter):
+    """Return a dict with the check results of a batch of payments."""
+    pairs = []
+    for transaction_id, payment in batch:
+        pairs.append((payment['partner_id'], transaction_id))
+    results = {}
+    for result in ideal.check_payments(pairs, max_workers, timeout,
+                                       limiter):
+        results[result.transaction_id] = result
+    return results
+
+
+def reconcile_payments(index, root, min_age=3600, max_age=7*24*3600,
+                       max_workers=4, rate=5, batch_size=100, timeout=60,
+                       commit=True, now=None, limit=None, ideal=None):
+    """Check the open payments which have not been updated for
+    ``min_age`` seconds.
+
+    Only payments updated less than ``max_age`` seconds ago are checked
+    (all older payments when it is None). At most ``max_workers``
+    payments are checked at the same time, and at most ``rate`` per
+    second. After every ``batch_size`` payments the results are stored
+    and the transaction is committed (when ``commit`` is True). At most
+    ``limit`` payments are checked, if given.
+
+    Return a dict with the number of payments per outcome ('checked',
+    'changed', 'unchanged', 'missing' and 'errors'), the number of
+    payments per new status in 'statuses', the duration in 'seconds'
+    and the number of checked payments per second in 'per_second'.
+    """
+    if ideal is None:
+        ideal = getUtility(IMollieIdeal)
+    if now is None:
+        now = time.time()
+    updated_min = None
+    if max_age is not None:
+        updated_min = now - max_age
+    limiter = None
+    if rate:
+        limiter = RateLimiter(rate, burst=max_workers)
+    stats = {
+        'checked': 0,
+        'changed': 0,
+        'unchanged': 0,
+        'missing': 0,
+        'errors': 0,
+        'statuses': {},
+    }
+    started = time.time()
+    # Storing the results changes the index, so do not iterate over it
+    # in the meantime.
+    candidates = list(open_payments(index, updated_min, now - min_age))
+    for transaction_ids in _batches(candidates, batch_size):
+        if limit is not None:
+            transaction_ids = transaction_ids[:limit - stats['checked']]
+        batch = []
+        for transaction_id in transaction_ids:
+            payment = get_indexed_payment(index, transaction_id, root)
+            if payment is None:
+                stats['missing'] += 1
+            else:
+                batch.append((transaction_id, payment))
+        results = _check_batch(ideal, batch, max_workers, timeout, limiter)
+        for transaction_id, payment in batch:
+            stats['checked'] += 1
+            result = results.get(transaction_id)
+            if result is None or result.error is not None:
+                stats['errors'] += 1
+                logger.warning('Checking transaction %s failed: %r',
+                               transaction_id, result and result.error)
+                continue
+            multiple = index.get(transaction_id)[2]
+            obj = index.resolve(transaction_id, root)
+            try:
+                event = process_report(obj, transaction_id, multiple,
+                                       order_info=result.order)
+            except UnknownTransactionError:
+                stats['missing'] += 1
+                continue
+            if event.old_status == event.new_status:
+                stats['unchanged'] += 1
+            else:
+                stats['changed'] += 1
+            statuses = stats['statuses']
+            statuses[event.new_status] = statuses.get(event.new_status, 0) + 1
+        logger.info('Checked %d payments.', stats['checked'])
+        if commit:
+            transaction.commit()
+        if limit is not None and stats['checked'] >= limit:
+            break
+    stats['seconds'] = time.time() - started
+    stats['per_second'] = 0.0
+    if stats['seconds']:
+        stats['per_second'] = stats['checked'] / stats['seconds']
+    logger.info('Checked %(checked)d payments in %(seconds).1f seconds: '
+                '%(changed)d changed, %(unchanged)d unchanged, %(errors)d '
+                'errors and %(missing)d missing.', stats)
+    return stats
+
+
+def reconcile_command(app, args):
+    """Check the open payments of a site, for ``bin/instance``.
+
+    Registered as the ``reconcile_mollie`` command of the Zope instance.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog reconcile_mollie [options] <path of the site>')
+    parser.add_option('--min-age', type='int', default=3600,
+                      help='Check payments not updated for this number '
+                           'of seconds (default: %default).')
+    parser.add_option('--max-age', type='int', default=7*24*3600,
+                      help='Skip payments not updated for this number of '
+                           'seconds, 0 checks all (default: %default).')
+    parser.add_option('--workers', type='int', default=4,
+                      help='Number of concurrent checks (default: %default).')
+    parser.add_option('--rate', type='float', default=5,
+                      help='Maximum number of checks per second, 0 for no '
+                           'limit (default: %default).')
+    parser.add_option('--batch-size', type='int', default=100,
+                      help='Commit after this number of payments '
+                           '(default: %default).')
+    parser.add_option('--timeout', type='float', default=60,
+                      help='Timeout of a check in seconds '
+                           '(default: %default).')
+    parser.add_option('--limit', type='int', default=None,
+                      help='Maximum number of payments to check.')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('Give the path of the site.')
+    site = app.unrestrictedTraverse(args[0])
+    if ISite.providedBy(site):
+        setSite(site)
+    try:
+        index = queryUtility(IMollieTransactionIndex)
+        if index is None:
+            parser.error('No transaction index in %s.' % args[0])
+        stats = reconcile_payments(
+            index, site, min_age=options.min_age,
+            max_age=options.max_age or None, max_workers=options.workers,
+            rate=options.rate, batch_size=options.batch_size,
+            timeout=options.timeout, limit=options.limit)
+    finally:
+        setSite(None)
+    print ('Checked %(checked)d payments in %(seconds).1f seconds '
+           '(%(per_second).1f per second).' % stats)
+    for name in ['changed', 'unchanged', 'errors', 'missing']:
+        print '%s: %d' % (name, stats[name])
+    for status, count in sorted(stats['statuses'].items()):
+        print 'status %s: %d' % (status, count)
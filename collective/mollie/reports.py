@@ -0,0 +1,379 @@
+"""
+Process the reports of Mollie in the background.
+
+When an ``IMollieReportQueue`` utility is registered, the report views
+only check the transaction ID and queue the report, so Mollie gets its
+answer right away. A pool of ``ReportWorkers`` then checks the queued
+payments (with bounded concurrency), notifies the
+``MollieIdealPaymentEvent`` subscribers and commits, each report in a
+transaction of its own.
+
+The ``ReportQueue`` is stored in the ZODB, so reports are not lost
+when Zope is restarted. The ``LocalReportQueue`` only lives in the
+memory of the process, which is enough for tests.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import transaction
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from zope.component import queryUtility
+from zope.event import notify
+from zope.interface import implements
+
+from collective.mollie.events import MollieIdealPaymentEvent
+from collective.mollie.events import notify_status
+from collective.mollie.events import status_event
+from collective.mollie.index import object_path
+from collective.mollie.index import object_uid
+from collective.mollie.index import resolve_entry
+from collective.mollie.interfaces import IMollieIdealMultiplePayments
+from collective.mollie.interfaces import IMollieIdealPayment
+from collective.mollie.interfaces import IMollieReportQueue
+
+try:
+    from zope.component.hooks import setSite
+except ImportError:
+    from zope.site.hooks import setSite
+
+try:
+    from zope.component.interfaces import ISite
+except ImportError:
+    from zope.location.interfaces import ISite
+
+logger = logging.getLogger('collective.mollie')
+
+# Number of times a report is processed again right away when its
+# transaction conflicts, before it counts as a failed attempt.
+CONFLICT_RETRIES = 3
+
+
+def process_report(obj, transaction_id, multiple=False, request=None,
+                   transaction_manager=None, order_info=None):
+    """Check the payment on ``obj`` and notify the event subscribers.
+
+    Next to the ``MollieIdealPaymentEvent``, a payment status event
+    (like ``PaymentPaid``) with the status before and after the check is
+    notified, see ``notify_status``. Return the status event.
+
+    When the payment has already been checked, pass the result as
+    ``order_info``.
+    """
+    if multiple:
+        adapted = IMollieIdealMultiplePayments(obj)
+        old_status = adapted.get_transaction(transaction_id)['status']
+        adapted.get_payment_status(transaction_id, order_info)
+        new_status = adapted.get_transaction(transaction_id)['status']
+    else:
+        adapted = IMollieIdealPayment(obj)
+        old_status = adapted.status
+        adapted.get_payment_status(order_info)
+        new_status = adapted.status
+    notify(MollieIdealPaymentEvent(obj, request, transaction_id))
+    event = status_event(obj, request, transaction_id, old_status,
+                         new_status)
+    notify_status(event, transaction_manager=transaction_manager)
+    return event
+
+
+def make_job(obj, multiple=False):
+    """Return the job for a report of a payment on ``obj``.
+
+    A job is a tuple of the path and UID of the object, whether it
+    stores multiple payments and the number of failed attempts.
+    """
+    return (object_path(obj), object_uid(obj), bool(multiple), 0)
+
+
+class ReportQueue(Persistent):
+    """Queue of reports which is stored in the ZODB.
+
+    The jobs are kept in an ``OOBTree`` keyed by transaction ID, so a
+    second report for the same payment does not add a job. Workers take
+    a job at a random position in the tree, so concurrent workers do
+    not all conflict on the same job.
+    """
+    implements(IMollieReportQueue)
+
+    # Number of attempts to process a report before it is dropped.
+    MAX_ATTEMPTS = 5
+
+    def __init__(self):
+        self._jobs = OOBTree()
+        self._length = Length()
+
+    def put(self, transaction_id, obj, multiple=False):
+        if transaction_id in self._jobs:
+            return False
+        self._jobs[transaction_id] = make_job(obj, multiple)
+        self._length.change(1)
+        return True
+
+    def pop(self):
+        if not self._jobs:
+            return None
+        # Transaction IDs are hexadecimal strings.
+        start = '%x' % random.randrange(16)
+        try:
+            transaction_id = self._jobs.minKey(start)
+        except ValueError:
+            transaction_id = self._jobs.minKey()
+        job = self._jobs.pop(transaction_id)
+        self._length.change(-1)
+        return transaction_id, job
+
+    def retake(self, transaction_id, job):
+        # Aborting the transaction has put the job back in the tree.
+        job = self._jobs.get(transaction_id)
+        if job is None:
+            return None
+        del self._jobs[transaction_id]
+        self._length.change(-1)
+        return job
+
+    def failed(self, transaction_id, job):
+        path, uid, multiple, attempts = job
+        attempts += 1
+        if attempts >= self.MAX_ATTEMPTS:
+            if transaction_id in self._jobs:
+                del self._jobs[transaction_id]
+                self._length.change(-1)
+            return False
+        if transaction_id not in self._jobs:
+            self._length.change(1)
+        self._jobs[transaction_id] = (path, uid, multiple, attempts)
+        return True
+
+    def __len__(self):
+        return self._length()
+
+
+class LocalReportQueue(object):
+    """Queue of reports in the memory of the process.
+
+    The queue is lost when the process stops, so only use it for tests
+    or when an occasional lost report is no problem (Mollie reports a
+    payment again when it did not get an answer).
+    """
+    implements(IMollieReportQueue)
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._order = deque()
+        self._jobs = {}
+
+    def put(self, transaction_id, obj, multiple=False):
+        return self._put(transaction_id, make_job(obj, multiple))
+
+    def _put(self, transaction_id, job):
+        self._lock.acquire()
+        try:
+            if transaction_id in self._jobs:
+                return False
+            self._jobs[transaction_id] = job
+            self._order.append(transaction_id)
+            return True
+        finally:
+            self._lock.release()
+
+    def pop(self):
+        self._lock.acquire()
+        try:
+            if not self._order:
+                return None
+            transaction_id = self._order.popleft()
+            return transaction_id, self._jobs.pop(transaction_id)
+        finally:
+            self._lock.release()
+
+    def retake(self, transaction_id, job):
+        # The queue is not transactional, so the job is still ours. A
+        # report of the same payment which was queued in the meantime
+        # is dropped, it is processed now.
+        self._lock.acquire()
+        try:
+            if transaction_id in self._jobs:
+                del self._jobs[transaction_id]
+                self._order.remove(transaction_id)
+            return job
+        finally:
+            self._lock.release()
+
+    def failed(self, transaction_id, job):
+        path, uid, multiple, attempts = job
+        attempts += 1
+        if attempts >= self.MAX_ATTEMPTS:
+            return False
+        return self._put(transaction_id, (path, uid, multiple, attempts))
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+def process_next(site, queue, transaction_manager=None):
+    """Process the next report in ``queue`` and commit.
+
+    Return False if the queue is empty. When the transaction conflicts,
+    it is aborted and the same report is processed again right away
+    (at most ``CONFLICT_RETRIES`` times), with the state the other
+    transaction committed. When processing the report fails otherwise,
+    the transaction is aborted and the report is queued again (until it
+    has failed ``MAX_ATTEMPTS`` times).
+    """
+    if transaction_manager is None:
+        transaction_manager = transaction.manager
+    item = queue.pop()
+    if item is None:
+        transaction_manager.abort()
+        return False
+    transaction_id, job = item
+    conflicts = 0
+    while True:
+        try:
+            _process_job(site, transaction_id, job, transaction_manager)
+            transaction_manager.commit()
+            return True
+        except ConflictError:
+            transaction_manager.abort()
+            conflicts += 1
+            if conflicts > CONFLICT_RETRIES:
+                logger.warning('The report of transaction %s conflicted '
+                               '%d times.', transaction_id, conflicts)
+                break
+            # The abort has synced the connection, so the job is read
+            # again as the other transaction committed it.
+            job = queue.retake(transaction_id, job)
+            if job is None:
+                transaction_manager.abort()
+                return True
+        except Exception:
+            transaction_manager.abort()
+            logger.exception('Processing the report of transaction %s '
+                             'failed.', transaction_id)
+            break
+    if not queue.failed(transaction_id, job):
+        logger.error('Dropped the report of transaction %s.',
+                     transaction_id)
+    try:
+        transaction_manager.commit()
+    except ConflictError:
+        # The report is still queued, it is processed again later.
+        transaction_manager.abort()
+    return True
+
+
+def _process_job(site, transaction_id, job, transaction_manager):
+    path, uid, multiple, attempts = job
+    obj = resolve_entry(path, uid, site)
+    if obj is None:
+        logger.warning('Object for queued report of transaction %s '
+                       'not found.', transaction_id)
+        return
+    process_report(obj, transaction_id, multiple,
+                   transaction_manager=transaction_manager)
+
+
+def site_processor(site, transaction_manager=None):
+    """Return a function which processes the next report for ``site``.
+
+    The queue is looked up when a report is processed. Use this when
+    the site can be shared by the workers, like in tests.
+    """
+    def process():
+        return process_next(site, queryUtility(IMollieReportQueue),
+                            transaction_manager)
+    return process
+
+
+def zodb_processor(db, get_site):
+    """Return a function which processes the next report.
+
+    Each report is processed with a connection of its own to ``db``.
+    ``get_site`` is called with the root of the database and should
+    return the site, e.g.::
+
+        zodb_processor(db, lambda root: root['Application']['plone'])
+    """
+    def process():
+        transaction_manager = transaction.TransactionManager()
+        connection = db.open(transaction_manager=transaction_manager)
+        try:
+            site = get_site(connection.root())
+            if ISite.providedBy(site):
+                setSite(site)
+            try:
+                queue = queryUtility(IMollieReportQueue)
+                if queue is None:
+                    return False
+                return process_next(site, queue, transaction_manager)
+            finally:
+                setSite(None)
+        finally:
+            transaction_manager.abort()
+            connection.close()
+    return process
+
+
+class ReportWorkers(object):
+    """Pool of threads which process the queued reports.
+
+    ``process`` is a function which processes the next report and
+    returns False when there was none (see ``site_processor`` and
+    ``zodb_processor``). At most ``workers`` reports are processed at
+    the same time. A worker without reports waits ``poll_interval``
+    seconds before it looks again.
+    """
+
+    def __init__(self, process, workers=2, poll_interval=1.0):
+        self.process = process
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stopped.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='mollie-report-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopped.isSet():
+            try:
+                processed = self.process()
+            except Exception:
+                logger.exception('Report worker failed.')
+                processed = False
+            if not processed:
+                self._stopped.wait(self.poll_interval)
+
+    def drain(self, timeout=None):
+        """Process reports in this thread until the queue is empty.
+
+        Return the number of processed reports.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        count = 0
+        while self.process():
+            count += 1
+            if timeout is not None and time.time() > deadline:
+                break
+        return count
@@ -0,0 +1,153 @@
+"""
+Compact, immutable result types for the answers of Mollie.
+
+The results use ``__slots__`` instead of an instance dict, so they are
+small and cheap to create. To keep code working which expects the
+dicts that were returned before, the results can also be accessed like
+a (read-only) dict: ``order['status']`` is the same as
+``order.status``.
+
+A field which is ``None`` counts as missing for the dict-like access,
+like a key which was not in the answer of Mollie.
+"""
+
+
+class _Result(object):
+    """Base class for the results."""
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self.__slots__):
+            raise TypeError('%s takes at most %d arguments' % (
+                self.__class__.__name__, len(self.__slots__)))
+        for name, value in zip(self.__slots__, args):
+            object.__setattr__(self, name, value)
+        for name in self.__slots__[len(args):]:
+            object.__setattr__(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('%s got unexpected arguments: %s' % (
+                self.__class__.__name__, ', '.join(kwargs)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (self.__class__, self._values())
+
+    def _values(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    # Dict-like access.
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return [name for name in self.__slots__
+                if getattr(self, name) is not None]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def as_dict(self):
+        """Return the result as a plain dict."""
+        result = {}
+        for key, value in self.items():
+            if isinstance(value, _Result):
+                value = value.as_dict()
+            result[key] = value
+        return result
+
+    def __eq__(self, other):
+        if isinstance(other, _Result):
+            return self.__class__ is other.__class__ and \
+                self._values() == other._values()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            ['%s=%r' % (key, value) for key, value in self.items()]))
+
+
+class Bank(tuple):
+    """A bank which supports iDeal.
+
+    This is a tuple of the bank ID and name, as was returned before.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, bank_id, bank_name):
+        return tuple.__new__(cls, (bank_id, bank_name))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    bank_id = property(lambda self: tuple.__getitem__(self, 0))
+    bank_name = property(lambda self: tuple.__getitem__(self, 1))
+
+    def __getitem__(self, key):
+        if key == 'bank_id':
+            return self.bank_id
+        if key == 'bank_name':
+            return self.bank_name
+        return tuple.__getitem__(self, key)
+
+    def __repr__(self):
+        return 'Bank(%r, %r)' % tuple(self)
+
+
+class Consumer(_Result):
+    """The consumer who paid."""
+
+    __slots__ = ('name', 'account', 'city')
+
+
+class PaymentOrder(_Result):
+    """A requested payment (the answer of a 'fetch')."""
+
+    __slots__ = ('transaction_id', 'amount', 'currency', 'URL', 'message')
+
+
+class CheckResult(_Result):
+    """The status of a payment (the answer of a 'check')."""
+
+    __slots__ = ('transaction_id', 'amount', 'currency', 'paid', 'status',
+                 'message', 'consumer')
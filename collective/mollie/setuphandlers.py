@@ -0,0 +1,17 @@
+from zope.component import queryUtility
+
+from collective.mollie.interfaces import IMollieTransactionIndex
+from collective.mollie.upgrades import backfill_index
+
+
+def index_stored_payments(context):
+    """Import step: add the payments stored before the profile was
+    installed to the transaction index."""
+    if context.readDataFile('collective.mollie_default.txt') is None:
+        return
+    index = queryUtility(IMollieTransactionIndex)
+    if index is None or index.complete:
+        return
+    # The import step runs in the transaction of the installation, so
+    # it does not commit itself.
+    backfill_index(index, context.getSite(), commit=False)
@@ -0,0 +1,80 @@
+"""
+Coalescing of concurrent identical calls.
+
+When a lot of threads need the same information at the same moment
+(for instance the list of banks right after a restart), there is no
+need to ask Mollie for it more than once. ``SingleFlight`` makes sure
+only one call for a key is in flight: other threads asking for the
+same key wait for that call and share its result.
+"""
+import sys
+import threading
+
+
+class _Call(object):
+    """A call in flight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Run a function at most once at a time for each key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {
+            'calls': 0,
+            'shared': 0,
+        }
+
+    def do(self, key, func, *args, **kwargs):
+        """Return the result of ``func(*args, **kwargs)``.
+
+        If a call for ``key`` is already in flight, wait for it and
+        return its result (or raise its exception) instead of calling
+        ``func`` again.
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            if call is not None:
+                self._counters['shared'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._counters['calls'] += 1
+                leader = True
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except:
+                call.exc_info = sys.exc_info()
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def stats(self):
+        """Return a dict with the number of calls and shared results."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+        finally:
+            self._lock.release()
+        return stats
@@ -0,0 +1,263 @@
+"""
+Persistent storage for the payments of the adapters.
+
+The ``MollieIdealMultiplePayments`` adapter stores its payments in an
+``OOBTree`` keyed by transaction ID. Each payment is a small
+persistent ``PaymentRecord``. Adding a payment only changes a single
+bucket of the tree, and updating the status of a payment only changes
+its record, so a context with thousands of payments does not get a
+huge pickle which is rewritten on each change.
+
+Mollie may report several payments at the same moment. Concurrent
+changes to the same record are merged by ``_p_resolveConflict``
+instead of raising a ``ConflictError``, so the report is not processed
+again (which would only get 'CheckedBefore' from Mollie).
+
+The times of a payment are stored as UTC epoch floats (in
+``last_update_time`` and ``last_checked_time``), which are a lot
+smaller and cheaper to compare than ``DateTime`` objects. The
+``last_update`` and ``last_checked`` properties still return a
+``DateTime``.
+"""
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from persistent import Persistent
+
+# The fields of a payment. Fields which have never been set are not
+# stored, the class attribute (None) is returned for them.
+PAYMENT_FIELDS = ('partner_id', 'profile_key', 'amount', 'last_update',
+                  'currency', 'status', 'paid', 'consumer', 'last_status',
+                  'last_checked')
+
+# The fields with a time, which are stored as an epoch float in the
+# attribute with the name in this mapping.
+TIME_FIELDS = {'last_update': 'last_update_time',
+               'last_checked': 'last_checked_time'}
+
+# Statuses of a payment which will never change anymore.
+FINAL_STATUSES = ('Success', 'Cancelled', 'Failure', 'Expired')
+
+# Fields which are stored together with the (final) status.
+STATUS_FIELDS = ('status', 'paid', 'consumer', 'currency')
+
+
+def as_timestamp(value):
+    """Return ``value`` (a ``DateTime``, a number or None) as epoch float."""
+    if value is None or isinstance(value, float):
+        return value
+    if isinstance(value, (int, long)):
+        return float(value)
+    return value.timeTime()
+
+
+def _update_time(state):
+    """Return the last update time of the state of a record, or None."""
+    value = state.get('last_update_time')
+    if value is None:
+        # Stored as a DateTime by an older version.
+        value = state.get('last_update')
+    return as_timestamp(value)
+
+
+def resolve_payment_conflict(old, saved, new):
+    """Return the merged state of a payment which was changed concurrently.
+
+    ``old`` is the state both transactions started from, ``saved`` the
+    state which was committed in the meantime and ``new`` the state of
+    the transaction which is being committed.
+
+    Fields changed by only one of the transactions are taken from that
+    transaction. For fields changed by both, the change with the latest
+    ``last_update`` wins. A final status (like 'Success') is never
+    replaced by a status which is not final.
+    """
+    saved_time = _update_time(saved)
+    new_time = _update_time(new)
+    if saved_time is not None and (new_time is None or saved_time > new_time):
+        latest = saved
+    else:
+        latest = new
+    merged = {}
+    for key in set(old) | set(saved) | set(new):
+        if saved.get(key) == old.get(key):
+            source = new
+        elif new.get(key) == old.get(key):
+            source = saved
+        else:
+            source = latest
+        if key in source:
+            merged[key] = source[key]
+    if merged.get('status') not in FINAL_STATUSES:
+        for state in (latest, saved, new):
+            if state.get('status') in FINAL_STATUSES:
+                for key in STATUS_FIELDS:
+                    if key in state:
+                        merged[key] = state[key]
+                    else:
+                        merged.pop(key, None)
+                break
+    return merged
+
+
+def _time_property(name):
+    """Return a property for a time field, which returns a ``DateTime``.
+
+    The time is stored as an epoch float. A ``DateTime`` stored in the
+    record by an older version is returned as is, until the record is
+    migrated or the time is changed.
+    """
+    time_name = TIME_FIELDS[name]
+
+    def get(self):
+        value = getattr(self, time_name)
+        if value is None:
+            self._p_activate()
+            return self.__dict__.get(name)
+        return DateTime(value)
+
+    def set(self, value):
+        setattr(self, time_name, as_timestamp(value))
+        self._p_activate()
+        if name in self.__dict__:
+            del self.__dict__[name]
+            self._p_changed = True
+
+    return property(get, set)
+
+
+class PaymentRecord(Persistent):
+    """The information about a single payment.
+
+    The record can be used like a dict (``record['status']``), as
+    the plain dicts which were stored before.
+    """
+
+    partner_id = None
+    profile_key = None
+    amount = None
+    currency = None
+    status = None
+    paid = None
+    consumer = None
+    last_status = None
+    last_update_time = None
+    last_checked_time = None
+
+    last_update = _time_property('last_update')
+    last_checked = _time_property('last_checked')
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return a record with the data of a payment stored as a dict."""
+        data = dict(data)
+        # Older versions stored the currency with a typo.
+        currency = data.pop('curreny', None)
+        if data.get('currency') is None:
+            data['currency'] = currency
+        if not data.get('consumer'):
+            data['consumer'] = None
+        return cls(**data)
+
+    def _check_key(self, key):
+        if not isinstance(key, basestring) or key.startswith('_'):
+            raise KeyError(key)
+
+    def keys(self):
+        self._p_activate()
+        extra = [key for key in self.__dict__
+                 if not key.startswith('_') and key not in PAYMENT_FIELDS
+                 and key not in TIME_FIELDS.values()]
+        return list(PAYMENT_FIELDS) + sorted(extra)
+
+    def __getitem__(self, key):
+        self._check_key(key)
+        if key not in PAYMENT_FIELDS and key not in TIME_FIELDS.values():
+            self._p_activate()
+            if key not in self.__dict__:
+                raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        self._check_key(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, data):
+        """Store the fields in ``data`` which have a different value.
+
+        Fields with the same value are not written, so the record is
+        not changed when nothing changed. Return the changed fields.
+        """
+        changed = []
+        for key, value in data.items():
+            if key not in self or self[key] != value:
+                self[key] = value
+                changed.append(key)
+        return changed
+
+    def timestamp(self, name):
+        """Return the time field ``name`` as epoch float (or None)."""
+        value = getattr(self, TIME_FIELDS[name])
+        if value is None:
+            value = as_timestamp(self[name])
+        return value
+
+    def migrate_timestamps(self):
+        """Convert times stored as ``DateTime`` to epoch floats.
+
+        Return True if the record has been changed.
+        """
+        self._p_activate()
+        changed = False
+        for name in TIME_FIELDS:
+            if name in self.__dict__:
+                setattr(self, name, self.__dict__[name])
+                changed = True
+        return changed
+
+    def as_dict(self):
+        """Return the payment as a plain dict."""
+        return dict(self.items())
+
+    def __repr__(self):
+        return '<PaymentRecord %r>' % self.as_dict()
+
+    def _p_resolveConflict(self, old, saved, new):
+        return resolve_payment_conflict(old, saved, new)
+
+
+def as_payment_record(data):
+    """Return ``data`` (a record or an old style dict) as a record."""
+    if isinstance(data, PaymentRecord):
+        return data
+    return PaymentRecord.from_dict(data)
+
+
+def as_payment_tree(payments):
+    """Return an ``OOBTree`` with ``PaymentRecord`` objects.
+
+    ``payments`` is an old style mapping of transaction IDs to dicts.
+    """
+    tree = OOBTree()
+    for transaction_id, data in payments.items():
+        tree[transaction_id] = as_payment_record(data)
+    return tree
@@ -1,9 +1,16 @@
 import os
+import shutil
+import tempfile
 
+import transaction
+from persistent import Persistent
 from plone.app.testing import PloneSandboxLayer
 from plone.app.testing import PLONE_FIXTURE
 from plone.app.testing import IntegrationTesting
+from plone.app.testing import applyProfile
 
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
 from zope.annotation import IAttributeAnnotatable
 from zope.configuration import xmlconfig
 from zope.interface import implements
@@ -21,6 +28,9 @@ class CollectiveMollie(PloneSandboxLayer):
         xmlconfig.file('browser.zcml', collective.mollie.tests,
                        context=configurationContext)
 
+    def setUpPloneSite(self, portal):
+        applyProfile(portal, 'collective.mollie:default')
+
 COLLECTIVE_MOLLIE_FIXTURE = CollectiveMollie()
 COLLECTIVE_MOLLIE_INTEGRATION_TESTING = IntegrationTesting(
     bases=(COLLECTIVE_MOLLIE_FIXTURE,), name="CollectiveMollie:Integration")
@@ -29,3 +39,90 @@ COLLECTIVE_MOLLIE_INTEGRATION_TESTING = IntegrationTesting(
 class Foo(object):
     """Annotatable object to test the MollieIdealPayment adapter."""
     implements(IAttributeAnnotatable)
+
+
+class TraversableFoo(Foo):
+    """Annotatable object which can be found by its path."""
+
+    def __init__(self, id):
+        self.id = id
+
+    def getPhysicalPath(self):
+        return ('', 'plone', self.id)
+
+
+class Site(object):
+    """Root object to find ``TraversableFoo`` objects by their path."""
+
+    isPrincipiaFolderish = True
+
+    def __init__(self):
+        self._objects = {}
+
+    def add(self, id):
+        obj = TraversableFoo(id)
+        self._objects[obj.getPhysicalPath()] = obj
+        return obj
+
+    def objectValues(self):
+        return self._objects.values()
+
+    def unrestrictedTraverse(self, path, default=None):
+        return self._objects.get(tuple(path), default)
+
+
+class PersistentFoo(Persistent):
+    """Persistent annotatable object, to test what is stored in the ZODB."""
+    implements(IAttributeAnnotatable)
+
+
+class StreamingResponse(object):
+    """Response which keeps what is written to it, like the Zope 2 one."""
+
+    def __init__(self):
+        self.headers = {}
+        self.written = []
+        self.status = 200
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+    def setStatus(self, status, reason=None):
+        self.status = status
+
+    def getStatus(self):
+        return self.status
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class StreamingRequest(object):
+    """Request with a ``StreamingResponse``."""
+
+    def __init__(self, form=None):
+        self.form = form or {}
+        self.response = StreamingResponse()
+
+
+class TemporaryDatabase(object):
+    """A database in a temporary directory, to test concurrent changes.
+
+    Each connection has its own transaction manager, so a single
+    thread can make conflicting changes. The storage (unlike a
+    ``MappingStorage``) resolves conflicts.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.directory, 'Data.fs')))
+
+    def open(self):
+        return self.db.open(transaction_manager=transaction.TransactionManager())
+
+    def close(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
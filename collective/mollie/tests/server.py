@@ -0,0 +1,144 @@
+"""
+A local stand-in for the Mollie API to test the network code against.
+"""
+import BaseHTTPServer
+import cgi
+import os
+import ssl
+import SocketServer
+import threading
+import time
+
+CURRENT_LOCATION = os.path.dirname(__file__)
+CERTFILE = os.path.join(CURRENT_LOCATION, 'certs', 'localhost.pem')
+
+# The response file for each Mollie action.
+RESPONSES = {
+    'banklist': 'banks.xml',
+    'fetch': 'request_payment_good.xml',
+    'check': 'payment_success.xml',
+}
+
+
+def get_response(filename):
+    """Return the XML stored in ``filename``."""
+    fp = open(os.path.join(CURRENT_LOCATION, 'responses', filename), 'r')
+    content = fp.read()
+    fp.close()
+    return content
+
+
+class MollieRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer Mollie API calls with the XML files in ``responses``."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        form = cgi.parse_qs(self.rfile.read(length))
+        data = dict((key, value[0]) for key, value in form.items())
+        server = self.server
+        server.log_request(self.client_address, data)
+        server.enter()
+        try:
+            if server.delay:
+                time.sleep(server.delay)
+        finally:
+            server.leave()
+        body = get_response(
+            server.responses.get(data.get('a'), 'error_14.xml'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if server.chunked:
+            # Send the answer in chunks, without telling its size.
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 100):
+                chunk = body[start:start + 100]
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        if server.drop_connections:
+            # Close the connection without telling the client, like a
+            # server does when a keep-alive connection times out.
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MollieStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTPS server which pretends to be Mollie.
+
+    The server is started in a separate thread on a random port on
+    localhost. Each request is logged in ``requests`` and the client
+    address of each request in ``connections``.
+    """
+
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, use_ssl=True):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('localhost', 0), MollieRequestHandler)
+        if use_ssl:
+            self.socket = ssl.wrap_socket(
+                self.socket, certfile=CERTFILE, server_side=True)
+        self.port = self.server_address[1]
+        self.responses = dict(RESPONSES)
+        self.drop_connections = False
+        # Send the answers with chunked transfer encoding.
+        self.chunked = False
+        # Number of seconds to wait before answering a request.
+        self.delay = 0
+        self.requests = []
+        self.connections = []
+        # Number of requests being handled and the maximum of that.
+        self.active = 0
+        self.max_active = 0
+        self._log_lock = threading.Lock()
+
+    def log_request(self, client_address, data):
+        self._log_lock.acquire()
+        try:
+            self.requests.append(data)
+            if client_address not in self.connections:
+                self.connections.append(client_address)
+        finally:
+            self._log_lock.release()
+
+    def enter(self):
+        self._log_lock.acquire()
+        try:
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        finally:
+            self._log_lock.release()
+
+    def leave(self):
+        self._log_lock.acquire()
+        try:
+            self.active -= 1
+        finally:
+            self._log_lock.release()
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections are expected.
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def client_ssl_context():
+    """Return an SSL context which trusts the stand-in's certificate."""
+    return ssl.create_default_context(cafile=CERTFILE)
@@ -1,23 +1,77 @@
+import json
 import os
+import sys
+import time
+import transaction
 import unittest2 as unittest
 
+from BTrees.OOBTree import OOBTree
+from cStringIO import StringIO
+from DateTime import DateTime
 from mock import MagicMock
+from mock import patch
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.POSException import ConflictError
+from ZODB.MappingStorage import MappingStorage
+from zope.annotation import IAnnotations
 
 from zope.component import eventtesting
 from zope.component import getMultiAdapter
+from zope.component import getGlobalSiteManager
 from zope.component import getUtility
+from zope.component import provideUtility
 from zope.publisher.browser import TestRequest
 
 from collective.mollie.adapter import MollieIdealMultiplePayments
 from collective.mollie.adapter import MollieIdealPayment
 from collective.mollie.adapter import UnknownTransactionError
+from collective.mollie.adapter import migrate_multiple_payments
+from collective.mollie.archive import archive_payments
+from collective.mollie.browser.export import ExportView
+from collective.mollie.checkstore import CheckResultStore
+from collective.mollie.events import PaymentCancelled
+from collective.mollie.events import PaymentPaid
+from collective.mollie.events import PaymentStatusChanged
+from collective.mollie.events import PaymentStatusUnchanged
+from collective.mollie.config import IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY
+from collective.mollie.config import \
+    IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY
+from collective.mollie.config import IDEAL_PAYMENT_ANNOTATION_KEY
 from collective.mollie.ideal import MollieAPIError
 from collective.mollie.interfaces import IMollieIdeal
 from collective.mollie.interfaces import IMollieIdealMultiplePayments
 from collective.mollie.interfaces import IMollieIdealPayment
 from collective.mollie.interfaces import IMollieIdealPaymentEvent
+from collective.mollie.interfaces import IMolliePaymentPaidEvent
+from collective.mollie.interfaces import IMolliePaymentStatusEvent
+from collective.mollie.interfaces import IMollieCheckResultStore
+from collective.mollie.interfaces import IMollieReportPreCheck
+from collective.mollie.interfaces import IMollieReportQueue
+from collective.mollie.interfaces import IMollieTransactionIndex
+from collective.mollie.index import TransactionIndex
+from collective.mollie.precheck import ReportPreCheck
+from collective.mollie.reconcile import reconcile_command
+from collective.mollie.reconcile import reconcile_payments
+from collective.mollie.reports import CONFLICT_RETRIES
+from collective.mollie.reports import LocalReportQueue
+from collective.mollie.reports import ReportQueue
+from collective.mollie.reports import ReportWorkers
+from collective.mollie.reports import process_report
+from collective.mollie.reports import site_processor
+from collective.mollie.storage import PaymentRecord
 from collective.mollie.testing import COLLECTIVE_MOLLIE_INTEGRATION_TESTING
 from collective.mollie.testing import Foo
+from collective.mollie.testing import PersistentFoo
+from collective.mollie.testing import Site
+from collective.mollie.testing import StreamingRequest
+from collective.mollie.testing import TemporaryDatabase
+from collective.mollie.upgrades import backfill_index
+from collective.mollie.upgrades import find_payments
+from collective.mollie.upgrades import migrate_indexed_payments
+from collective.mollie.upgrades import reindex_payments
+from collective.mollie.upgrades import upgrade_payment_indexes
+from collective.mollie.upgrades import upgrade_timestamps
 
 
 def mock_do_request(filename):
@@ -39,6 +93,7 @@ class TestIdealWrapper(unittest.TestCase):
     def setUp(self):
         self.ideal = getUtility(IMollieIdeal)
         self.ideal.old_do_request = self.ideal._do_request
+        self.ideal.clear_banks_cache()
         self.partner_id = '999999'
         self.bank_id = '9999'
         self.amount = '123'  # 1.23 Euro
@@ -69,6 +124,77 @@ class TestIdealWrapper(unittest.TestCase):
         banks = self.ideal.get_banks()
         self.assertTrue(('0021', 'Rabobank') in banks)
 
+    def test_banklist_cached(self):
+        """Check the list of banks is only requested once."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('banks.xml')
+        self.ideal._do_request = MagicMock(
+            side_effect=side_effect)
+        banks = self.ideal.get_banks()
+        self.assertEqual(self.ideal.get_banks(), banks)
+        self.assertEqual(self.ideal._do_request.call_count, 1)
+
+    def test_banklist_cached_per_mode(self):
+        """Check the list of test banks is cached separately."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('banks.xml')
+        self.ideal._do_request = MagicMock(
+            side_effect=side_effect)
+        self.ideal.get_banks()
+        self.ideal.TESTMODE = True
+        try:
+            self.ideal.get_banks()
+        finally:
+            self.ideal.TESTMODE = False
+        self.assertEqual(self.ideal._do_request.call_count, 2)
+        self.ideal._do_request.assert_called_with(
+            {'a': 'banklist', 'testmode': 'true'})
+
+    def test_banklist_stale(self):
+        """Check an expired list is returned while it is refreshed."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('banks.xml')
+        self.ideal._do_request = MagicMock(
+            side_effect=side_effect)
+        stale_banks = [('0721', 'Postbank')]
+        self.ideal._banks_cache[False] = (0, stale_banks)
+        self.assertEqual(self.ideal.get_banks(), stale_banks)
+        refresh = self.ideal._banks_refreshing.get(False)
+        if refresh is not None:
+            refresh.join()
+        self.assertEqual(self.ideal._do_request.call_count, 1)
+        banks = self.ideal.get_banks()
+        self.assertTrue(('0021', 'Rabobank') in banks)
+        self.assertEqual(self.ideal._do_request.call_count, 1)
+
+    def test_banklist_stale_refresh_error(self):
+        """Check the expired list is kept when refreshing fails."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('error_14.xml')
+        self.ideal._do_request = MagicMock(
+            side_effect=side_effect)
+        stale_banks = [('0721', 'Postbank')]
+        self.ideal._banks_cache[False] = (0, stale_banks)
+        self.ideal.get_banks()
+        refresh = self.ideal._banks_refreshing.get(False)
+        if refresh is not None:
+            refresh.join()
+        self.assertEqual(self.ideal.get_banks(), stale_banks)
+
+    def test_banklist_cache_disabled(self):
+        """Check the cache can be disabled."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('banks.xml')
+        self.ideal._do_request = MagicMock(
+            side_effect=side_effect)
+        self.ideal.BANKS_CACHE_TTL = 0
+        try:
+            self.ideal.get_banks()
+            self.ideal.get_banks()
+        finally:
+            del self.ideal.BANKS_CACHE_TTL
+        self.assertEqual(self.ideal._do_request.call_count, 2)
+
     def test_basic_payment_request_request(self):
         """Make sure we send the right parameters to Mollie"""
         def side_effect(*args, **kwargs):
@@ -220,6 +346,7 @@ class TestPaymentAdapter(unittest.TestCase):
         self.adapted = IMollieIdealPayment(self.foo)
         self.adapted.ideal_wrapper.old_do_request = \
             self.adapted.ideal_wrapper._do_request
+        self.adapted.ideal_wrapper.clear_banks_cache()
         self.partner_id = '999999'
         self.bank_id = '9999'
         self.amount = '123'  # 1.23 Euro
@@ -332,6 +459,157 @@ class TestPaymentAdapter(unittest.TestCase):
         self.assertEqual(self.adapted.status, 'Success')
         self.assertEqual(self.adapted.last_status, 'CheckedBefore')
 
+    def test_migration(self):
+        """Check a payment stored by an older version is migrated."""
+        foo = Foo()
+        IAnnotations(foo)[IDEAL_PAYMENT_ANNOTATION_KEY] = PersistentMapping(
+            {'transaction_id': self.transaction_id, 'paid': True,
+             'status': 'Success', 'consumer': {'name': 'T. TEST'}})
+        adapted = IMollieIdealPayment(foo)
+        self.assertEqual(adapted.transaction_id, self.transaction_id)
+        self.assertTrue(adapted.paid)
+        self.assertEqual(adapted.consumer, {'name': 'T. TEST'})
+        # Reading does not migrate the payment, writing does.
+        self.assertTrue(isinstance(
+            IAnnotations(foo)[IDEAL_PAYMENT_ANNOTATION_KEY],
+            PersistentMapping))
+        adapted.last_status = 'CheckedBefore'
+        self.assertTrue(isinstance(adapted._metadata, PaymentRecord))
+        self.assertTrue(adapted.paid)
+
+    def test_no_changes_written(self):
+        """Check a check without changes does not change the payment."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('payment_checked_before.xml')
+        self.adapted.ideal_wrapper._do_request = MagicMock(
+            side_effect=side_effect)
+        db = DB(MappingStorage())
+        connection = db.open()
+        try:
+            root = connection.root()
+            root['foo'] = PersistentFoo()
+            adapted = IMollieIdealPayment(root['foo'])
+            adapted._partner_id = self.partner_id
+            adapted.transaction_id = self.transaction_id
+            adapted.get_payment_status()
+            last_update = adapted.last_update
+            self.assertEqual(adapted.last_checked, last_update)
+            transaction.commit()
+            self.assertEqual(adapted.get_payment_status(), 'CheckedBefore')
+            self.assertEqual(connection._registered_objects, [])
+            self.assertEqual(adapted.last_update, last_update)
+            self.assertEqual(adapted.last_checked, last_update)
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def test_last_checked(self):
+        """Check the time of the last check is stored now and then."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('payment_checked_before.xml')
+        self.adapted.ideal_wrapper._do_request = MagicMock(
+            side_effect=side_effect)
+        self.adapted.get_payment_status()
+        last_update = self.adapted.last_update
+        self.adapted.LAST_CHECKED_INTERVAL = 0
+        self.adapted.get_payment_status()
+        self.assertEqual(self.adapted.last_update, last_update)
+        self.assertTrue(self.adapted.last_checked > last_update)
+        last_checked = self.adapted.last_checked
+        self.adapted.LAST_CHECKED_INTERVAL = None
+        self.adapted.get_payment_status()
+        self.assertEqual(self.adapted.last_checked, last_checked)
+
+    def test_no_storage_on_adapt(self):
+        """Check adapting and reading do not store anything."""
+        foo = Foo()
+        adapted = IMollieIdealPayment(foo)
+        self.assertEqual(adapted.transaction_id, None)
+        self.assertEqual(adapted.paid, None)
+        self.assertFalse(hasattr(foo, '__annotations__'))
+        adapted.transaction_id = self.transaction_id
+        self.assertEqual(
+            IAnnotations(foo)[IDEAL_PAYMENT_ANNOTATION_KEY].transaction_id,
+            self.transaction_id)
+
+    def test_reads_do_not_change_object(self):
+        """Check reading the payment does not change a persistent object."""
+        db = DB(MappingStorage())
+        connection = db.open()
+        try:
+            root = connection.root()
+            root['empty'] = PersistentFoo()
+            root['foo'] = PersistentFoo()
+            IMollieIdealPayment(root['foo']).transaction_id = \
+                self.transaction_id
+            transaction.commit()
+            for name in ['empty', 'foo']:
+                adapted = IMollieIdealPayment(root[name])
+                adapted.transaction_id
+                adapted.paid
+                adapted.status
+                adapted.consumer
+                request = TestRequest(form=dict(transaction_id='deadbeef'))
+                view = getMultiAdapter((root[name], request),
+                                       name='report_payment_status')
+                self.assertEqual(view(), 'Wrong or missing transaction ID')
+                self.assertFalse(root[name]._p_changed)
+            self.assertFalse(IAnnotations(root['foo'])[
+                IDEAL_PAYMENT_ANNOTATION_KEY]._p_changed)
+            self.assertEqual(connection._registered_objects, [])
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def test_concurrent_reports(self):
+        """Check concurrent status updates do not conflict."""
+        def side_effect(*args, **kwargs):
+            return mock_do_request('request_payment_good.xml')
+        self.adapted.ideal_wrapper._do_request = MagicMock(
+            side_effect=side_effect)
+        database = TemporaryDatabase()
+        try:
+            connection = database.open()
+            connection.root()['foo'] = PersistentFoo()
+            IMollieIdealPayment(connection.root()['foo']).get_payment_url(
+                self.partner_id, self.bank_id, self.amount, self.message,
+                self.report_url, self.return_url)
+            connection.transaction_manager.commit()
+
+            # Mollie reports the payment twice at the same moment. The
+            # first report gets the final status.
+            connection1 = database.open()
+            connection2 = database.open()
+
+            def side_effect2(*args, **kwargs):
+                return mock_do_request('payment_success.xml')
+            self.adapted.ideal_wrapper._do_request = MagicMock(
+                side_effect=side_effect2)
+            IMollieIdealPayment(
+                connection1.root()['foo']).get_payment_status()
+
+            def side_effect3(*args, **kwargs):
+                return mock_do_request('payment_open.xml')
+            self.adapted.ideal_wrapper._do_request = MagicMock(
+                side_effect=side_effect3)
+            IMollieIdealPayment(
+                connection2.root()['foo']).get_payment_status()
+
+            connection1.transaction_manager.commit()
+            connection2.transaction_manager.commit()
+
+            connection.sync()
+            adapted = IMollieIdealPayment(connection.root()['foo'])
+            self.assertEqual(adapted.status, 'Success')
+            self.assertTrue(adapted.paid)
+            self.assertEqual(adapted.consumer['name'], 'T. TEST')
+            self.assertEqual(adapted.last_status, 'Open')
+            self.assertEqual(adapted.amount, self.amount)
+        finally:
+            database.close()
+
 
 class TestMultiplePaymentsAdapter(unittest.TestCase):
     """Test the Mollie iDeal Multiple Payments adapter."""
@@ -343,6 +621,7 @@ class TestMultiplePaymentsAdapter(unittest.TestCase):
         self.adapted = IMollieIdealMultiplePayments(self.foo)
         self.adapted.ideal_wrapper.old_do_request = \
             self.adapted.ideal_wrapper._do_request
+        self.adapted.ideal_wrapper.clear_banks_cache()
         self.partner_id = '999999'
         self.bank_id = '9999'
         self.amount = '123'  # 1.23 Euro
@@ -516,6 +795,362 @@ class TestMultiplePaymentsAdapter(unittest.TestCase):
         self.assertEqual(result2, 'Cancelled')
         self.assertFalse(transaction2['paid'])
 
+    def request_payment(self):
+        def side_effect(*args, **kwargs):
+            return mock_do_request('request_payment_good.xml')
+        self.adapted.ideal_wrapper._do_request = MagicMock(
+            side_effect=side_effect)
+        transaction_id, url = self.adapted.get_payment_url(
+            self.partner_id, self.bank_id, self.amount, self.message,
+            self.report_url, self.return_url)
+        return transaction_id
+
+    def check_payment(self, filename='payment_success.xml'):
+        def side_effect(*args, **kwargs):
+            return mock_do_request(filename)
+        self.adapted.ideal_wrapper._do_request = MagicMock(
+            side_effect=side_effect)
+        return self.adapted.get_payment_status(self.transaction_id)
+
+    def test_storage(self):
+        """Check the payments are stored as records in a BTree."""
+        self.request_payment()
+        self.assertTrue(isinstance(self.adapted._metadata, OOBTree))
+        record = self.adapted._metadata[self.transaction_id]
+        self.assertTrue(isinstance(record, PaymentRecord))
+        self.assertTrue(record is
+                        self.adapted.get_transaction(self.transaction_id))
+        self.assertEqual(record['currency'], None)
+        self.assertEqual(record['consumer'], None)
+        self.check_payment()
+        self.assertEqual(record['currency'], 'EUR')
+        self.assertEqual(record.status, 'Success')
+        self.assertEqual(record.as_dict()['consumer']['city'], 'Testdorp')
+
+    def test_dict_converted(self):
+        """Check a payment stored as a dict is converted to a record."""
+        self.adapted._metadata[self.transaction_id] = {
+            'partner_id': self.partner_id,
+            'extra': 'Extra information',
+            }
+        transaction = self.adapted.get_transaction(self.transaction_id)
+        self.assertTrue(isinstance(transaction, PaymentRecord))
+        self.assertEqual(transaction['partner_id'], self.partner_id)
+        self.assertEqual(transaction['extra'], 'Extra information')
+        # Reading the transaction does not store the record.
+        self.assertTrue(isinstance(
+            self.adapted._metadata[self.transaction_id], dict))
+        self.check_payment()
+        transaction = self.adapted._metadata[self.transaction_id]
+        self.assertTrue(isinstance(transaction, PaymentRecord))
+        self.assertEqual(transaction['extra'], 'Extra information')
+        self.assertEqual(transaction['status'], 'Success')
+
+    def test_migration(self):
+        """Check payments stored by older versions are migrated."""
+        foo = Foo()
+        annotations = IAnnotations(foo)
+        annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
+            PersistentMapping({self.transaction_id: {
+                'partner_id': self.partner_id,
+                'amount': self.amount,
+                'curreny': None,
+                'currency': 'EUR',
+                'status': 'Success',
+                'paid': True,
+                'consumer': {'name': 'T. TEST'},
+                'last_status': 'CheckedBefore',
+                }})
+        self.assertTrue(migrate_multiple_payments(foo))
+        self.assertFalse(migrate_multiple_payments(foo))
+        payments = annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY]
+        self.assertTrue(isinstance(payments, OOBTree))
+        transaction = IMollieIdealMultiplePayments(foo).get_transaction(
+            self.transaction_id)
+        self.assertTrue(isinstance(transaction, PaymentRecord))
+        self.assertEqual(transaction['currency'], 'EUR')
+        self.assertTrue(transaction['paid'])
+        self.assertEqual(transaction['consumer'], {'name': 'T. TEST'})
+        self.assertFalse('curreny' in transaction)
+
+    def test_migration_on_write(self):
+        """Check the adapter migrates the payments of older versions."""
+        foo = Foo()
+        annotations = IAnnotations(foo)
+        annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
+            PersistentMapping({self.transaction_id: {
+                'partner_id': self.partner_id, 'consumer': {}}})
+        adapted = self.adapted = IMollieIdealMultiplePayments(foo)
+        self.assertEqual(
+            adapted.get_transaction(self.transaction_id)['consumer'], None)
+        self.assertTrue(isinstance(
+            annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY],
+            PersistentMapping))
+        self.check_payment()
+        self.assertTrue(isinstance(
+            annotations[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY], OOBTree))
+
+    def test_status_update_changes_record_only(self):
+        """Check updating a payment only writes its record."""
+        db = DB(MappingStorage())
+        connection = db.open()
+        try:
+            root = connection.root()
+            root['foo'] = PersistentFoo()
+            self.adapted = IMollieIdealMultiplePayments(root['foo'])
+            self.request_payment()
+            transaction.commit()
+            self.check_payment()
+            record = self.adapted._metadata[self.transaction_id]
+            self.assertTrue(record._p_changed)
+            self.assertFalse(self.adapted._metadata._p_changed)
+            self.assertFalse(root['foo']._p_changed)
+            transaction.commit()
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def test_no_changes_written(self):
+        """Check repeated reports do not change the payment."""
+        db = DB(MappingStorage())
+        connection = db.open()
+        try:
+            root = connection.root()
+            root['foo'] = PersistentFoo()
+            self.adapted = IMollieIdealMultiplePayments(root['foo'])
+            self.request_payment()
+            self.check_payment()
+            transaction.commit()
+            payment = self.adapted.get_transaction(self.transaction_id)
+            last_update = payment['last_update']
+            # The first 'CheckedBefore' is stored in last_status.
+            self.check_payment('payment_checked_before.xml')
+            self.assertTrue(payment._p_changed)
+            self.assertTrue(payment['last_update'] > last_update)
+            transaction.commit()
+            last_update = payment['last_update']
+            for i in range(3):
+                self.check_payment('payment_checked_before.xml')
+            self.assertEqual(connection._registered_objects, [])
+            self.assertEqual(payment['last_update'], last_update)
+            self.assertEqual(payment['status'], 'Success')
+            # The heartbeat is written once the interval has passed.
+            self.adapted.LAST_CHECKED_INTERVAL = 0
+            self.check_payment('payment_checked_before.xml')
+            self.assertTrue(payment._p_changed)
+            self.assertTrue(payment['last_checked'] > last_update)
+            self.assertEqual(payment['last_update'], last_update)
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def test_reads_do_not_change_object(self):
+        """Check reading payments does not change a persistent object."""
+        db = DB(MappingStorage())
+        connection = db.open()
+        try:
+            root = connection.root()
+            root['empty'] = PersistentFoo()
+            root['foo'] = PersistentFoo()
+            self.adapted = IMollieIdealMultiplePayments(root['foo'])
+            self.request_payment()
+            transaction.commit()
+            for name in ['empty', 'foo']:
+                adapted = IMollieIdealMultiplePayments(root[name])
+                self.assertRaises(UnknownTransactionError,
+                                  adapted.get_transaction, 'deadbeef')
+                request = TestRequest(form=dict(transaction_id='deadbeef'))
+                view = getMultiAdapter((root[name], request),
+                                       name='report_multiple_payment_status')
+                self.assertEqual(view(), 'Wrong or missing transaction ID')
+                self.assertFalse(root[name]._p_changed)
+            adapted.get_transaction(self.transaction_id)['status']
+            self.assertEqual(connection._registered_objects, [])
+            self.assertFalse(hasattr(root['empty'], '__annotations__'))
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def add_payments(self, count):
+        """Return an adapter for a new object with ``count`` payments.
+
+        The transaction IDs are 'tid00', 'tid01', etc. in order of
+        their last update.
+        """
+        adapted = IMollieIdealMultiplePayments(Foo())
+        adapted.ideal_wrapper = MagicMock()
+        for i in range(count):
+            adapted.ideal_wrapper.request_payment.return_value = (
+                'tid%02d' % i, 'http://example.com/pay')
+            adapted.get_payment_url(self.partner_id, self.bank_id,
+                self.amount, self.message, self.report_url, self.return_url)
+        return adapted
+
+    def test_iter_transactions(self):
+        """Check iterating over the transactions in a range."""
+        adapted = self.add_payments(5)
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions()]
+        self.assertEqual(ids, ['tid00', 'tid01', 'tid02', 'tid03', 'tid04'])
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(min='tid01', max='tid03')]
+        self.assertEqual(ids, ['tid01', 'tid02', 'tid03'])
+        transaction_id, payment = adapted.iter_transactions().next()
+        self.assertTrue(isinstance(payment, PaymentRecord))
+        self.assertEqual(payment['amount'], self.amount)
+        empty = IMollieIdealMultiplePayments(Foo())
+        self.assertEqual(list(empty.iter_transactions()), [])
+
+    def test_transaction_pages(self):
+        """Check paging through the transactions with a cursor."""
+        adapted = self.add_payments(10)
+        for order in ['transaction_id', 'last_update']:
+            ids = []
+            cursor = None
+            sizes = []
+            while True:
+                page, cursor = adapted.get_transactions_page(
+                    size=4, cursor=cursor, order=order)
+                sizes.append(len(page))
+                ids.extend(transaction_id for transaction_id, payment in page)
+                if cursor is None:
+                    break
+            self.assertEqual(sizes, [4, 4, 2])
+            self.assertEqual(ids, ['tid%02d' % i for i in range(10)])
+        page, cursor = adapted.get_transactions_page(size=10)
+        self.assertEqual(len(page), 10)
+        self.assertEqual(cursor, None)
+
+    def test_order_by_last_update(self):
+        """Check iterating over the transactions by their last update."""
+        adapted = self.add_payments(5)
+        adapted.ideal_wrapper.check_payment.return_value = {
+            'status': 'Success', 'currency': 'EUR', 'paid': True}
+        start = time.time()
+        adapted.get_payment_status('tid01')
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(order='last_update')]
+        self.assertEqual(ids, ['tid00', 'tid02', 'tid03', 'tid04', 'tid01'])
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(order='last_update', min=start)]
+        self.assertEqual(ids, ['tid01'])
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(order='last_update', max=start)]
+        self.assertEqual(ids, ['tid00', 'tid02', 'tid03', 'tid04'])
+        self.assertRaises(ValueError, list,
+                          adapted.iter_transactions(order='amount'))
+
+    def test_archive_transactions(self):
+        """Check old final payments are moved to the archive."""
+        adapted = self.add_payments(4)
+        for transaction_id, status in [('tid00', 'Success'),
+                                       ('tid01', 'Open'),
+                                       ('tid02', 'Cancelled')]:
+            adapted.ideal_wrapper.check_payment.return_value = {
+                'status': status, 'currency': 'EUR',
+                'paid': status == 'Success'}
+            adapted.get_payment_status(transaction_id)
+        now = time.time()
+        self.assertEqual(adapted.archive_transactions(3600, now), [])
+        self.assertEqual(adapted.archive_transactions(1800, now + 3600),
+                         ['tid00', 'tid02'])
+        self.assertEqual(list(adapted._metadata.keys()), ['tid01', 'tid03'])
+        archive = IAnnotations(adapted.context)[
+            IDEAL_MULTIPLE_PAYMENTS_ARCHIVE_ANNOTATION_KEY]
+        self.assertEqual(list(archive.keys()), ['tid00', 'tid02'])
+        # Archived payments are still found.
+        self.assertTrue(adapted.get_transaction('tid00')['paid'])
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions()]
+        self.assertEqual(ids, ['tid00', 'tid01', 'tid02', 'tid03'])
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(order='last_update')]
+        self.assertEqual(ids, ['tid03', 'tid00', 'tid01', 'tid02'])
+        adapted.ideal_wrapper.check_payment.return_value = {
+            'status': 'CheckedBefore'}
+        self.assertEqual(adapted.get_payment_status('tid02'),
+                         'CheckedBefore')
+        self.assertFalse(adapted.archive_transaction('tid02'))
+
+    def test_archive_prunes_order(self):
+        """Check archiving removes the earlier updates from the order."""
+        adapted = self.add_payments(3)
+        adapted.ideal_wrapper.check_payment.return_value = {
+            'status': 'Open', 'currency': 'EUR', 'paid': False}
+        adapted.get_payment_status('tid00')
+        adapted.ideal_wrapper.check_payment.return_value = {
+            'status': 'Success', 'currency': 'EUR', 'paid': True}
+        adapted.get_payment_status('tid00')
+        adapted.get_payment_status('tid01')
+        order = adapted._order()
+        self.assertEqual(len(order), 6)
+        self.assertEqual(adapted.archive_transactions(
+            1800, time.time() + 3600), ['tid00', 'tid01'])
+        self.assertEqual(len(order), 3)
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions(order='last_update')]
+        self.assertEqual(ids, ['tid02', 'tid00', 'tid01'])
+
+    def test_iterate_old_storage(self):
+        """Check payments stored by older versions can be iterated."""
+        foo = Foo()
+        IAnnotations(foo)[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY] = \
+            PersistentMapping({'tid02': {'amount': '1', 'last_update': 2},
+                               'tid01': {'amount': '2', 'last_update': 3}})
+        adapted = IMollieIdealMultiplePayments(foo)
+        ids = [transaction_id for transaction_id, payment
+               in adapted.iter_transactions()]
+        self.assertEqual(ids, ['tid01', 'tid02'])
+        page, cursor = adapted.get_transactions_page(size=1,
+                                                     order='last_update')
+        self.assertEqual(page[0][0], 'tid02')
+        page, cursor = adapted.get_transactions_page(size=1, cursor=cursor,
+                                                     order='last_update')
+        self.assertEqual(page[0][0], 'tid01')
+        self.assertEqual(cursor, None)
+        # Nothing has been migrated.
+        self.assertTrue(isinstance(
+            IAnnotations(foo)[IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY],
+            PersistentMapping))
+
+    def test_concurrent_reports(self):
+        """Check concurrent reports for payments do not conflict."""
+        database = TemporaryDatabase()
+        try:
+            connection = database.open()
+            connection.root()['foo'] = PersistentFoo()
+            self.adapted = IMollieIdealMultiplePayments(
+                connection.root()['foo'])
+            self.request_payment()
+            self.adapted._metadata['other'] = PaymentRecord(
+                partner_id=self.partner_id)
+            connection.transaction_manager.commit()
+
+            connections = [database.open() for i in range(3)]
+            # Two reports for the same payment and one for another.
+            for conn, transaction_id in zip(
+                    connections, [self.transaction_id, self.transaction_id,
+                                  'other']):
+                self.adapted = IMollieIdealMultiplePayments(
+                    conn.root()['foo'])
+                self.transaction_id = transaction_id
+                self.check_payment()
+            for conn in connections:
+                conn.transaction_manager.commit()
+
+            connection.sync()
+            adapted = IMollieIdealMultiplePayments(connection.root()['foo'])
+            for transaction_id in ['482d599bbcc7795727650330ad65fe9b',
+                                   'other']:
+                payment = adapted.get_transaction(transaction_id)
+                self.assertEqual(payment['status'], 'Success')
+                self.assertTrue(payment['paid'])
+        finally:
+            database.close()
+
 
 class TestReportSinglePaymentView(unittest.TestCase):
     """Test the report view where Mollie reports a payment.
@@ -702,6 +1337,1090 @@ class TestReportMultiplePaymentView(unittest.TestCase):
         self.assertEqual(event.transaction_id, self.transaction_id)
 
 
+class TestTransactionIndex(unittest.TestCase):
+    """Test the site wide index of transactions."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def _side_effect(*args, **kwargs):
+        return mock_do_request('request_payment_good.xml')
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            side_effect=self._side_effect)
+        self.index = getUtility(IMollieTransactionIndex)
+        self.old_archived_until = self.index.archived_until
+        self.site = Site()
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+
+    def tearDown(self):
+        self.ideal._do_request = self.ideal.old_do_request
+        self.index.unindex_transaction(self.transaction_id)
+        self.index.archived_until = self.old_archived_until
+
+    def request_payment(self, adapted):
+        return adapted.get_payment_url('999999', '9999', '123',
+                                       'Testing payment',
+                                       'http://example.com/report',
+                                       'http://example.com/return')
+
+    def test_single_payment_indexed(self):
+        """Check requesting a payment adds it to the index."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        self.assertTrue(self.transaction_id in self.index)
+        self.assertEqual(self.index.get(self.transaction_id),
+                         (('', 'plone', 'foo'), None, False))
+        self.assertTrue(self.index.resolve(self.transaction_id, self.site)
+                        is foo)
+
+    def test_multiple_payments_indexed(self):
+        """Check payments on objects with multiple payments are indexed."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealMultiplePayments(foo))
+        path, uid, multiple = self.index.get(self.transaction_id)
+        self.assertTrue(multiple)
+        self.assertTrue(self.index.resolve(self.transaction_id, self.site)
+                        is foo)
+
+    def test_length(self):
+        """Check the number of transactions is kept."""
+        length = len(self.index)
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        self.assertEqual(len(self.index), length + 1)
+        # Indexing the same transaction again does not count.
+        self.index.index_transaction(self.transaction_id, foo)
+        self.assertEqual(len(self.index), length + 1)
+        self.index.unindex_transaction(self.transaction_id)
+        self.assertEqual(len(self.index), length)
+        self.assertFalse(self.transaction_id in self.index)
+
+    def test_unknown_transaction(self):
+        """Check unknown transactions are not resolved."""
+        self.assertEqual(self.index.get('deadbeef'), None)
+        self.assertEqual(self.index.resolve('deadbeef', self.site), None)
+        self.assertEqual(self.index.resolve(None, self.site), None)
+        self.assertFalse(None in self.index)
+
+    def test_removed_object(self):
+        """Check a transaction of a removed object is not resolved."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        self.assertEqual(self.index.resolve(self.transaction_id, Site()),
+                         None)
+
+    def test_object_without_path(self):
+        """Check objects which cannot be found again are not indexed."""
+        self.request_payment(IMollieIdealPayment(Foo()))
+        self.assertFalse(self.transaction_id in self.index)
+
+    def test_migrate_timestamps(self):
+        """Check the times stored by older versions are migrated."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        self.request_payment(adapted)
+        record = adapted.get_transaction(self.transaction_id)
+        last_update = record.last_update
+        del record.last_update_time
+        record.__dict__['last_update'] = last_update
+        self.assertEqual(migrate_indexed_payments(
+            self.index, self.site, commit=False), 1)
+        self.assertEqual(record.last_update_time, last_update.timeTime())
+        self.assertEqual(record['last_update'], last_update)
+        # Migrated objects are left alone.
+        self.assertEqual(migrate_indexed_payments(
+            self.index, self.site, commit=False), 0)
+
+    def test_payment_status_indexed(self):
+        """Check the status of a payment is indexed when it changes."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        self.request_payment(adapted)
+        now = time.time()
+        self.assertEqual(list(self.index.query(updated_min=now - 60)),
+                         [self.transaction_id])
+        self.assertEqual(list(self.index.query(status='Success')), [])
+        self.ideal._do_request = MagicMock(
+            return_value=mock_do_request('payment_success.xml'))
+        adapted.get_payment_status(self.transaction_id)
+        self.assertEqual(list(self.index.query(status='Success')),
+                         [self.transaction_id])
+        self.assertEqual(list(self.index.query(paid=True)),
+                         [self.transaction_id])
+        self.assertEqual(list(self.index.query(paid=False)), [])
+        self.assertEqual(list(self.index.query(
+            status='Success', updated_max=now - 3600)), [])
+        self.index.unindex_transaction(self.transaction_id)
+        self.assertEqual(list(self.index.query(status='Success')), [])
+
+    def test_query(self):
+        """Check the payments are found by status and update time."""
+        foo = self.site.add('foo')
+        now = time.time()
+        payments = {
+            'tid1': PaymentRecord(status='Open', paid=False,
+                                  last_update=now - 7200),
+            'tid2': PaymentRecord(status='Open', paid=False,
+                                  last_update=now - 60),
+            'tid3': PaymentRecord(status='Success', paid=True,
+                                  last_update=now - 1800),
+            'tid4': PaymentRecord(last_update=now),
+        }
+        try:
+            for transaction_id, payment in payments.items():
+                self.index.index_transaction(transaction_id, foo, True)
+                self.assertTrue(
+                    self.index.index_payment(transaction_id, payment))
+            query = lambda **kwargs: sorted(self.index.query(**kwargs))
+            self.assertEqual(query(status='Open'), ['tid1', 'tid2'])
+            self.assertEqual(query(status='Open', updated_max=now - 1800),
+                             ['tid1'])
+            self.assertEqual(query(updated_min=now - 1800),
+                             ['tid2', 'tid3', 'tid4'])
+            self.assertEqual(query(updated_min=now - 1800,
+                                   updated_max=now - 60),
+                             ['tid2', 'tid3'])
+            self.assertEqual(query(paid=False), ['tid1', 'tid2'])
+            self.assertEqual(query(paid=False, updated_min=now - 7200),
+                             ['tid1', 'tid2'])
+            # A status change moves the payment to another status.
+            payments['tid2']['status'] = 'Cancelled'
+            self.index.index_payment('tid2', payments['tid2'])
+            self.assertEqual(query(status='Open'), ['tid1'])
+            self.assertEqual(query(status='Cancelled'), ['tid2'])
+        finally:
+            for transaction_id in payments:
+                self.index.unindex_transaction(transaction_id)
+        self.assertEqual(list(self.index.query(status='Open')), [])
+        self.assertFalse(self.index.index_payment('tid1', payments['tid1']))
+
+    def test_archive_payments(self):
+        """Check old final payments of the whole site are archived."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        self.request_payment(adapted)
+        self.ideal._do_request = MagicMock(
+            return_value=mock_do_request('payment_success.xml'))
+        adapted.get_payment_status(self.transaction_id)
+        now = time.time()
+        self.assertEqual(archive_payments(
+            self.index, self.site, 3600, commit=False, now=now), 0)
+        self.assertEqual(archive_payments(
+            self.index, self.site, 3600, commit=False, now=now + 7200), 1)
+        self.assertFalse(self.transaction_id in adapted._metadata)
+        self.assertTrue(adapted.get_transaction(self.transaction_id)['paid'])
+        self.assertEqual(self.index.archived_until, now + 3600)
+        # The next run does not look at the archived payment again.
+        with patch.object(self.index, 'resolve',
+                          wraps=self.index.resolve) as resolve:
+            self.assertEqual(archive_payments(
+                self.index, self.site, 3600, commit=False,
+                now=now + 7300), 0)
+        self.assertEqual(resolve.call_count, 0)
+
+    def test_reindex_payments(self):
+        """Check payments stored before are added to the indexes."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        self.index._unindex_payment(self.transaction_id)
+        self.assertEqual(list(self.index.query(updated_max=time.time())),
+                         [])
+        self.assertEqual(reindex_payments(
+            self.index, self.site, commit=False), 1)
+        self.assertEqual(list(self.index.query(updated_max=time.time())),
+                         [self.transaction_id])
+
+    def test_find_payments(self):
+        """Check the objects with payments are found by walking the site."""
+        single = self.site.add('single')
+        multiple = self.site.add('multiple')
+        self.site.add('nothing')
+        self.request_payment(IMollieIdealPayment(single))
+        self.request_payment(IMollieIdealMultiplePayments(multiple))
+        self.assertEqual(
+            sorted((obj.id, flag) for obj, flag in find_payments(self.site)),
+            [('multiple', True), ('single', False)])
+
+    def test_backfill_index(self):
+        """Check payments stored before the index existed are indexed."""
+        index = TransactionIndex()
+        self.assertFalse(index.complete)
+        single = self.site.add('single')
+        multiple = self.site.add('multiple')
+        self.request_payment(IMollieIdealPayment(single))
+        adapted = IMollieIdealMultiplePayments(multiple)
+        adapted._metadata['tid1'] = PaymentRecord(
+            transaction_id='tid1', status='Success', paid=True,
+            last_update_time=time.time())
+        self.assertEqual(len(index), 0)
+        self.assertEqual(backfill_index(index, self.site, commit=False), 2)
+        self.assertTrue(index.complete)
+        self.assertEqual(index.resolve(self.transaction_id, self.site),
+                         single)
+        self.assertEqual(index.get('tid1')[2], True)
+        self.assertEqual(list(index.query(paid=True)), ['tid1'])
+        self.assertEqual(
+            sorted(index.query(updated_max=time.time())),
+            [self.transaction_id, 'tid1'])
+        # Running it again changes nothing.
+        self.assertEqual(backfill_index(index, self.site, commit=False), 2)
+        self.assertEqual(len(index), 2)
+
+    def test_upgrade_steps_do_not_commit(self):
+        """Check the upgrade steps leave committing to GenericSetup."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        setup_tool = MagicMock(aq_parent=self.site)
+        old_complete = self.index.complete
+        try:
+            with patch('transaction.commit') as commit:
+                upgrade_timestamps(setup_tool)
+                upgrade_payment_indexes(setup_tool)
+        finally:
+            self.index.complete = old_complete
+        self.assertFalse(commit.called)
+        self.assertEqual(list(self.index.query(updated_max=time.time())),
+                         [self.transaction_id])
+
+    def test_batches_without_commit(self):
+        """Check a savepoint is added after each batch without commits."""
+        foo = self.site.add('foo')
+        self.request_payment(IMollieIdealPayment(foo))
+        with patch('transaction.commit') as commit:
+            with patch('transaction.savepoint') as savepoint:
+                reindex_payments(self.index, self.site, batch_size=1,
+                                 commit=False)
+        self.assertFalse(commit.called)
+        savepoint.assert_called_with(optimistic=True)
+
+
+class TestReportView(unittest.TestCase):
+    """Test the site wide report view where Mollie reports a payment."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def _side_effect(*args, **kwargs):
+        return mock_do_request('payment_success.xml')
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            side_effect=self._side_effect)
+        self.index = getUtility(IMollieTransactionIndex)
+        self.site = Site()
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        eventtesting.setUp()
+
+    def tearDown(self):
+        self.ideal._do_request = self.ideal.old_do_request
+        self.index.unindex_transaction(self.transaction_id)
+        eventtesting.clearEvents()
+
+    def report(self, transaction_id):
+        form = {}
+        if transaction_id is not None:
+            form['transaction_id'] = transaction_id
+        request = TestRequest(form=form)
+        view = getMultiAdapter((self.site, request), name='mollie-report')
+        return view(), request
+
+    def test_missing_transaction_id(self):
+        """Check missing transaction_id is invalid."""
+        result, request = self.report(None)
+        self.assertEqual(result, 'Wrong or missing transaction ID')
+        self.assertEqual(request.response.getStatus(), 403)
+
+    def test_unknown_transaction_id(self):
+        """Check a transaction_id which is not indexed is invalid."""
+        result, request = self.report('deadbeef')
+        self.assertEqual(result, 'Wrong or missing transaction ID')
+        self.assertEqual(request.response.getStatus(), 403)
+
+    def test_stale_index(self):
+        """Check a transaction which is not stored on the object."""
+        foo = self.site.add('foo')
+        self.index.index_transaction(self.transaction_id, foo)
+        result, request = self.report(self.transaction_id)
+        self.assertEqual(request.response.getStatus(), 403)
+        self.index.index_transaction(self.transaction_id, foo, True)
+        result, request = self.report(self.transaction_id)
+        self.assertEqual(request.response.getStatus(), 403)
+
+    def test_single_payment(self):
+        """Check the payment of an object with a single payment."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealPayment(foo)
+        adapted._partner_id = '999999'
+        adapted.transaction_id = self.transaction_id
+        self.index.index_transaction(self.transaction_id, foo)
+        result, request = self.report(self.transaction_id)
+        self.assertEqual(result, 'OK')
+        self.assertEqual(request.response.getStatus(), 200)
+        self.assertTrue(adapted.paid)
+
+    def test_multiple_payments(self):
+        """Check a payment of an object with multiple payments."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        adapted._metadata[self.transaction_id] = PaymentRecord(
+            partner_id='999999')
+        self.index.index_transaction(self.transaction_id, foo, True)
+        result, request = self.report(self.transaction_id)
+        self.assertEqual(result, 'OK')
+        self.assertEqual(request.response.getStatus(), 200)
+        self.assertTrue(adapted.get_transaction(self.transaction_id)['paid'])
+
+    def test_payment_event(self):
+        """Check the event is fired for the object with the payment."""
+        foo = self.site.add('foo')
+        adapted = IMollieIdealPayment(foo)
+        adapted._partner_id = '999999'
+        adapted.transaction_id = self.transaction_id
+        self.index.index_transaction(self.transaction_id, foo)
+        result, request = self.report(self.transaction_id)
+        payment_events = [event for event in eventtesting.getEvents()
+                          if IMollieIdealPaymentEvent.providedBy(event)]
+        self.assertTrue(len(payment_events) > 0)
+        event = payment_events[-1]
+        self.assertTrue(event.context is foo)
+        self.assertEqual(event.request, request)
+        self.assertEqual(event.transaction_id, self.transaction_id)
+
+
+class TestPaymentStatusEvents(unittest.TestCase):
+    """Test the events for the status of reported payments."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            return_value=mock_do_request('payment_success.xml'))
+        self.foo = Foo()
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        adapted = IMollieIdealPayment(self.foo)
+        adapted._partner_id = '999999'
+        adapted.transaction_id = self.transaction_id
+        eventtesting.setUp()
+
+    def tearDown(self):
+        self.ideal._do_request = self.ideal.old_do_request
+        eventtesting.clearEvents()
+
+    def report(self, filename, name='report_payment_status'):
+        self.ideal._do_request.return_value = mock_do_request(filename)
+        request = TestRequest(form=dict(transaction_id=self.transaction_id))
+        getMultiAdapter((self.foo, request), name=name)()
+        return eventtesting.getEvents(IMolliePaymentStatusEvent)
+
+    def test_paid(self):
+        """Check a paid payment and a repeated report."""
+        events = self.report('payment_success.xml')
+        event = events[-1]
+        self.assertEqual(type(event), PaymentPaid)
+        self.assertEqual(event.context, self.foo)
+        self.assertEqual(event.transaction_id, self.transaction_id)
+        self.assertEqual(event.old_status, None)
+        self.assertEqual(event.new_status, 'Success')
+        paid = len(eventtesting.getEvents(IMolliePaymentPaidEvent))
+
+        event = self.report('payment_checked_before.xml')[-1]
+        self.assertEqual(type(event), PaymentStatusUnchanged)
+        self.assertEqual(event.old_status, 'Success')
+        self.assertEqual(event.new_status, 'Success')
+        self.assertEqual(
+            len(eventtesting.getEvents(IMolliePaymentPaidEvent)), paid)
+
+    def test_other_statuses(self):
+        """Check the events for other changes of the status."""
+        event = self.report('payment_open.xml')[-1]
+        self.assertEqual(type(event), PaymentStatusChanged)
+        self.assertEqual(event.new_status, 'Open')
+        event = self.report('payment_cancelled.xml')[-1]
+        self.assertEqual(type(event), PaymentCancelled)
+        self.assertEqual(event.old_status, 'Open')
+        self.assertEqual(event.new_status, 'Cancelled')
+
+    def test_multiple_payments(self):
+        """Check the events for objects with multiple payments."""
+        self.ideal._do_request.return_value = mock_do_request(
+            'request_payment_good.xml')
+        self.foo = Foo()
+        IMollieIdealMultiplePayments(self.foo).get_payment_url(
+            '999999', '9999', '123', 'Test', 'http://report', 'http://return')
+        event = self.report('payment_success.xml',
+                            name='report_multiple_payment_status')[-1]
+        self.assertEqual(type(event), PaymentPaid)
+        self.assertEqual(event.old_status, None)
+
+    def test_after_commit(self):
+        """Check the events are only notified after a commit."""
+        manager = transaction.TransactionManager()
+        manager.begin()
+        count = len(eventtesting.getEvents(IMolliePaymentStatusEvent))
+        with patch('collective.mollie.config.STATUS_EVENTS_AFTER_COMMIT',
+                   True):
+            process_report(self.foo, self.transaction_id,
+                           transaction_manager=manager)
+        events = eventtesting.getEvents(IMolliePaymentStatusEvent)
+        self.assertEqual(len(events), count)
+        self.assertEqual(len(eventtesting.getEvents(IMollieIdealPaymentEvent)),
+                         1)
+        manager.commit()
+        events = eventtesting.getEvents(IMolliePaymentStatusEvent)
+        self.assertEqual(len(events), count + 1)
+        self.assertEqual(type(events[-1]), PaymentPaid)
+
+        # Nothing is notified for an aborted transaction.
+        manager.begin()
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_checked_before.xml')
+        with patch('collective.mollie.config.STATUS_EVENTS_AFTER_COMMIT',
+                   True):
+            process_report(self.foo, self.transaction_id,
+                           transaction_manager=manager)
+        manager.abort()
+        self.assertEqual(
+            len(eventtesting.getEvents(IMolliePaymentStatusEvent)), count + 1)
+
+
+class TestReconcile(unittest.TestCase):
+    """Test checking the payments Mollie did not report."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    # The answers of Mollie for the checks of the transactions.
+    answers = {
+        '482d599bbcc7795727650330ad65fe9b': 'payment_success.xml',
+        '5727650330ad65fe9b482d599bbcc779': 'payment_cancelled_2.xml',
+    }
+
+    def _side_effect(self, data={}):
+        if data.get('a') == 'check':
+            return mock_do_request(self.answers[data['transaction_id']])
+        return mock_do_request(self.requests.pop(0))
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(side_effect=self._side_effect)
+        self.requests = ['request_payment_good.xml',
+                         'request_payment_good_2.xml']
+        self.old_index = getUtility(IMollieTransactionIndex)
+        self.index = TransactionIndex()
+        provideUtility(self.index, IMollieTransactionIndex)
+        self.site = Site()
+        self.foo = self.site.add('foo')
+        self.bar = self.site.add('bar')
+        for adapted in [IMollieIdealPayment(self.foo),
+                        IMollieIdealMultiplePayments(self.bar)]:
+            adapted.get_payment_url('999999', '9999', '123', 'Test',
+                                    'http://example.com/report',
+                                    'http://example.com/return')
+        eventtesting.setUp()
+
+    def tearDown(self):
+        self.ideal._do_request = self.ideal.old_do_request
+        provideUtility(self.old_index, IMollieTransactionIndex)
+        eventtesting.clearEvents()
+
+    def reconcile(self, **kwargs):
+        kwargs.setdefault('now', time.time() + 7200)
+        return reconcile_payments(self.index, self.site, commit=False,
+                                  rate=None, **kwargs)
+
+    def test_reconcile(self):
+        """Check open payments are checked and stored."""
+        stats = self.reconcile()
+        self.assertEqual(stats['checked'], 2)
+        self.assertEqual(stats['changed'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['statuses'], {'Success': 1, 'Cancelled': 1})
+        self.assertTrue(IMollieIdealPayment(self.foo).paid)
+        payment = IMollieIdealMultiplePayments(self.bar).get_transaction(
+            '5727650330ad65fe9b482d599bbcc779')
+        self.assertEqual(payment['status'], 'Cancelled')
+        self.assertEqual(list(self.index.query(status='Success')),
+                         ['482d599bbcc7795727650330ad65fe9b'])
+        event = eventtesting.getEvents(IMolliePaymentPaidEvent)[-1]
+        self.assertEqual(event.context, self.foo)
+        self.assertEqual(event.request, None)
+        # The payments are not open anymore.
+        self.assertEqual(self.reconcile()['checked'], 0)
+
+    def test_stored_result(self):
+        """Check a payment with a stored check result gets that result,
+        although Mollie only answers 'CheckedBefore' now."""
+        transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        store = CheckResultStore()
+        provideUtility(store, IMollieCheckResultStore)
+        try:
+            # The report checked the payment, but its transaction was
+            # aborted.
+            self.ideal.check_payment('999999', transaction_id)
+            self.answers = dict(self.answers)
+            self.answers[transaction_id] = 'payment_checked_before.xml'
+            calls = self.ideal._do_request.call_count
+            stats = self.reconcile()
+        finally:
+            getGlobalSiteManager().unregisterUtility(
+                store, IMollieCheckResultStore)
+        self.assertEqual(stats['statuses'], {'Success': 1, 'Cancelled': 1})
+        self.assertTrue(IMollieIdealPayment(self.foo).paid)
+        # Only the other payment has been checked with Mollie.
+        self.assertEqual(self.ideal._do_request.call_count, calls + 1)
+
+    def test_min_age(self):
+        """Check recently updated payments are not checked yet."""
+        self.assertEqual(self.reconcile(now=time.time())['checked'], 0)
+        self.assertEqual(self.reconcile(max_age=3600)['checked'], 0)
+        self.assertEqual(self.ideal._do_request.call_count, 2)
+
+    def test_errors(self):
+        """Check failed checks are counted and the payment stays open."""
+        self.answers = dict(self.answers)
+        self.answers['5727650330ad65fe9b482d599bbcc779'] = 'error_14.xml'
+        stats = self.reconcile()
+        self.assertEqual(stats['checked'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['statuses'], {'Success': 1})
+        self.answers['5727650330ad65fe9b482d599bbcc779'] = \
+            'payment_cancelled_2.xml'
+        stats = self.reconcile()
+        self.assertEqual(stats['checked'], 1)
+        self.assertEqual(stats['statuses'], {'Cancelled': 1})
+
+    def test_limit(self):
+        """Check the number of checked payments can be limited."""
+        stats = self.reconcile(limit=1, batch_size=1)
+        self.assertEqual(stats['checked'], 1)
+        stats = self.reconcile(limit=1, batch_size=5)
+        self.assertEqual(stats['checked'], 1)
+        self.assertEqual(self.reconcile()['checked'], 0)
+
+    def test_missing(self):
+        """Check payments on removed objects are skipped."""
+        del self.site._objects[('', 'plone', 'foo')]
+        stats = self.reconcile()
+        self.assertEqual(stats['missing'], 1)
+        self.assertEqual(stats['checked'], 1)
+
+    def test_command(self):
+        """Check the command of the Zope instance."""
+        app = MagicMock()
+        app.unrestrictedTraverse.return_value = self.site
+        with patch('sys.stdout', StringIO()):
+            reconcile_command(app, ['--min-age', '0', '--rate', '0',
+                                    '--limit', '5', 'plone'])
+            output = sys.stdout.getvalue()
+        app.unrestrictedTraverse.assert_called_with('plone')
+        self.assertTrue('Checked 2 payments' in output)
+        self.assertTrue('status Success: 1' in output)
+
+
+class TestReportPreCheck(unittest.TestCase):
+    """Test bogus reports are rejected before the payment is loaded."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def _side_effect(*args, **kwargs):
+        return mock_do_request('request_payment_good.xml')
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            side_effect=self._side_effect)
+        self.old_precheck = getUtility(IMollieReportPreCheck)
+        self.precheck = ReportPreCheck(networks=['10.1.2.0/24'])
+        provideUtility(self.precheck, IMollieReportPreCheck)
+        self.index = getUtility(IMollieTransactionIndex)
+        self.old_complete = self.index.complete
+        self.index.complete = True
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        self.foo = Site().add('foo')
+
+    def tearDown(self):
+        self.ideal._do_request = self.ideal.old_do_request
+        provideUtility(self.old_precheck, IMollieReportPreCheck)
+        self.index.unindex_transaction(self.transaction_id)
+        self.index.complete = self.old_complete
+
+    def report(self, transaction_id, address='10.1.2.3',
+               name='report_payment_status'):
+        request = TestRequest(form=dict(transaction_id=transaction_id),
+                              environ=dict(REMOTE_ADDR=address))
+        view = getMultiAdapter((self.foo, request), name=name)
+        with patch('collective.mollie.browser.report.IMollieIdealPayment',
+                   side_effect=IMollieIdealPayment) as adapter:
+            result = view()
+        return result, request.response.getStatus(), adapter.called
+
+    def test_bad_format(self):
+        """Check a transaction ID with the wrong format is rejected."""
+        for transaction_id in ['deadbeef', self.transaction_id.upper(),
+                               self.transaction_id + '\n']:
+            result, status, loaded = self.report(transaction_id)
+            self.assertEqual(status, 403)
+            self.assertFalse(loaded)
+        self.assertEqual(self.precheck.stats()['bad_format'], 3)
+
+    def test_address(self):
+        """Check reports from other networks are rejected."""
+        for address in ['10.1.3.3', 'unknown', None]:
+            result, status, loaded = self.report(self.transaction_id,
+                                                 address=address)
+            self.assertEqual(status, 403)
+            self.assertFalse(loaded)
+        self.assertEqual(self.precheck.stats()['bad_address'], 3)
+        self.index.index_transaction(self.transaction_id, self.foo)
+        result, status, loaded = self.report(self.transaction_id)
+        self.assertTrue(loaded)
+        self.assertEqual(self.precheck.stats()['accepted'], 1)
+
+    def test_known_transactions(self):
+        """Check unknown transactions are rejected once they are loaded."""
+        self.assertEqual(self.precheck.load([]), 0)
+        for name in ['report_payment_status',
+                     'report_multiple_payment_status']:
+            result, status, loaded = self.report(self.transaction_id,
+                                                 name=name)
+            self.assertEqual(status, 403)
+            self.assertFalse(loaded)
+        self.assertEqual(self.precheck.stats()['unknown'], 2)
+
+        # Requesting a payment makes the transaction known.
+        IMollieIdealPayment(self.foo).get_payment_url(
+            '999999', '9999', '123', 'Test', 'http://report', 'http://return')
+        self.ideal._do_request.side_effect = None
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_success.xml')
+        result, status, loaded = self.report(self.transaction_id)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.precheck.stats()['known'], 1)
+
+    def test_incomplete_index(self):
+        """Check unknown transactions are accepted until the payments
+        stored before the index existed have been indexed."""
+        self.precheck.load([])
+        self.index.complete = False
+        result, status, loaded = self.report(self.transaction_id)
+        self.assertTrue(loaded)
+        self.assertEqual(self.precheck.stats()['unknown'], 0)
+
+    def test_indexed_transactions(self):
+        """Check transactions of other processes are found in the index."""
+        self.precheck.load([])
+        self.index.index_transaction(self.transaction_id, self.foo)
+        result, status, loaded = self.report(self.transaction_id)
+        self.assertTrue(loaded)
+        self.assertEqual(self.precheck.stats()['unknown'], 0)
+        self.assertEqual(self.precheck.stats()['known'], 1)
+
+    def test_load_from_index(self):
+        """Check the known transactions are loaded from the index when
+        the first report is checked."""
+        self.index.index_transaction(self.transaction_id, self.foo)
+        self.assertEqual(self.precheck.stats()['known'], None)
+        result, status, loaded = self.report(self.transaction_id)
+        self.assertTrue(loaded)
+        self.assertEqual(self.precheck.stats()['known'], len(self.index))
+        result, status, loaded = self.report('0' * 32)
+        self.assertEqual(status, 403)
+        self.assertFalse(loaded)
+        self.assertEqual(self.precheck.stats()['unknown'], 1)
+
+    def test_site_wide_view(self):
+        """Check the site wide report view also checks reports."""
+        result, status, loaded = self.report('deadbeef', name='mollie-report')
+        self.assertEqual(status, 403)
+        self.assertEqual(self.precheck.stats()['bad_format'], 1)
+
+
+class TestQueuedReports(unittest.TestCase):
+    """Test processing the reports of Mollie in the background."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            return_value=mock_do_request('payment_success.xml'))
+        self.index = getUtility(IMollieTransactionIndex)
+        self.queue = LocalReportQueue()
+        provideUtility(self.queue, IMollieReportQueue)
+        self.site = Site()
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        eventtesting.setUp()
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(self.queue,
+                                                 IMollieReportQueue)
+        self.ideal._do_request = self.ideal.old_do_request
+        self.index.unindex_transaction(self.transaction_id)
+        eventtesting.clearEvents()
+
+    def report(self):
+        request = TestRequest(form={'transaction_id': self.transaction_id})
+        view = getMultiAdapter((self.site, request), name='mollie-report')
+        return view(), request
+
+    def add_payment(self):
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        adapted._metadata[self.transaction_id] = PaymentRecord(
+            partner_id='999999')
+        self.index.index_transaction(self.transaction_id, foo, True)
+        return adapted
+
+    def workers(self):
+        return ReportWorkers(site_processor(
+            self.site, transaction.TransactionManager()))
+
+    def test_report_queued(self):
+        """Check a report is answered at once and processed later."""
+        adapted = self.add_payment()
+        result, request = self.report()
+        self.assertEqual(result, 'OK')
+        self.assertEqual(request.response.getStatus(), 200)
+        self.assertEqual(self.ideal._do_request.call_count, 0)
+        self.assertEqual(adapted.get_transaction(self.transaction_id)['paid'],
+                         None)
+        # A second report for the same payment is not queued again.
+        self.report()
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.workers().drain(), 1)
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue(adapted.get_transaction(self.transaction_id)['paid'])
+        payment_events = eventtesting.getEvents(IMollieIdealPaymentEvent)
+        self.assertTrue(len(payment_events) > 0)
+        self.assertEqual(payment_events[-1].transaction_id,
+                         self.transaction_id)
+        self.assertEqual(payment_events[-1].request, None)
+
+    def test_failed_report(self):
+        """Check a report which fails is retried and finally dropped."""
+        adapted = self.add_payment()
+        self.report()
+        self.ideal._do_request = MagicMock(side_effect=MollieAPIError(
+            'error', 'Failed'))
+        self.queue.MAX_ATTEMPTS = 2
+        workers = self.workers()
+        self.assertTrue(workers.process())
+        self.assertEqual(len(self.queue), 1)
+        self.assertTrue(workers.process())
+        self.assertEqual(len(self.queue), 0)
+        self.assertFalse(workers.process())
+        self.assertEqual(adapted.get_transaction(self.transaction_id)['paid'],
+                         None)
+
+    def test_conflict_retried(self):
+        """Check a report which conflicts is processed again right away,
+        without queueing it again."""
+        adapted = self.add_payment()
+        self.report()
+        calls = []
+
+        def conflict_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ConflictError()
+            return process_report(*args, **kwargs)
+
+        with patch('collective.mollie.reports.process_report',
+                   side_effect=conflict_once):
+            self.assertTrue(self.workers().process())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue(adapted.get_transaction(self.transaction_id)['paid'])
+
+    def test_conflicts_count_as_failure(self):
+        """Check a report which keeps conflicting is queued again."""
+        self.add_payment()
+        self.report()
+        with patch('collective.mollie.reports.process_report',
+                   side_effect=ConflictError()) as process:
+            self.assertTrue(self.workers().process())
+        self.assertEqual(process.call_count, CONFLICT_RETRIES + 1)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.pop()[1][3], 1)
+
+    def test_workers(self):
+        """Check the worker threads process the queued reports."""
+        adapted = self.add_payment()
+        self.report()
+        workers = ReportWorkers(site_processor(self.site), workers=2,
+                                poll_interval=0.01)
+        workers.start()
+        try:
+            for i in range(500):
+                if not len(self.queue):
+                    break
+                time.sleep(0.01)
+        finally:
+            workers.stop(5)
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue(adapted.get_transaction(self.transaction_id)['paid'])
+
+    def test_persistent_queue(self):
+        """Check the queue stored in the ZODB."""
+        database = TemporaryDatabase()
+        try:
+            connection = database.open()
+            root = connection.root()
+            root['queue'] = queue = ReportQueue()
+            for transaction_id in ['1a', '2b', '3c']:
+                self.assertTrue(queue.put(transaction_id,
+                                          self.site.add(transaction_id)))
+            self.assertFalse(queue.put('2b', self.site.add('2b')))
+            self.assertEqual(len(queue), 3)
+            connection.transaction_manager.commit()
+
+            # Workers take different jobs, which do not conflict.
+            connections = [database.open() for i in range(2)]
+            for conn, start in zip(connections, [2, 3]):
+                with patch('random.randrange', return_value=start):
+                    conn.root()['queue'].pop()
+            for conn in connections:
+                conn.transaction_manager.commit()
+            connection.sync()
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(list(queue._jobs.keys()), ['1a'])
+
+            # A job which failed is queued again, until it failed
+            # too often.
+            transaction_id, job = queue.pop()
+            self.assertEqual(job, (('', 'plone', '1a'), None, False, 0))
+            connection.transaction_manager.abort()
+            queue.MAX_ATTEMPTS = 2
+            self.assertTrue(queue.failed(transaction_id, job))
+            self.assertEqual(queue._jobs['1a'][3], 1)
+            self.assertEqual(len(queue), 1)
+            self.assertFalse(queue.failed(transaction_id, queue._jobs['1a']))
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.pop(), None)
+
+            # After a conflict, the job is taken again, unless another
+            # worker has processed it in the meantime.
+            queue.put('4d', self.site.add('4d'))
+            connection.transaction_manager.commit()
+            transaction_id, job = queue.pop()
+            connection.transaction_manager.abort()
+            self.assertEqual(queue.retake(transaction_id, job), job)
+            self.assertEqual(len(queue), 0)
+            connection.transaction_manager.abort()
+            other = database.open()
+            other.root()['queue'].pop()
+            other.transaction_manager.commit()
+            connection.sync()
+            self.assertEqual(queue.retake(transaction_id, job), None)
+        finally:
+            database.close()
+
+
+class TestCheckResultStore(unittest.TestCase):
+    """Test the first result of checking a payment is kept."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.ideal = getUtility(IMollieIdeal)
+        self.ideal.old_do_request = self.ideal._do_request
+        self.ideal._do_request = MagicMock(
+            return_value=mock_do_request('payment_success.xml'))
+        self.store = CheckResultStore()
+        provideUtility(self.store, IMollieCheckResultStore)
+        self.transaction_id = '482d599bbcc7795727650330ad65fe9b'
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(self.store,
+                                                 IMollieCheckResultStore)
+        self.ideal._do_request = self.ideal.old_do_request
+
+    def test_checked_once(self):
+        """Check Mollie is only asked for the status once."""
+        result = self.ideal.check_payment('999999', self.transaction_id)
+        self.assertEqual(result['status'], 'Success')
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_checked_before.xml')
+        for i in range(2):
+            again = self.ideal.check_payment('999999', self.transaction_id)
+            self.assertEqual(again, result)
+            self.assertEqual(again.consumer, result.consumer)
+        self.assertEqual(self.ideal._do_request.call_count, 1)
+
+    def test_checked_before_not_stored(self):
+        """Check a 'CheckedBefore' answer is not stored."""
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_checked_before.xml')
+        self.ideal.check_payment('999999', self.transaction_id)
+        self.assertFalse(self.transaction_id in self.store)
+        self.ideal.check_payment('999999', self.transaction_id)
+        self.assertEqual(self.ideal._do_request.call_count, 2)
+
+    def test_open_not_stored(self):
+        """Check a payment which is still open is checked again."""
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_open.xml')
+        result = self.ideal.check_payment('999999', self.transaction_id)
+        self.assertEqual(result['status'], 'Open')
+        self.assertFalse(self.transaction_id in self.store)
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_success.xml')
+        result = self.ideal.check_payment('999999', self.transaction_id)
+        self.assertEqual(result['status'], 'Success')
+        self.assertEqual(self.ideal._do_request.call_count, 2)
+        self.assertEqual(self.store.get(self.transaction_id), result)
+
+    def test_batch_recorded(self):
+        """Check the results of checking payments in a batch are stored."""
+        results = list(self.ideal.check_payments(
+            [('999999', self.transaction_id)]))
+        self.assertEqual(results[0].order['status'], 'Success')
+        self.assertEqual(self.store.get(self.transaction_id)['status'],
+                         'Success')
+
+    def test_batch_late_answer_recorded(self):
+        """Check an answer arriving after the timeout is still stored."""
+        def slow_request(*args, **kwargs):
+            time.sleep(0.3)
+            return mock_do_request('payment_success.xml')
+        self.ideal._do_request = MagicMock(side_effect=slow_request)
+        results = list(self.ideal.check_payments(
+            [('999999', self.transaction_id)], timeout=0.05))
+        self.assertTrue(results[0].error is not None)
+        for i in range(50):
+            if self.transaction_id in self.store:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.store.get(self.transaction_id)['status'],
+                         'Success')
+
+    def test_retried_report(self):
+        """Check a retried report still gets the real status."""
+        adapted = IMollieIdealPayment(Foo())
+        adapted._partner_id = '999999'
+        adapted.transaction_id = self.transaction_id
+        self.assertEqual(adapted.get_payment_status(), 'Success')
+        # The request conflicts and is retried with a fresh object.
+        adapted = IMollieIdealPayment(Foo())
+        adapted._partner_id = '999999'
+        adapted.transaction_id = self.transaction_id
+        self.ideal._do_request.return_value = mock_do_request(
+            'payment_checked_before.xml')
+        self.assertEqual(adapted.get_payment_status(), 'Success')
+        self.assertTrue(adapted.paid)
+
+    def test_durable(self):
+        """Check a result is kept when the transaction is aborted."""
+        database = TemporaryDatabase()
+        try:
+            connection = database.open()
+            connection.root()['store'] = CheckResultStore()
+            connection.transaction_manager.commit()
+            other = database.open()
+            result = self.ideal.check_payment('999999', self.transaction_id)
+            store = connection.root()['store']
+            self.assertTrue(store.record(self.transaction_id, result))
+            connection.transaction_manager.abort()
+            other.transaction_manager.begin()
+            self.assertEqual(
+                other.root()['store'].get(self.transaction_id), result)
+            self.assertEqual(store.get(self.transaction_id), result)
+        finally:
+            database.close()
+
+
+class TestExportView(unittest.TestCase):
+    """Test exporting the payments of the whole site."""
+
+    layer = COLLECTIVE_MOLLIE_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.index = getUtility(IMollieTransactionIndex)
+        self.site = Site()
+        foo = self.site.add('foo')
+        adapted = IMollieIdealMultiplePayments(foo)
+        adapted.ideal_wrapper = MagicMock()
+        self.now = time.time()
+        self.transaction_ids = ['export1', 'export2', 'export3']
+        for transaction_id, partner_id in zip(self.transaction_ids,
+                                              ['1', '1', '2']):
+            adapted.ideal_wrapper.request_payment.return_value = (
+                transaction_id, 'http://example.com/pay')
+            adapted.get_payment_url(partner_id, '9999', '123', 'Export',
+                                    'http://example.com/report',
+                                    'http://example.com/return')
+        adapted.ideal_wrapper.check_payment.return_value = {
+            'status': 'Success', 'currency': 'EUR', 'paid': True,
+            'consumer': {'name': u'T. T\xebst', 'account': '0123456789',
+                         'city': 'Testdorp'}}
+        adapted.get_payment_status('export2')
+
+    def tearDown(self):
+        for transaction_id in self.transaction_ids:
+            self.index.unindex_transaction(transaction_id)
+
+    def export(self, **form):
+        request = StreamingRequest(form)
+        result = ExportView(self.site, request)()
+        return result, request.response
+
+    def test_csv(self):
+        """Check the payments are exported as CSV."""
+        result, response = self.export()
+        self.assertEqual(result, '')
+        self.assertEqual(response.getHeader('Content-Type'),
+                         'text/csv; charset=utf-8')
+        lines = ''.join(response.written).splitlines()
+        self.assertEqual(lines[0].split(',')[:2],
+                         ['transaction_id', 'partner_id'])
+        self.assertEqual(len(lines), 4)
+        row = [line for line in lines if line.startswith('export2')][0]
+        self.assertTrue('Success' in row)
+        self.assertTrue('T. T\xc3\xabst' in row)
+        self.assertTrue('/plone/foo' in row)
+
+    def test_json_filters(self):
+        """Check the filters and the JSON lines export."""
+        result, response = self.export(format='json', status='Success')
+        rows = [json.loads(line) for line in response.written]
+        self.assertEqual([row['transaction_id'] for row in rows],
+                         ['export2'])
+        self.assertEqual(rows[0]['consumer_name'], u'T. T\xebst')
+        self.assertTrue(rows[0]['paid'])
+        result, response = self.export(format='json', partner_id='1')
+        self.assertEqual(sorted(json.loads(line)['transaction_id']
+                                for line in response.written),
+                         ['export1', 'export2'])
+        start = DateTime(self.now - 60).ISO8601()
+        end = DateTime(self.now - 30).ISO8601()
+        result, response = self.export(format='json', start=start, end=end)
+        self.assertEqual(response.written, [])
+        result, response = self.export(format='json', start=start)
+        self.assertEqual(len(response.written), 3)
+
+    def test_invalid_date(self):
+        """Check an invalid date is refused."""
+        result, response = self.export(start='yesterday-ish')
+        self.assertEqual(response.getStatus(), 400)
+        self.assertEqual(response.written, [])
+
+    def test_cache_cleared(self):
+        """Check the ZODB cache is cleared during long exports."""
+        self.site._p_jar = MagicMock()
+        view = ExportView(self.site, StreamingRequest())
+        view.CACHE_CLEAR_INTERVAL = 2
+        list(view.payments(self.index))
+        self.assertEqual(self.site._p_jar.cacheMinimize.call_count, 1)
+
+
 class TestMollieConnection(unittest.TestCase):
     """Test the actual integration with Mollie."""
 
@@ -710,6 +2429,7 @@ class TestMollieConnection(unittest.TestCase):
     def setUp(self):
         self.ideal = getUtility(IMollieIdeal)
         self.ideal.TESTMODE = True
+        self.ideal.clear_banks_cache()
 
     def test_connection(self):
         """Check the Mollie connection by retrieving list of banks."""
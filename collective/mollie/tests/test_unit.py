@@ -1,10 +1,49 @@
+import gc
+import httplib
 import os
+import pickle
+import socket
+import ssl
+import threading
+import time
 import unittest2 as unittest
 
+from collective.mollie.async_ideal import AsyncMollieIdeal
+from collective.mollie.batch import BatchChecker
+from collective.mollie.batch import RateLimiter
+from collective.mollie.checkstore import result_data
+from collective.mollie.checkstore import result_from_data
+from collective.mollie.events import PaymentExpired
+from collective.mollie.events import PaymentPaid
+from collective.mollie.events import PaymentStatusChanged
+from collective.mollie.events import PaymentStatusUnchanged
+from collective.mollie.events import status_event
+from collective.mollie.ideal import MollieAPIError
+from collective.mollie.ideal import MollieIdeal
+from collective.mollie.ideal import MollieUnavailableError
+from collective.mollie.ideal import normalize_order
+from collective.mollie.ideal import parse_answer
+from collective.mollie.ideal import parse_banklist
+from collective.mollie.ideal import parse_order
+from collective.mollie.ideal import payment_from_order
+from collective.mollie.pool import HTTPSConnectionPool
+from collective.mollie.pool import ResponseTooLargeError
+from collective.mollie.precheck import BloomFilter
+from collective.mollie.precheck import ReportPreCheck
+from collective.mollie.precheck import parse_network
+from collective.mollie.results import Bank
+from collective.mollie.results import CheckResult
+from collective.mollie.results import Consumer
+from collective.mollie.storage import PaymentRecord
+from collective.mollie.storage import resolve_payment_conflict
+from collective.mollie.tests.server import MollieStandIn
+from collective.mollie.tests.server import client_ssl_context
+from collective.mollie.tests.server import get_response
 from collective.mollie.xml_parser import ElementTree
 from collective.mollie.xml_parser import XmlListConfig
 from collective.mollie.xml_parser import XmlDictConfig
 from collective.mollie.xml_parser import xml_string_to_dict
+from DateTime import DateTime
 
 
 def get_xml_from_file(filename):
@@ -141,3 +180,1040 @@ class TestXmlStringToDict(unittest.TestCase):
         expected_dict = {'Bar': '1',
                          'Qux': '2'}
         self.assertEqual(xml_dict, expected_dict)
+
+
+class TestAnswerParsers(unittest.TestCase):
+    """Test the parsers for specific answers from Mollie."""
+
+    def test_banklist(self):
+        """Check parsing the list of banks."""
+        banks = parse_banklist(get_response('banks.xml'))
+        self.assertEqual(banks, [('0031', 'ABN AMRO'),
+                                 ('0721', 'Postbank'),
+                                 ('0021', 'Rabobank')])
+
+    def test_banklist_single_bank(self):
+        """Check a list with a single bank is still a list."""
+        banks = parse_banklist(make_banklist(1))
+        self.assertEqual(banks, [('0000', 'Bank 0')])
+
+    def test_banklist_empty(self):
+        """Check parsing an empty list of banks."""
+        self.assertEqual(parse_banklist(make_banklist(0)), [])
+
+    def test_banklist_error(self):
+        """Check errors are raised."""
+        self.assertRaises(MollieAPIError, parse_banklist,
+                          get_response('error_14.xml'))
+
+    def test_order(self):
+        """Check the orders are the same as with the generic parser."""
+        for filename in ['request_payment_good.xml',
+                         'request_payment_wrong_amount.xml',
+                         'payment_success.xml',
+                         'payment_open.xml',
+                         'payment_cancelled.xml',
+                         'payment_checked_before.xml']:
+            text = get_response(filename)
+            self.assertEqual(parse_order(text), parse_answer(text)['order'])
+
+    def test_order_error(self):
+        """Check errors are raised."""
+        try:
+            parse_order(get_response('error_14.xml'))
+        except MollieAPIError, e:
+            self.assertEqual(e.args, ('-14', 'Minimum amount for an ideal '
+                                      'transaction is EUR 1,18'))
+        else:
+            self.fail('No MollieAPIError raised')
+
+    def test_order_fallback(self):
+        """Check an unexpected answer falls back to the generic parser."""
+        self.assertEqual(parse_order(get_response('banks.xml')), None)
+
+
+class TestResults(unittest.TestCase):
+    """Test the result types."""
+
+    def check_result(self):
+        return normalize_order(parse_order(get_response('payment_success.xml')))
+
+    def test_bank(self):
+        """Check a bank is still a tuple of ID and name."""
+        bank = Bank('0031', 'ABN AMRO')
+        bank_id, bank_name = bank
+        self.assertEqual(bank, ('0031', 'ABN AMRO'))
+        self.assertEqual(bank_id, '0031')
+        self.assertEqual(bank.bank_name, 'ABN AMRO')
+        self.assertEqual(bank[0], '0031')
+        self.assertEqual(bank['bank_name'], 'ABN AMRO')
+        self.assertFalse(hasattr(bank, '__dict__'))
+
+    def test_check_result(self):
+        """Check the fields and dict-like access of a check result."""
+        result = self.check_result()
+        self.assertTrue(isinstance(result, CheckResult))
+        self.assertEqual(result.status, 'Success')
+        self.assertEqual(result['status'], 'Success')
+        self.assertTrue(result.paid)
+        self.assertTrue(isinstance(result.consumer, Consumer))
+        self.assertEqual(result['consumer']['name'], 'T. TEST')
+        self.assertEqual(result.consumer.city, 'Testdorp')
+        self.assertFalse(hasattr(result, '__dict__'))
+
+    def test_missing_fields(self):
+        """Check fields which are None count as missing."""
+        result = normalize_order(
+            parse_order(get_response('payment_cancelled.xml')))
+        self.assertEqual(result.consumer, None)
+        self.assertTrue('consumer' not in result)
+        self.assertTrue('status' in result)
+        self.assertEqual(result.get('consumer', {}), {})
+        self.assertRaises(KeyError, lambda: result['consumer'])
+        self.assertRaises(KeyError, lambda: result['consumerName'])
+        self.assertFalse('consumer' in result.keys())
+
+    def test_paid_false(self):
+        """Check a false value is not missing."""
+        result = CheckResult(status='Open', paid=False)
+        self.assertTrue('paid' in result)
+        self.assertEqual(result['paid'], False)
+
+    def test_immutable(self):
+        """Check the results can not be changed."""
+        result = self.check_result()
+        self.assertRaises(AttributeError, setattr, result, 'status', 'Open')
+        self.assertRaises(AttributeError, setattr, result, 'foo', 'bar')
+        self.assertRaises(AttributeError, delattr, result, 'status')
+        def set_item():
+            result['status'] = 'Open'
+        self.assertRaises(TypeError, set_item)
+
+    def test_as_dict(self):
+        """Check a result can be converted to plain dicts."""
+        result = self.check_result().as_dict()
+        self.assertEqual(type(result), dict)
+        self.assertEqual(type(result['consumer']), dict)
+        self.assertEqual(result['consumer'], {'name': 'T. TEST',
+                                              'account': '0123456789',
+                                              'city': 'Testdorp'})
+        self.assertEqual(self.check_result(), result)
+
+    def test_equality(self):
+        """Check equal results compare and hash equal."""
+        self.assertEqual(self.check_result(), self.check_result())
+        self.assertEqual(hash(self.check_result()),
+                         hash(self.check_result()))
+        self.assertNotEqual(self.check_result(), CheckResult(status='Open'))
+        self.assertNotEqual(Consumer('T. TEST'),
+                            CheckResult('T. TEST'))
+
+    def test_pickle(self):
+        """Check the results can be pickled."""
+        for result in [self.check_result(), Bank('0031', 'ABN AMRO')]:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(result, protocol))
+                self.assertEqual(copy, result)
+                self.assertEqual(type(copy), type(result))
+
+    def test_stored_result(self):
+        """Check a result survives the conversion for the result store."""
+        for result in [self.check_result(), CheckResult(status='Open')]:
+            data = result_data(result)
+            self.assertEqual(type(data), tuple)
+            copy = result_from_data(data)
+            self.assertEqual(copy, result)
+            self.assertEqual(copy.consumer, result.consumer)
+            self.assertEqual(type(copy), CheckResult)
+
+    def test_payment_order(self):
+        """Check the order of a requested payment."""
+        order = payment_from_order(
+            parse_order(get_response('request_payment_good.xml')), '123')
+        self.assertEqual(order.amount, '123')
+        self.assertEqual(order['currency'], 'EUR')
+        self.assertTrue(order.URL.startswith('https://'))
+        self.assertRaises(ValueError, payment_from_order,
+                          parse_order(get_response('request_payment_good.xml')),
+                          '124')
+
+
+class TestConflictResolution(unittest.TestCase):
+    """Test merging concurrent changes to a payment."""
+
+    old = {'partner_id': '999999', 'amount': '123', 'last_update': 1}
+
+    def test_different_fields(self):
+        """Check changes to different fields are both kept."""
+        saved = dict(self.old, note='Saved')
+        new = dict(self.old, extra='New')
+        merged = resolve_payment_conflict(self.old, saved, new)
+        self.assertEqual(merged, dict(self.old, note='Saved', extra='New'))
+
+    def test_latest_wins(self):
+        """Check the latest change of a field wins."""
+        saved = dict(self.old, last_status='Open', last_update=3)
+        new = dict(self.old, last_status='CheckedBefore', last_update=2)
+        merged = resolve_payment_conflict(self.old, saved, new)
+        self.assertEqual(merged['last_status'], 'Open')
+        self.assertEqual(merged['last_update'], 3)
+        saved['last_update'] = 1.5
+        merged = resolve_payment_conflict(self.old, saved, new)
+        self.assertEqual(merged['last_status'], 'CheckedBefore')
+        self.assertEqual(merged['last_update'], 2)
+
+    def test_final_status_kept(self):
+        """Check a final status is not replaced by a later open status."""
+        saved = dict(self.old, status='Success', paid=True, currency='EUR',
+                     consumer={'name': 'T. TEST'}, last_status='Success',
+                     last_update=2)
+        new = dict(self.old, status='Open', paid=False, currency='EUR',
+                   last_status='Open', last_update=3)
+        for merged in [resolve_payment_conflict(self.old, saved, new),
+                       resolve_payment_conflict(self.old, new, saved)]:
+            self.assertEqual(merged['status'], 'Success')
+            self.assertTrue(merged['paid'])
+            self.assertEqual(merged['consumer'], {'name': 'T. TEST'})
+            self.assertEqual(merged['last_status'], 'Open')
+            self.assertEqual(merged['last_update'], 3)
+
+    def test_removed_field(self):
+        """Check a field removed by one transaction stays removed."""
+        old = dict(self.old, note='Note')
+        saved = dict(self.old)
+        new = dict(old, last_update=2)
+        merged = resolve_payment_conflict(old, saved, new)
+        self.assertFalse('note' in merged)
+        self.assertEqual(merged['last_update'], 2)
+
+    def test_migrated_time(self):
+        """Check a time stored as DateTime is compared with an epoch."""
+        old = dict(self.old, last_update=DateTime(1))
+        saved = dict(old, last_status='Open', last_update=DateTime(3))
+        new = dict(self.old, last_status='CheckedBefore',
+                   last_update_time=2.0)
+        del new['last_update']
+        merged = resolve_payment_conflict(old, saved, new)
+        self.assertEqual(merged['last_status'], 'Open')
+
+
+class TestPaymentRecordTimes(unittest.TestCase):
+    """Test the times of a payment are stored as epoch floats."""
+
+    def test_epoch_stored(self):
+        """Check a time is stored as float and returned as DateTime."""
+        now = DateTime()
+        record = PaymentRecord(last_update=now, last_checked=time.time())
+        self.assertEqual(record.last_update_time, now.timeTime())
+        self.assertEqual(record['last_update'], now)
+        self.assertTrue(isinstance(record.last_checked, DateTime))
+        self.assertEqual(record.timestamp('last_update'), now.timeTime())
+        self.assertFalse('last_update_time' in record.keys())
+        self.assertFalse('last_update' in record.__dict__)
+        record.last_update = None
+        self.assertEqual(record.last_update, None)
+
+    def test_from_dict(self):
+        """Check the times of a payment stored as dict are converted."""
+        now = DateTime()
+        record = PaymentRecord.from_dict({'amount': '123', 'last_update': now})
+        self.assertEqual(record.last_update_time, now.timeTime())
+
+    def test_migrate_timestamps(self):
+        """Check a DateTime stored by an older version is migrated."""
+        now = DateTime()
+        record = PaymentRecord()
+        record.__dict__['last_update'] = now
+        self.assertEqual(record.last_update, now)
+        self.assertEqual(record.timestamp('last_update'), now.timeTime())
+        self.assertTrue(record.migrate_timestamps())
+        self.assertFalse('last_update' in record.__dict__)
+        self.assertEqual(record.last_update_time, now.timeTime())
+        self.assertEqual(record.last_update, now)
+        self.assertFalse(record.migrate_timestamps())
+
+
+def make_banklist(count):
+    """Return a synthetic banklist answer with ``count`` banks."""
+    banks = ['<bank><bank_id>%04d</bank_id><bank_name>Bank %d</bank_name>'
+             '</bank>' % (i, i) for i in range(count)]
+    return '<response>%s</response>' % ''.join(banks)
+
+
+class TestStatusEvents(unittest.TestCase):
+    """Test the event for a change of the status of a payment."""
+
+    def test_status_event(self):
+        """Check the type of event depends on the old and new status."""
+        for old, new, factory in [
+                (None, 'Success', PaymentPaid),
+                ('Open', 'Success', PaymentPaid),
+                ('Open', 'Expired', PaymentExpired),
+                (None, 'Open', PaymentStatusChanged),
+                ('Open', 'Failure', PaymentStatusChanged),
+                ('Success', 'Success', PaymentStatusUnchanged),
+                (None, None, PaymentStatusUnchanged)]:
+            event = status_event('context', None, '123', old, new)
+            self.assertEqual(type(event), factory)
+            self.assertEqual((event.old_status, event.new_status), (old, new))
+            self.assertEqual(event.transaction_id, '123')
+
+
+class TestReportPreCheck(unittest.TestCase):
+    """Test the cheap checks of reports."""
+
+    def test_bloom_filter(self):
+        """Check added strings are found and others mostly not."""
+        known = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            known.add('%032x' % i)
+        self.assertEqual(len(known), 1000)
+        for i in range(1000):
+            self.assertTrue('%032x' % i in known)
+        false_positives = len([i for i in range(1000, 11000)
+                               if '%032x' % i in known])
+        self.assertTrue(false_positives < 300)
+
+    def test_parse_network(self):
+        """Check IPv4 networks are parsed."""
+        self.assertEqual(parse_network('10.1.2.3/24'),
+                         (0x0a010200, 0xffffff00))
+        self.assertEqual(parse_network('10.1.2.3'),
+                         (0x0a010203, 0xffffffff))
+        self.assertEqual(parse_network('0.0.0.0/0'), (0, 0))
+        self.assertRaises(ValueError, parse_network, '10.1.2.3/33')
+        self.assertRaises(ValueError, parse_network, 'mollie.nl')
+
+    def test_check(self):
+        """Check the reasons to reject a report are counted."""
+        precheck = ReportPreCheck(networks=['10.1.2.0/24', '10.2.0.1'])
+        transaction_id = '482d599bbcc7795727650330ad65fe9b'
+        self.assertEqual(precheck.check(None), 'missing')
+        self.assertEqual(precheck.check('foo'), 'bad_format')
+        self.assertEqual(precheck.check(transaction_id, '10.2.0.2'),
+                         'bad_address')
+        self.assertEqual(precheck.check(transaction_id, '10.2.0.1'), None)
+        self.assertEqual(precheck.check(transaction_id, '10.1.2.99'), None)
+        self.assertEqual(precheck.stats(), {
+            'accepted': 2, 'missing': 1, 'bad_format': 1, 'bad_address': 1,
+            'unknown': 0, 'known': None})
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test limiting the number of calls per second."""
+
+    def test_rate(self):
+        """Check calls are spread over time after the burst."""
+        limiter = RateLimiter(50, burst=2)
+        start = time.time()
+        for i in range(7):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_threads(self):
+        """Check the rate holds for all threads together."""
+        limiter = RateLimiter(100)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.wait) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - start >= 0.08)
+
+
+class TestXmlScaling(unittest.TestCase):
+    """Test the conversion of large answers."""
+
+    def test_banklist(self):
+        """Check the conversion of a synthetic banklist answer."""
+        xml_dict = XmlDictConfig(ElementTree.XML(make_banklist(10)))
+        self.assertEqual(len(xml_dict['bank']), 10)
+        self.assertEqual(xml_dict['bank'][9],
+                         {'bank_id': '0009', 'bank_name': 'Bank 9'})
+
+
+class TestXmlScalingBenchmark(unittest.TestCase):
+    """Micro-benchmark the conversion of large answers.
+
+    It depends on the speed of the machine, so it only runs with the
+    slow tests (``bin/test -a 2``).
+    """
+
+    level = 2
+
+    def convert_time(self, count):
+        """Return the best time of converting ``count`` banks to a dict."""
+        tree = ElementTree.XML(make_banklist(count))
+        best = None
+        gc.disable()
+        try:
+            for i in range(3):
+                start = time.time()
+                XmlDictConfig(tree)
+                duration = time.time() - start
+                if best is None or duration < best:
+                    best = duration
+        finally:
+            gc.enable()
+        return best
+
+    def test_linear_scaling(self):
+        """Check the conversion time grows linearly with the answer size.
+
+        With 10 times as many elements, the conversion should take
+        about 10 times as long. A quadratic conversion would take 100
+        times as long.
+        """
+        times = [self.convert_time(count)
+                 for count in (10, 100, 1000, 10000, 100000)]
+        self.assertTrue(times[4] < 30 * times[3],
+                        'Conversion times do not scale linearly: %r' % times)
+        self.assertTrue(times[4] < 300 * times[2],
+                        'Conversion times do not scale linearly: %r' % times)
+
+
+class FakeResponse(object):
+    """Response with an empty body."""
+    status = 200
+    length = 0
+    will_close = False
+
+    def read(self, amt=None):
+        return ''
+
+    def isclosed(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class LosingConnection(object):
+    """Connection which fails as told by the ``failures`` list.
+
+    Each failure is a tuple of the method which fails ('request' or
+    'getresponse') and the error. The sent requests are kept in
+    ``sent``.
+    """
+    failures = []
+    sent = []
+
+    def __init__(self, host, port=None, **kwargs):
+        self.sock = None
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _fail(self, method):
+        if self.failures and self.failures[0][0] == method:
+            raise self.failures.pop(0)[1]
+
+    def request(self, method, url, body=None, headers={}):
+        self._fail('request')
+        self.sent.append(body)
+
+    def getresponse(self):
+        self._fail('getresponse')
+        return FakeResponse()
+
+
+class TestConnectionPoolResend(unittest.TestCase):
+    """Test when a request on a reused connection is sent again."""
+
+    def setUp(self):
+        LosingConnection.failures = []
+        LosingConnection.sent = []
+        self.pool = HTTPSConnectionPool(
+            'localhost', connection_class=LosingConnection)
+        # Get a connection in the pool.
+        self.pool.request('POST', '/', 'a=banklist')
+
+    def test_resend_unsent(self):
+        """Check a request which could not be sent is sent again."""
+        LosingConnection.failures = [('request', socket.error('reset'))]
+        self.assertEqual(self.pool.request('POST', '/', 'a=check'),
+                         (200, ''))
+        self.assertEqual(LosingConnection.sent, ['a=banklist', 'a=check'])
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+
+    def test_no_resend_after_sent(self):
+        """Check a sent request is not sent again when the answer is lost."""
+        for error in [socket.error('reset'), httplib.BadStatusLine('')]:
+            LosingConnection.failures = [('getresponse', error)]
+            self.assertRaises(type(error), self.pool.request, 'POST', '/',
+                              'a=check')
+            # Get a reused connection in the pool again.
+            self.pool.request('POST', '/', 'a=banklist')
+        self.assertEqual(LosingConnection.sent, ['a=banklist', 'a=check'] * 2
+                         + ['a=banklist'])
+
+    def test_resend_idempotent(self):
+        """Check an idempotent request is sent again."""
+        LosingConnection.failures = [
+            ('getresponse', httplib.BadStatusLine(''))]
+        self.assertEqual(self.pool.request('POST', '/', 'a=banklist',
+                                           idempotent=True), (200, ''))
+        self.assertEqual(LosingConnection.sent, ['a=banklist'] * 3)
+
+    def test_fresh_connection(self):
+        """Check a request on a new connection is never sent again."""
+        self.pool.clear()
+        LosingConnection.failures = [
+            ('getresponse', httplib.BadStatusLine(''))]
+        self.assertRaises(httplib.BadStatusLine, self.pool.request, 'POST',
+                          '/', 'a=banklist', idempotent=True)
+        self.assertEqual(LosingConnection.sent, ['a=banklist'] * 2)
+
+    def test_ssl_timeout(self):
+        """Check a timeout of an SSL socket is raised as socket.timeout."""
+        self.pool.clear()
+        LosingConnection.failures = [
+            ('getresponse', ssl.SSLError('The read operation timed out'))]
+        self.assertRaises(socket.timeout, self.pool.request, 'POST', '/',
+                          'a=check')
+        LosingConnection.failures = [
+            ('getresponse', ssl.SSLError('bad record mac'))]
+        self.assertRaises(ssl.SSLError, self.pool.request, 'POST', '/',
+                          'a=check')
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Test the keep-alive connections to a local Mollie stand-in."""
+
+    def setUp(self):
+        self.server = MollieStandIn()
+        self.server.start()
+        self.ideal = MollieIdeal()
+        self.ideal.API_HOST = 'localhost'
+        self.ideal.API_PORT = self.server.port
+        self.ideal.SSL_CONTEXT = client_ssl_context()
+        self.ideal.BANKS_CACHE_TTL = 0
+
+    def tearDown(self):
+        self.ideal._get_pool().clear()
+        self.server.stop()
+
+    def test_connection_reused(self):
+        """Check subsequent calls use the same connection."""
+        for i in range(5):
+            banks = self.ideal.get_banks()
+            self.assertTrue(('0021', 'Rabobank') in banks)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.connections), 1)
+        stats = self.ideal.pool_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_reconnect(self):
+        """Check a connection closed by the server is reopened."""
+        self.server.drop_connections = True
+        for i in range(3):
+            banks = self.ideal.get_banks()
+            self.assertTrue(('0021', 'Rabobank') in banks)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.connections), 3)
+        stats = self.ideal.pool_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reconnects'], 2)
+
+    def test_idle_timeout(self):
+        """Check idle connections are not reused after the timeout."""
+        self.ideal.POOL_IDLE_TIMEOUT = -1
+        self.ideal.get_banks()
+        self.ideal.get_banks()
+        self.assertEqual(len(self.server.connections), 2)
+        stats = self.ideal.pool_stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['expired'], 1)
+
+    def test_pool_size(self):
+        """Check no more than the pool size connections are kept."""
+        self.ideal.POOL_SIZE = 2
+        pool = self.ideal._get_pool()
+        connections = [pool.acquire()[0] for i in range(3)]
+        self.assertEqual(pool.stats()['in_use'], 3)
+        for connection in connections:
+            pool.release(connection)
+        stats = pool.stats()
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_concurrent_requests(self):
+        """Check the pool can be used from multiple threads."""
+        errors = []
+
+        def worker():
+            try:
+                for i in range(5):
+                    self.ideal.request_payment(
+                        '999999', '9999', '123', 'Testing payment',
+                        'http://example.com/report_payment',
+                        'http://example.com/return_url')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertTrue(len(self.server.connections) <= 4)
+        self.assertEqual(self.ideal.pool_stats()['in_use'], 0)
+
+    def test_chunked_answer(self):
+        """Check an answer of unknown size is parsed while it is read."""
+        self.server.chunked = True
+        for i in range(3):
+            order = self.ideal.check_payment('999999', str(i))
+            self.assertEqual(order['consumer']['name'], 'T. TEST')
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.ideal.pool_stats()['reused'], 2)
+
+    def test_response_too_large(self):
+        """Check answers larger than the maximum size are refused."""
+        self.ideal.MAX_RESPONSE_SIZE = 100
+        self.assertRaises(ResponseTooLargeError, self.ideal.get_banks)
+        # The connection is not reused.
+        stats = self.ideal.pool_stats()
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.ideal.MAX_RESPONSE_SIZE = None
+        self.assertEqual(len(self.ideal.get_banks()), 3)
+
+    def test_response_too_large_chunked(self):
+        """Check the maximum size also works without a Content-Length."""
+        self.server.chunked = True
+        self.ideal.MAX_RESPONSE_SIZE = 150
+        self.assertRaises(ResponseTooLargeError, self.ideal.get_banks)
+        self.assertEqual(self.ideal.pool_stats()['in_use'], 0)
+        self.ideal.MAX_RESPONSE_SIZE = 10000
+        self.assertEqual(len(self.ideal.get_banks()), 3)
+
+    def test_parse_answer_from_stream(self):
+        """Check the parsers read the answer from a file-like object."""
+        pool = self.ideal._get_pool()
+        response = pool.open('POST', self.ideal.BASE_PATH, 'a=check')
+        try:
+            order = parse_order(response)
+        finally:
+            response.close()
+        self.assertEqual(order['status'], 'Success')
+        response = pool.open('POST', self.ideal.BASE_PATH, 'a=banklist')
+        try:
+            self.assertEqual(parse_answer(response)['bank'][0]['bank_id'],
+                             '0031')
+        finally:
+            response.close()
+        self.assertEqual(pool.stats()['reused'], 1)
+
+
+class TestResilience(unittest.TestCase):
+    """Test the timeouts, retries and circuit breaker."""
+
+    def setUp(self):
+        self.server = MollieStandIn()
+        self.server.start()
+        self.ideal = MollieIdeal()
+        self.ideal.API_HOST = 'localhost'
+        self.ideal.API_PORT = self.server.port
+        self.ideal.SSL_CONTEXT = client_ssl_context()
+        self.ideal.BANKS_CACHE_TTL = 0
+        self.ideal.RETRY_BACKOFF = 0.01
+        self.ideal.BREAKER_RESET_TIMEOUT = 0.2
+
+    def tearDown(self):
+        self.ideal._get_pool().clear()
+        self.server.stop()
+
+    def fail_requests(self, count, error=None):
+        """Let the first ``count`` requests to Mollie fail."""
+        calls = []
+        do_request = self.ideal._do_request
+
+        def flaky_request(data):
+            calls.append(data)
+            if len(calls) <= count:
+                raise error or socket.error('Connection refused')
+            return do_request(data)
+        self.ideal._do_request = flaky_request
+        return calls
+
+    def test_read_timeout(self):
+        """Check a hanging Mollie does not block the call forever."""
+        self.server.delay = 1
+        self.ideal.READ_TIMEOUT = 0.2
+        start = time.time()
+        self.assertRaises(socket.timeout, self.ideal.check_payment,
+                          '999999', '1')
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual(self.ideal.pool_stats()['in_use'], 0)
+
+    def test_call_deadline(self):
+        """Check the deadline limits the complete call."""
+        self.server.delay = 1
+        self.ideal.READ_TIMEOUT = None
+        self.ideal.CALL_DEADLINE = 0.3
+        start = time.time()
+        self.assertRaises(socket.timeout, self.ideal.get_banks)
+        self.assertTrue(time.time() - start < 0.9)
+
+    def test_banklist_retried(self):
+        """Check the list of banks is retried after a network error."""
+        calls = self.fail_requests(2)
+        self.assertEqual(len(self.ideal.get_banks()), 3)
+        self.assertEqual(len(calls), 3)
+
+    def test_banklist_retries_exhausted(self):
+        """Check the error is raised when all retries failed."""
+        calls = self.fail_requests(3)
+        self.assertRaises(socket.error, self.ideal.get_banks)
+        self.assertEqual(len(calls), 3)
+
+    def test_payments_not_retried(self):
+        """Check requesting and checking payments is never retried."""
+        calls = self.fail_requests(2)
+        self.assertRaises(socket.error, self.ideal.request_payment,
+                          '999999', '9999', '123', 'Testing payment',
+                          'http://example.com/report_payment',
+                          'http://example.com/return_url')
+        self.assertRaises(socket.error, self.ideal.check_payment,
+                          '999999', '1')
+        self.assertEqual(len(calls), 2)
+
+    def test_api_errors_not_retried(self):
+        """Check errors reported by Mollie are not retried."""
+        self.server.responses['banklist'] = 'error_14.xml'
+        self.assertRaises(MollieAPIError, self.ideal.get_banks)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.ideal.breaker_stats()['failures'], 0)
+
+    def test_breaker_opens(self):
+        """Check calls fail fast after a number of failures."""
+        self.ideal.BREAKER_THRESHOLD = 2
+        calls = self.fail_requests(2)
+        for i in range(2):
+            self.assertRaises(socket.error, self.ideal.check_payment,
+                              '999999', '1')
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'open')
+        self.assertRaises(MollieUnavailableError, self.ideal.check_payment,
+                          '999999', '1')
+        self.assertEqual(len(calls), 2)
+        stats = self.ideal.breaker_stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+    def test_breaker_closes(self):
+        """Check a successful trial call closes the breaker."""
+        self.ideal.BREAKER_THRESHOLD = 1
+        self.fail_requests(1)
+        self.assertRaises(socket.error, self.ideal.check_payment,
+                          '999999', '1')
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'open')
+        time.sleep(0.25)
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'half_open')
+        self.assertEqual(self.ideal.check_payment('999999', '1')['status'],
+                         'Success')
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'closed')
+
+    def test_breaker_reopens(self):
+        """Check a failed trial call opens the breaker again."""
+        self.ideal.BREAKER_THRESHOLD = 1
+        self.fail_requests(2)
+        self.assertRaises(socket.error, self.ideal.check_payment,
+                          '999999', '1')
+        time.sleep(0.25)
+        self.assertRaises(socket.error, self.ideal.check_payment,
+                          '999999', '1')
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'open')
+        self.assertEqual(self.ideal.breaker_stats()['opened'], 2)
+
+    def test_breaker_disabled(self):
+        """Check the breaker never opens with a threshold of 0."""
+        self.ideal.BREAKER_THRESHOLD = 0
+        calls = self.fail_requests(10)
+        for i in range(10):
+            self.assertRaises(socket.error, self.ideal.check_payment,
+                              '999999', '1')
+        self.assertEqual(len(calls), 10)
+        self.assertEqual(self.ideal.breaker_stats()['state'], 'closed')
+
+
+class TestCoalescing(unittest.TestCase):
+    """Test concurrent identical calls share a single request."""
+
+    def setUp(self):
+        self.server = MollieStandIn()
+        self.server.delay = 0.2
+        self.server.start()
+        self.ideal = MollieIdeal()
+        self.ideal.API_HOST = 'localhost'
+        self.ideal.API_PORT = self.server.port
+        self.ideal.SSL_CONTEXT = client_ssl_context()
+        self.ideal.BANKS_CACHE_TTL = 0
+
+    def tearDown(self):
+        self.ideal._get_pool().clear()
+        self.server.stop()
+
+    def run_concurrently(self, func, *args):
+        """Call ``func`` from 5 threads at once and return the results."""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func(*args)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_banklist_coalesced(self):
+        """Check concurrent requests for the banks share one request."""
+        results = self.run_concurrently(self.ideal.get_banks)
+        self.assertEqual(len(results), 5)
+        for banks in results:
+            self.assertTrue(('0021', 'Rabobank') in banks)
+        self.assertEqual(len(self.server.requests), 1)
+        stats = self.ideal.coalesce_stats()
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['shared'], 4)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_check_payment_coalesced(self):
+        """Check concurrent checks of a transaction share one request."""
+        results = self.run_concurrently(
+            self.ideal.check_payment, '999999',
+            '482d599bbcc7795727650330ad65fe9b')
+        self.assertEqual(len(results), 5)
+        for order in results:
+            self.assertEqual(order['status'], 'Success')
+            self.assertTrue(order['paid'])
+            self.assertEqual(order['consumer']['name'], 'T. TEST')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_check_different_payments(self):
+        """Check different transactions are not coalesced."""
+        threads = [threading.Thread(target=self.ideal.check_payment,
+                                    args=('999999', str(i)))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_request_payment_not_coalesced(self):
+        """Check payment requests are never shared."""
+        self.run_concurrently(
+            self.ideal.request_payment, '999999', '9999', '123',
+            'Testing payment', 'http://example.com/report_payment',
+            'http://example.com/return_url')
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_error_shared(self):
+        """Check all waiting threads get the error of the shared call."""
+        self.server.responses['banklist'] = 'error_14.xml'
+        errors = []
+
+        def get_banks():
+            try:
+                self.ideal.get_banks()
+            except MollieAPIError, e:
+                errors.append(e)
+        self.run_concurrently(get_banks)
+        self.assertEqual(len(errors), 5)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class TestAsyncClient(unittest.TestCase):
+    """Test the non-blocking client against a local Mollie stand-in."""
+
+    def setUp(self):
+        self.server = MollieStandIn()
+        self.server.start()
+        self.client = AsyncMollieIdeal()
+        self.client.API_HOST = 'localhost'
+        self.client.API_PORT = self.server.port
+        self.client.SSL_CONTEXT = client_ssl_context()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_banks(self):
+        """Check retrieving the list of banks."""
+        result = self.client.get_banks()
+        self.assertFalse(result.done())
+        self.client.run(timeout=10)
+        self.assertTrue(result.done())
+        self.assertTrue(('0021', 'Rabobank') in result.result())
+        self.assertEqual(self.server.requests, [{'a': 'banklist'}])
+
+    def test_request_payment(self):
+        """Check requesting a payment."""
+        result = self.client.request_payment(
+            '999999', '9999', '123', 'Testing payment',
+            'http://example.com/report_payment',
+            'http://example.com/return_url')
+        self.client.run(timeout=10)
+        transaction_id, url = result.result()
+        self.assertEqual(transaction_id, '482d599bbcc7795727650330ad65fe9b')
+
+    def test_check_payment(self):
+        """Check the status of a payment."""
+        result = self.client.check_payment(
+            '999999', '482d599bbcc7795727650330ad65fe9b')
+        self.client.run(timeout=10)
+        order = result.result()
+        self.assertTrue(order['paid'])
+        self.assertEqual(order['status'], 'Success')
+        self.assertEqual(order['consumer']['name'], 'T. TEST')
+
+    def test_callback(self):
+        """Check callbacks are called when the result arrives."""
+        results = []
+        self.client.get_banks().add_callback(results.append)
+        self.client.run(timeout=10)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(('0021', 'Rabobank') in results[0].result())
+
+    def test_mollie_error(self):
+        """Check errors from Mollie are raised as MollieAPIError."""
+        self.server.responses['banklist'] = 'error_14.xml'
+        result = self.client.get_banks()
+        self.client.run(timeout=10)
+        self.assertTrue(isinstance(result.exception(), MollieAPIError))
+        self.assertRaises(MollieAPIError, result.result)
+
+    def test_concurrent_calls(self):
+        """Check a lot of calls can be in flight in a single thread."""
+        self.server.delay = 0.5
+        results = [self.client.check_payment('999999', str(i))
+                   for i in range(20)]
+        self.assertEqual(self.client.pending(), 20)
+        start = time.time()
+        self.client.run(timeout=10)
+        # Handled one by one this would take at least 10 seconds.
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.client.pending(), 0)
+        for result in results:
+            self.assertEqual(result.result()['status'], 'Success')
+        self.assertEqual(len(self.server.requests), 20)
+
+    def test_timeout(self):
+        """Check calls which take too long fail."""
+        self.server.delay = 1
+        result = self.client.get_banks()
+        self.client.run(timeout=0.1)
+        self.assertEqual(self.client.pending(), 0)
+        self.assertRaises(socket.timeout, result.result)
+
+    def test_connection_refused(self):
+        """Check connection errors are raised."""
+        self.client.API_PORT = self.server.port
+        self.server.stop()
+        result = self.client.get_banks()
+        self.client.run(timeout=10)
+        self.assertRaises(socket.error, result.result)
+        self.server = MollieStandIn()
+        self.server.start()
+
+
+class TestBatchCheck(unittest.TestCase):
+    """Test checking multiple payments concurrently."""
+
+    def setUp(self):
+        self.server = MollieStandIn()
+        self.server.start()
+        self.ideal = MollieIdeal()
+        self.ideal.API_HOST = 'localhost'
+        self.ideal.API_PORT = self.server.port
+        self.ideal.SSL_CONTEXT = client_ssl_context()
+        self.pairs = [('999999', str(i)) for i in range(10)]
+
+    def tearDown(self):
+        self.ideal._get_pool().clear()
+        self.server.stop()
+
+    def test_check_payments(self):
+        """Check a result is returned for each payment."""
+        results = list(self.ideal.check_payments(self.pairs))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(
+            sorted([(r.partner_id, r.transaction_id) for r in results]),
+            sorted(self.pairs))
+        for result in results:
+            self.assertEqual(result.error, None)
+            self.assertEqual(result.order['status'], 'Success')
+            self.assertTrue(result.order['paid'])
+
+    def test_concurrency(self):
+        """Check the payments are checked concurrently, but bounded."""
+        self.server.delay = 0.3
+        start = time.time()
+        results = list(self.ideal.check_payments(self.pairs, max_workers=5))
+        # One by one this would take at least 3 seconds.
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.server.max_active, 5)
+
+    def test_completion_order(self):
+        """Check results are returned as soon as they are available."""
+        self.server.delay = 0.3
+        results = self.ideal.check_payments(self.pairs, max_workers=10)
+        start = time.time()
+        results.next()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(list(results)), 9)
+
+    def test_errors(self):
+        """Check errors are returned as part of the results."""
+        self.server.responses['check'] = 'error_14.xml'
+        results = list(self.ideal.check_payments(self.pairs))
+        self.assertEqual(len(results), 10)
+        for result in results:
+            self.assertEqual(result.order, None)
+            self.assertTrue(isinstance(result.error, MollieAPIError))
+
+    def test_timeout(self):
+        """Check payments which take too long are returned as errors."""
+        self.server.delay = 1
+        start = time.time()
+        results = list(self.ideal.check_payments(
+            self.pairs[:2], max_workers=2, timeout=0.2))
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(isinstance(result.error, socket.timeout))
+
+    def test_no_payments(self):
+        """Check nothing is returned when there is nothing to check."""
+        self.assertEqual(list(self.ideal.check_payments([])), [])
+
+    def test_late_answer(self):
+        """Check the answer of an abandoned check is still delivered."""
+        answered = threading.Event()
+        late = []
+
+        def check(partner_id, transaction_id):
+            time.sleep(0.3)
+            return {'status': 'Success'}
+
+        def deliver(result):
+            late.append(result)
+            answered.set()
+
+        checker = BatchChecker(check, max_workers=1, timeout=0.05,
+                               late=deliver)
+        results = list(checker.run(self.pairs[:1]))
+        self.assertTrue(isinstance(results[0].error, socket.timeout))
+        answered.wait(5)
+        self.assertEqual(len(late), 1)
+        self.assertEqual(late[0].transaction_id, '0')
+        self.assertEqual(late[0].order, {'status': 'Success'})
@@ -0,0 +1,172 @@
+"""
+Migrations of the stored payments.
+
+The migrations find the payments through the site wide transaction
+index. Payments stored before the index existed are not in it, so
+``backfill_index`` first walks the whole site to add them. The
+migrations work in batches and (optionally) commit after each batch,
+so they can run in the background next to a live site without a huge
+transaction which conflicts with the reports from Mollie. The upgrade
+steps do not commit the transaction of GenericSetup, they only add a
+savepoint after each batch.
+"""
+import logging
+
+import transaction
+from zope.annotation import IAnnotations
+from zope.component import queryUtility
+
+from collective.mollie.adapter import get_indexed_payment
+from collective.mollie.adapter import migrate_timestamps
+from collective.mollie.config import IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY
+from collective.mollie.config import IDEAL_PAYMENT_ANNOTATION_KEY
+from collective.mollie.interfaces import IMollieIdealMultiplePayments
+from collective.mollie.interfaces import IMollieIdealPayment
+from collective.mollie.interfaces import IMollieTransactionIndex
+
+logger = logging.getLogger('collective.mollie')
+
+
+def _end_batch(commit):
+    """Commit the batch, or only add a savepoint so the changed objects
+    can be removed from the cache."""
+    if commit:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+
+
+def find_payments(root):
+    """Yield the (object, multiple) pairs of the objects below (and
+    including) ``root`` on which payments are stored.
+
+    ``multiple`` tells whether the payments are stored with the
+    ``IMollieIdealMultiplePayments`` adapter. An object can have both.
+    Only the contents of folderish objects are walked.
+    """
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        annotations = IAnnotations(obj, None)
+        if annotations is not None:
+            if annotations.get(IDEAL_PAYMENT_ANNOTATION_KEY) is not None:
+                yield obj, False
+            if annotations.get(
+                    IDEAL_MULTIPLE_PAYMENTS_ANNOTATION_KEY) is not None:
+                yield obj, True
+        if getattr(obj, 'isPrincipiaFolderish', False):
+            stack.extend(obj.objectValues())
+
+
+def _stored_payments(obj, multiple):
+    """Yield the transaction IDs and records of the payments on ``obj``."""
+    if multiple:
+        for transaction_id, payment in \
+                IMollieIdealMultiplePayments(obj).iter_transactions():
+            yield transaction_id, payment
+        return
+    payment = IMollieIdealPayment(obj)._storage()
+    if payment is not None and payment['transaction_id']:
+        yield payment['transaction_id'], payment
+
+
+def backfill_index(index, root, batch_size=100, commit=True):
+    """Add the payments stored on the objects below ``root`` to the
+    transaction index.
+
+    Payments stored before the index existed (or on objects which were
+    not indexed) are only found by walking the whole site. Afterwards
+    the index is marked ``complete``. After every ``batch_size``
+    payments, the transaction is committed (when ``commit`` is True,
+    otherwise a savepoint is added). Return the number of indexed
+    payments.
+    """
+    indexed = 0
+    for obj, multiple in find_payments(root):
+        for transaction_id, payment in _stored_payments(obj, multiple):
+            if not index.index_transaction(transaction_id, obj, multiple):
+                continue
+            index.index_payment(transaction_id, payment)
+            indexed += 1
+            if indexed % batch_size == 0:
+                logger.info('Indexed %d stored payments.', indexed)
+                _end_batch(commit)
+    index.complete = True
+    if commit:
+        transaction.commit()
+    logger.info('Indexed %d stored payments in total.', indexed)
+    return indexed
+
+
+def migrate_indexed_payments(index, root, batch_size=100, commit=True):
+    """Migrate the payments of all objects in the transaction index.
+
+    Each object is migrated once, even when it has several payments.
+    After every ``batch_size`` migrated objects, the transaction is
+    committed (when ``commit`` is True, otherwise a savepoint is
+    added). Return the number of migrated objects.
+    """
+    seen = set()
+    migrated = 0
+    for transaction_id in index.keys():
+        entry = index.get(transaction_id)
+        if entry is None or entry[:2] in seen:
+            continue
+        seen.add(entry[:2])
+        obj = index.resolve(transaction_id, root)
+        if obj is None or not migrate_timestamps(obj):
+            continue
+        migrated += 1
+        if migrated % batch_size == 0:
+            logger.info('Migrated the payments of %d objects.', migrated)
+            _end_batch(commit)
+    if commit:
+        transaction.commit()
+    logger.info('Migrated the payments of %d objects in total.', migrated)
+    return migrated
+
+
+def reindex_payments(index, root, batch_size=100, commit=True):
+    """Add the status of all indexed payments to the secondary indexes.
+
+    After every ``batch_size`` payments, the transaction is committed
+    (when ``commit`` is True, otherwise a savepoint is added). Return
+    the number of indexed payments.
+    """
+    indexed = 0
+    for transaction_id in index.keys():
+        payment = get_indexed_payment(index, transaction_id, root)
+        if payment is None:
+            continue
+        index.index_payment(transaction_id, payment)
+        indexed += 1
+        if indexed % batch_size == 0:
+            logger.info('Indexed %d payments.', indexed)
+            _end_batch(commit)
+    if commit:
+        transaction.commit()
+    logger.info('Indexed %d payments in total.', indexed)
+    return indexed
+
+
+def upgrade_timestamps(setup_tool):
+    """Upgrade step: store the times of the payments as epoch floats."""
+    index = queryUtility(IMollieTransactionIndex)
+    if index is None:
+        return
+    root = setup_tool.aq_parent
+    backfill_index(index, root, commit=False)
+    migrate_indexed_payments(index, root, commit=False)
+
+
+def upgrade_payment_indexes(setup_tool):
+    """Upgrade step: index the status of the stored payments."""
+    index = queryUtility(IMollieTransactionIndex)
+    if index is None:
+        return
+    root = setup_tool.aq_parent
+    if index.complete:
+        reindex_payments(index, root, commit=False)
+    else:
+        # Indexes the stored payments in the secondary indexes as well.
+        backfill_index(index, root, commit=False)
@@ -7,10 +7,27 @@ The code of the XmlListConfig and XmlDictConfig classes came from:
  - http://code.activestate.com/recipes/410469-xml-as-dictionary/#c3
 """
 
+from cStringIO import StringIO
+
 try:
-    from xml.etree import ElementTree
-except:
-    from elementtree import ElementTree
+    # The C implementation parses a lot faster.
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    try:
+        from xml.etree import ElementTree
+    except:
+        from elementtree import ElementTree
+
+
+def _as_file(source):
+    """Return ``source`` as a file-like object.
+
+    ``source`` is either a string with XML or a file-like object (for
+    instance an HTTP response) which is returned as is.
+    """
+    if hasattr(source, 'read'):
+        return source
+    return StringIO(source)
 
 
 def xml_string_to_dict(text):
@@ -19,20 +36,39 @@ def xml_string_to_dict(text):
     return XmlDictConfig(tree)
 
 
+def xml_to_dict(source):
+    """Parse the XML from a string or file-like object and return a dict."""
+    if not hasattr(source, 'read'):
+        return xml_string_to_dict(source)
+    return XmlDictConfig(ElementTree.parse(source).getroot())
+
+
+def iterparse(source, events=('end',)):
+    """Incrementally parse the XML from a string or file-like object.
+
+    Return an iterator over (event, element) tuples, see
+    ``ElementTree.iterparse``. A file-like object is read in chunks
+    while the XML is parsed, so it is never read completely in memory.
+    """
+    return ElementTree.iterparse(_as_file(source), events)
+
+
 class XmlListConfig(list):
     def __init__(self, aList):
+        append = self.append
         for element in aList:
             if len(element) > 0:
-                # treat like dict
+                # treat like dict - we assume that if the first two tags
+                # in a series are different, then they are all different.
                 if len(element) == 1 or element[0].tag != element[1].tag:
-                    self.append(XmlDictConfig(element))
-                    # treat like list
-                elif element[0].tag == element[1].tag:
-                    self.append(XmlListConfig(element))
+                    append(XmlDictConfig(element))
+                # treat like list
+                else:
+                    append(XmlListConfig(element))
             elif element.text:
                 text = element.text.strip()
                 if text:
-                    self.append(text)
+                    append(text)
 
 
 class XmlDictConfig(dict):
@@ -49,18 +85,26 @@ class XmlDictConfig(dict):
     >>> xmldict = XmlDictConfig(root)
 
     And then use xmldict for what it is... a dict.
+
+    The conversion takes linear time in the number of elements: the
+    occurrences of each tag are counted once, before the children are
+    converted.
     """
 
     def __init__(self, parent_element):
-        childrenNames = [child.tag for child in parent_element.getchildren()]
+        attributes = parent_element.items()
+        if attributes:
+            self.update(attributes)
 
-        if parent_element.items():  # attributes
-            self.update(dict(parent_element.items()))
+        counts = {}
         for element in parent_element:
+            counts[element.tag] = counts.get(element.tag, 0) + 1
+
+        for element in parent_element:
+            tag = element.tag
             if len(element) > 0:
                 # treat like dict - we assume that if the first two tags
                 # in a series are different, then they are all different.
-                #print len(element), element[0].tag, element[1].tag
                 if len(element) == 1 or element[0].tag != element[1].tag:
                     aDict = XmlDictConfig(element)
                 # treat like list - we assume that if the first two tags
@@ -71,28 +115,28 @@ class XmlDictConfig(dict):
                     # the value is the list itself
                     aDict = {element[0].tag: XmlListConfig(element)}
                 # if the tag has attributes, add those to the dict
-                if element.items():
-                    aDict.update(dict(element.items()))
+                attributes = element.items()
+                if attributes:
+                    aDict.update(attributes)
 
-                if childrenNames.count(element.tag) > 1:
-                    try:
-                        currentValue = self[element.tag]
+                if counts[tag] > 1:
+                    currentValue = self.get(tag)
+                    if isinstance(currentValue, list):
                         currentValue.append(aDict)
-                        self.update({element.tag: currentValue})
-                    except:
-                        # the first of its kind, an empty list must be created
-                        # aDict is written in [], i.e. it will be a list
-                        self.update({element.tag: [aDict]})
-
+                    else:
+                        # the first of its kind, a list must be created
+                        self[tag] = [aDict]
                 else:
-                    self.update({element.tag: aDict})
+                    self[tag] = aDict
             # this assumes that if you've got an attribute in a tag,
             # you won't be having any text. This may or may not be a
             # good idea -- time will tell. It works for the way we are
             # currently doing XML configuration files...
-            elif element.items():
-                self.update({element.tag: dict(element.items())})
-            # finally, if there are no child tags and no attributes, extract
-            # the text
             else:
-                self.update({element.tag: element.text})
+                attributes = element.items()
+                if attributes:
+                    self[tag] = dict(attributes)
+                # finally, if there are no child tags and no attributes,
+                # extract the text
+                else:
+                    self[tag] = element.text
@@ -13,13 +13,11 @@ setup(name='collective.mollie',
       # http://pypi.python.org/pypi?:action=list_classifiers
       classifiers=[
         "Environment :: Web Environment",
-        "Framework :: Plone :: 3.3",
         "Framework :: Plone :: 4.0",
         "Framework :: Plone :: 4.1",
         "Framework :: Plone :: 4.2",
         "License :: OSI Approved :: GNU General Public License (GPL)",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 2.4",
         "Programming Language :: Python :: 2.6",
         ],
       keywords='ideal mollie plone',
@@ -43,5 +41,8 @@ setup(name='collective.mollie',
 
       [z3c.autoinclude.plugin]
       target = plone
+
+      [zopectl.command]
+      reconcile_mollie = collective.mollie.reconcile:reconcile_command
       """,
       )